@@ -0,0 +1,198 @@
+"""
+Time the phases of c3i examine on a synthetic recipe repository.
+
+A repository is generated with benchmarks/synthetic_repo.py, then compute_builds
+is run on it `--repeat` times, each in a fresh process so that no render caches
+carry over.  The time spent in each phase is recorded; phases nest, so
+construct_graph includes add_intradependencies and collapse_subpackage_nodes and
+graph_to_plan_with_jobs includes order_build.
+
+Everything runs offline: the only channel is an empty local one.  Results are
+written to benchmarks/results as JSON and compared with the last result for the
+same parameters, so regressions are visible:
+
+    python benchmarks/run_benchmarks.py --feedstocks 500 --variants 4
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+from synthetic_repo import add_generator_args, generate_repo, generator_kwargs
+
+results_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# (module, function) pairs which are timed, in the order they are reported
+PHASES = [
+    ('execute', 'collect_tasks'),
+    ('execute', 'construct_graph'),
+    ('compute_build_graph', 'add_intradependencies'),
+    ('compute_build_graph', 'collapse_subpackage_nodes'),
+    ('execute', 'expand_run'),
+    ('execute', 'collapse_noarch_python_nodes'),
+    ('execute', 'graph_to_plan_with_jobs'),
+    ('execute', 'order_build'),
+    ('execute', 'write_plan'),
+    ('execute', 'write_recipes'),
+    ('execute', 'compute_builds'),
+]
+
+
+def _write_condarc(path, channel_url):
+    """ Point conda at the local channel only, so nothing is fetched from the network """
+    condarc = os.path.join(path, 'condarc')
+    with open(condarc, 'w') as f:
+        json.dump({'channels': [channel_url], 'default_channels': [channel_url],
+                   'offline': True}, f)
+    return condarc
+
+
+def _timed(func, totals):
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            totals[func.__name__] += time.perf_counter() - start
+    return wrapper
+
+
+def _run_once(repo, folders, steps):
+    """ Run compute_builds once, returning the seconds spent in each phase """
+    # conda reads its configuration when first imported, so set it up before that
+    os.environ['CONDARC'] = repo['condarc']
+    from conda_concourse_ci import compute_build_graph, execute
+    modules = {'execute': execute, 'compute_build_graph': compute_build_graph}
+    totals = defaultdict(float)
+    for module, name in PHASES:
+        setattr(modules[module], name, _timed(getattr(modules[module], name), totals))
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        execute.compute_builds(
+            repo['recipes_dir'], 'bench', folders,
+            matrix_base_dir=repo['config_dir'],
+            steps=steps, max_downstream=-1,
+            output_dir=output_dir,
+            channel=[repo['channel_url']],
+            variant_config_files=[repo['variant_config_file']],
+        )
+    return dict(totals)
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(__file__),
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def _previous_result(params):
+    for path in sorted(glob.glob(os.path.join(results_dir, '*.json')), reverse=True):
+        with open(path) as f:
+            result = json.load(f)
+        if result.get('params') == params:
+            return path, result
+    return None, None
+
+
+def _compare(previous, current, threshold):
+    """ Print the change of each phase, returning the phases which got slower """
+    regressions = []
+    print("{:<28} {:>10} {:>10} {:>8}".format('phase', 'before', 'now', 'ratio'))
+    for phase, timing in current.items():
+        before = previous.get(phase, {}).get('median')
+        if not before:
+            continue
+        ratio = timing['median'] / before
+        flag = ''
+        if ratio > threshold:
+            regressions.append(phase)
+            flag = '  REGRESSION'
+        print("{:<28} {:>10.3f} {:>10.3f} {:>8.2f}{}".format(
+            phase, before, timing['median'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_generator_args(parser)
+    parser.add_argument('--changed', type=int, default=0,
+                        help=("number of randomly chosen feedstocks to examine, following all "
+                              "of their dependents.  Default is 0, examining every feedstock."))
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="number of times to run, default is 3")
+    parser.add_argument('--threshold', type=float, default=1.2,
+                        help=("ratio to the last result above which a phase counts as a "
+                              "regression, default is 1.2"))
+    parser.add_argument('--fail-on-regression', action='store_true',
+                        help="exit with an error when a phase regressed")
+    parser.add_argument('--no-save', action='store_true', help="do not store the results")
+    args = parser.parse_args()
+
+    params = dict(generator_kwargs(args), changed=args.changed)
+    with tempfile.TemporaryDirectory() as path:
+        repo = generate_repo(path, **generator_kwargs(args))
+        repo['condarc'] = _write_condarc(path, repo['channel_url'])
+        folders = repo.pop('folders')
+        steps = 0
+        if args.changed:
+            folders = sorted(random.Random(args.seed).sample(folders, args.changed))
+            steps = -1
+        runs = []
+        # spawn a fresh interpreter for each run, so that no caches are shared between them
+        ctx = multiprocessing.get_context('spawn')
+        for count in range(args.repeat):
+            with ctx.Pool(1) as pool:
+                runs.append(pool.apply(_run_once, (repo, folders, steps)))
+            print("run {}/{}: {:.2f}s".format(count + 1, args.repeat,
+                                              runs[-1].get('compute_builds', 0)))
+
+    timings = {}
+    for _, phase in PHASES:
+        values = [run.get(phase, 0.0) for run in runs]
+        timings[phase] = {'min': min(values), 'median': statistics.median(values),
+                          'max': max(values)}
+    from conda_build import __version__ as conda_build_version
+    result = {
+        'params': params,
+        'revision': _git_revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'conda_build': conda_build_version,
+        'timings': timings,
+    }
+
+    previous_path, previous = _previous_result(params)
+    regressions = []
+    if previous:
+        print("compared with {}".format(os.path.basename(previous_path)))
+        regressions = _compare(previous['timings'], timings, args.threshold)
+    else:
+        for phase, timing in timings.items():
+            print("{:<28} {:>10.3f}".format(phase, timing['median']))
+
+    if not args.no_save:
+        os.makedirs(results_dir, exist_ok=True)
+        path = os.path.join(results_dir, '{}-{}.json'.format(
+            time.strftime('%Y%m%d-%H%M%S'), result['revision']))
+        with open(path, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        print("results written to {}".format(path))
+    if regressions and args.fail_on_regression:
+        sys.exit("phases slower than before: {}".format(', '.join(regressions)))
+
+
+if __name__ == '__main__':
+    main()
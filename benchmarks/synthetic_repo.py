@@ -0,0 +1,163 @@
+"""
+Generate synthetic recipe repositories for benchmarking c3i.
+
+The repository holds `feedstocks` recipe folders whose dependencies form a
+random DAG, with a c3i configuration folder and an empty local file channel,
+so that examining it does not need the network.  For example:
+
+    python benchmarks/synthetic_repo.py /tmp/bench-repo --feedstocks 500 --variants 4
+"""
+import argparse
+import json
+import os
+import random
+
+import yaml
+
+# the variant key which every arch-specific recipe uses, so that it is built once per value
+VARIANT_KEY = 'c3i_bench_variant'
+LABEL = 'linux-64'
+
+
+def _pick_dependencies(index, dependents, fan_in, fan_out, rng):
+    """ Pick up to fan_in earlier recipes with fewer than fan_out dependents """
+    candidates = [i for i in range(index) if dependents[i] < fan_out]
+    deps = rng.sample(candidates, min(len(candidates), rng.randint(0, fan_in)))
+    for dep in deps:
+        dependents[dep] += 1
+    return sorted(deps)
+
+
+def _requirements(deps, indent):
+    if not deps:
+        return []
+    pad = ' ' * indent
+    lines = [pad + 'requirements:', pad + '  host:']
+    lines.extend(pad + '    - ' + dep for dep in deps)
+    lines.append(pad + '  run:')
+    lines.extend(pad + '    - ' + dep for dep in deps)
+    return lines
+
+
+def _meta_yaml(name, deps, multi_output, noarch):
+    lines = [
+        "package:",
+        "  name: {}".format(name + '-split' if multi_output else name),
+        "  version: 1.0.0",
+        "",
+        "build:",
+        "  number: 0",
+        "  noarch: generic" if noarch else "  string: v{{ %s }}_{{ PKG_BUILDNUM }}" % VARIANT_KEY,
+        "",
+    ]
+    if multi_output:
+        lines.append("outputs:")
+        lines.append("  - name: {}-lib".format(name))
+        lines.extend(_requirements(deps, 4))
+        lines.append("  - name: {}".format(name))
+        lines.extend(["    requirements:", "      run:", "        - {}-lib".format(name)])
+    else:
+        lines.extend(_requirements(deps, 0))
+    lines.extend(["", "about:", "  summary: synthetic benchmark recipe", ""])
+    return '\n'.join(lines)
+
+
+def generate_repo(path, feedstocks=100, fan_in=3, fan_out=10, multi_output_share=0.1,
+                  noarch_share=0.2, variants=2, seed=0):
+    """ Write a synthetic repository to path and return a description of it.
+
+    path gets three folders: ``recipes`` with one folder per feedstock, ``config``
+    with the c3i configuration for a single linux-64 worker and ``channel``, an
+    empty local channel.  Each feedstock depends on up to `fan_in` earlier ones,
+    and no feedstock has more than `fan_out` dependents.  `multi_output_share` of
+    them have two outputs, `noarch_share` are noarch and all others are built for
+    each of the `variants` values of the variant key.
+    """
+    rng = random.Random(seed)
+    recipes_dir = os.path.join(path, 'recipes')
+    config_dir = os.path.join(path, 'config')
+    channel_dir = os.path.join(path, 'channel')
+    for folder in (recipes_dir, os.path.join(config_dir, 'build_platforms.d')):
+        os.makedirs(folder, exist_ok=True)
+
+    dependents = [0] * feedstocks
+    folders = []
+    for index in range(feedstocks):
+        name = 'pkg{:05d}'.format(index)
+        deps = ['pkg{:05d}'.format(dep)
+                for dep in _pick_dependencies(index, dependents, fan_in, fan_out, rng)]
+        multi_output = rng.random() < multi_output_share
+        noarch = rng.random() < noarch_share
+        folder = name + '-feedstock'
+        os.makedirs(os.path.join(recipes_dir, folder), exist_ok=True)
+        with open(os.path.join(recipes_dir, folder, 'meta.yaml'), 'w') as f:
+            f.write(_meta_yaml(name, deps, multi_output, noarch))
+        folders.append(folder)
+
+    with open(os.path.join(config_dir, 'conda_build_config.yaml'), 'w') as f:
+        yaml.dump({VARIANT_KEY: [str(i) for i in range(variants)]}, f,
+                  default_flow_style=False)
+    with open(os.path.join(config_dir, 'build_platforms.d', LABEL + '.yml'), 'w') as f:
+        yaml.dump({'label': LABEL, 'platform': 'linux', 'arch': '64',
+                   'pool_name': 'linux'}, f, default_flow_style=False)
+    with open(os.path.join(config_dir, 'config.yml'), 'w') as f:
+        yaml.dump({
+            'concourse-url': 'http://localhost:8080',
+            'base-name': 'bench',
+            'recipe-repo': 'bench-repo',
+            # the plan refers to the intermediate server, which the benchmark never contacts
+            'intermediate-server': 'localhost',
+            'intermediate-base-folder': '/ci',
+            'intermediate-user': 'bench',
+            'intermediate-private-key-job': 'bench-key',
+            'build_env_pkgs': '/ci/build_pack',
+        }, f, default_flow_style=False)
+
+    for subdir in ('linux-64', 'noarch'):
+        os.makedirs(os.path.join(channel_dir, subdir), exist_ok=True)
+        with open(os.path.join(channel_dir, subdir, 'repodata.json'), 'w') as f:
+            json.dump({'info': {'subdir': subdir}, 'packages': {}}, f)
+
+    return {
+        'recipes_dir': recipes_dir,
+        'config_dir': config_dir,
+        'channel_url': 'file://' + os.path.abspath(channel_dir),
+        'variant_config_file': os.path.join(config_dir, 'conda_build_config.yaml'),
+        'folders': folders,
+    }
+
+
+def add_generator_args(parser):
+    parser.add_argument('--feedstocks', type=int, default=100,
+                        help="number of feedstocks, default is 100")
+    parser.add_argument('--fan-in', type=int, default=3,
+                        help="most dependencies of a feedstock, default is 3")
+    parser.add_argument('--fan-out', type=int, default=10,
+                        help="most dependents of a feedstock, default is 10")
+    parser.add_argument('--multi-output-share', type=float, default=0.1,
+                        help="share of feedstocks with two outputs, default is 0.1")
+    parser.add_argument('--noarch-share', type=float, default=0.2,
+                        help="share of noarch feedstocks, default is 0.2")
+    parser.add_argument('--variants', type=int, default=2,
+                        help="size of the variant matrix, default is 2")
+    parser.add_argument('--seed', type=int, default=0,
+                        help="seed of the random generator, default is 0")
+
+
+def generator_kwargs(args):
+    return {key: getattr(args, key) for key in (
+        'feedstocks', 'fan_in', 'fan_out', 'multi_output_share', 'noarch_share', 'variants',
+        'seed')}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('path', help="folder to write the repository to")
+    add_generator_args(parser)
+    args = parser.parse_args()
+    repo = generate_repo(args.path, **generator_kwargs(args))
+    print("wrote {} feedstocks to {}".format(len(repo['folders']), repo['recipes_dir']))
+
+
+if __name__ == '__main__':
+    main()
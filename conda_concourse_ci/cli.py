@@ -2,14 +2,32 @@ import argparse
 import logging
 import os
 
-from conda_build.conda_interface import cc_conda_build
+from conda_concourse_ci import __version__, serve
 
-from conda_concourse_ci import __version__, execute
+# Options of each subcommand which default to the matrix_base_dir setting of conda-build in
+#    condarc.  That is only looked up when the option is not given, as importing conda-build
+#    is slow; the pipeline management commands do not need it otherwise.
+_condarc_matrix_base_dir_options = {
+    'examine': 'matrix_base_dir',
+    'one-off': 'config_root_dir',
+    'batch': 'config_root_dir',
+    'rm': 'config_root_dir',
+    'pause': 'config_root_dir',
+    'unpause': 'config_root_dir',
+    'trigger': 'config_root_dir',
+    'abort': 'config_root_dir',
+}
 
 
 def parse_args(parse_this=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--profile', metavar='REPORT',
+                        help=("write the wall time, CPU time and memory high-water mark of each "
+                              "phase of the command to this file as JSON"))
+    parser.add_argument('--profile-dir',
+                        help=("with --profile, also write a cProfile dump of each phase to this "
+                              "folder"))
     parser.add_argument('--version', action='version',
         help='Show the conda-build version number and exit.',
         version='conda-concourse-ci %s' % __version__)
@@ -40,8 +58,7 @@ def parse_args(parse_this=None):
     examine_parser.add_argument('--test', action='store_true',
                         help='test packages (instead of building AND testing them)')
     examine_parser.add_argument('--matrix-base-dir',
-                                help='path to matrix configuration, if different from recipe path',
-                                default=cc_conda_build.get('matrix_base_dir'))
+                                help='path to matrix configuration, if different from recipe path')
     examine_parser.add_argument('--output-dir', help="folder where output plan and recipes live",
                                 default='../output')
     examine_parser.add_argument('--channel', '-c', action='append',
@@ -66,6 +83,31 @@ def parse_args(parse_this=None):
         '--no-skip-existing', help="Do not skip existing builds",
         dest="skip_existing", action="store_false"
     )
+    examine_parser.add_argument('--dedup-plan', action='store_true',
+                                help=("write the parts of plan.yml which repeat, such as the "
+                                      "images and scripts of the tasks of each platform, once "
+                                      "as YAML anchors, and print how much smaller that makes "
+                                      "the plan"))
+    examine_parser.add_argument('--stage-mode', choices=('copy', 'link', 'reflink'),
+                                default='copy',
+                                help=("how the files of each recipe are put into the output "
+                                      "folder of each of its jobs: copied, hardlinked, or "
+                                      "reflinked where the filesystem supports it.  Files "
+                                      "which can not be linked are copied"))
+    examine_parser.add_argument('--group-by-feedstock', action='store_true',
+                                help=("besides the pipeline groups of jobs by worker label and "
+                                      "dependency level, add a group of the jobs of each "
+                                      "recipe folder"))
+    examine_parser.add_argument('--cache-dir',
+                                help=("folder to store the rendered recipes of each commit in.  "
+                                      "Only the recipes changed since the last stored commit "
+                                      "are rendered again."))
+    examine_parser.add_argument('--server', default=serve.DEFAULT_SOCKET, dest='server_socket',
+                                help=("socket of a c3i server (see c3i serve) to send the work "
+                                      "to, if one is running.  Default is %(default)s"))
+    examine_parser.add_argument('--no-server', action='store_const', const=None,
+                                dest='server_socket',
+                                help="examine in this process, even when a c3i server is running")
     submit_parser = sp.add_parser('submit', help="submit plan director to configured server")
     submit_parser.add_argument('base_name',
                                help="name of your project, to distinguish it from other projects")
@@ -155,8 +197,7 @@ def parse_args(parse_this=None):
     one_off_parser.add_argument('--recipe-root-dir', default=os.getcwd(),
                                 help="path containing recipe folders to upload")
     one_off_parser.add_argument('--config-root-dir',
-                                help="path containing config.yml and matrix definitions",
-                                default=cc_conda_build.get('matrix_base_dir'))
+                                help="path containing config.yml and matrix definitions")
     one_off_parser.add_argument('--private', action='store_false',
                         help='hide build logs (overall graph still shown in Concourse web view)',
                         dest='public')
@@ -195,6 +236,26 @@ def parse_args(parse_this=None):
         '--no-skip-existing', help="Do not skip existing builds",
         dest="skip_existing", action="store_false"
     )
+    one_off_parser.add_argument(
+        '--dedup-plan', action='store_true',
+        help=("write the parts of plan.yml which repeat, such as the images and scripts "
+              "of the tasks of each platform, once as YAML anchors, and print how much "
+              "smaller that makes the plan"))
+    one_off_parser.add_argument(
+        '--stage-mode', choices=('copy', 'link', 'reflink'), default='copy',
+        help=("how the files of each recipe are put into the output folder of each of its "
+              "jobs: copied, hardlinked, or reflinked where the filesystem supports it.  "
+              "Files which can not be linked are copied"))
+    one_off_parser.add_argument(
+        '--group-by-feedstock', action='store_true',
+        help=("besides the pipeline groups of jobs by worker label and dependency level, "
+              "add a group of the jobs of each recipe folder"))
+    one_off_parser.add_argument(
+        '--max-shard-jobs', type=int, default=None,
+        help=("split a plan of more jobs than this into pipelines which share no jobs, "
+              "named <pipeline_label>-<i>-of-<n>, and submit each of them.  A group of "
+              "jobs which depend on each other is never split, so a pipeline may have "
+              "more jobs than this when one group does"))
     one_off_parser.add_argument(
         '--use-repo-access',
         help="Pass the repo access credentials to the workers",
@@ -233,21 +294,43 @@ def parse_args(parse_this=None):
               "job, default is 6"))
     batch_parser.add_argument(
         '--poll-time', default=120, type=int,
-        help=("time in seconds between checking concourse server for active "
-              "builds, default is 120 seconds."))
+        help=("longest time in seconds between checking concourse server for active "
+              "builds, default is 120 seconds.  Checks are more frequent while builds "
+              "are finishing quickly."))
     batch_parser.add_argument(
         '--build-lookback', default=500, type=int,
-        help="number of builds to examine for active builds, default is 500")
+        help=("number of builds to examine for active builds on the first check, "
+              "default is 500.  Later checks only look at newer builds."))
     batch_parser.add_argument(
         '--label-prefix', default='autobot_',
         help="prefix for pipeline labels, default is autobot_")
+    batch_parser.add_argument(
+        '--precompute', default=2, type=int,
+        help=("number of background processes computing the plans of upcoming jobs while "
+              "earlier ones are submitted, default is 2.  0 computes each plan just "
+              "before it is submitted."))
+    batch_parser.add_argument(
+        '--order', default='alpha', choices=('alpha', 'deps'),
+        help=("order in which to submit the jobs.  'alpha' (default) follows the sorted "
+              "batch file.  'deps' renders all recipes first and submits each job after "
+              "the jobs it depends on, longest chain of dependent builds first."))
+    batch_parser.add_argument(
+        '--checkpoint',
+        help=("file recording the status of each job.  Rerunning with the same file "
+              "resumes the batch, skipping jobs which were already submitted."))
+    batch_parser.add_argument(
+        '--retries', default=3, type=int,
+        help="number of times to retry a job which failed, default is 3")
+    batch_parser.add_argument(
+        '--retry-delay', default=60, type=int,
+        help=("seconds to wait before retrying a failed job, doubled for each further "
+              "retry, default is 60"))
 
     # one-off arguments
     batch_parser.add_argument('--recipe-root-dir', default=os.getcwd(),
                                 help="path containing recipe folders to upload")
     batch_parser.add_argument('--config-root-dir',
-                                help="path containing config.yml and matrix definitions",
-                                default=cc_conda_build.get('matrix_base_dir'))
+                                help="path containing config.yml and matrix definitions")
     batch_parser.add_argument('--private', action='store_false',
                         help='hide build logs (overall graph still shown in Concourse web view)',
                         dest='public')
@@ -286,6 +369,20 @@ def parse_args(parse_this=None):
         '--no-skip-existing', help="Do not skip existing builds",
         dest="skip_existing", action="store_false"
     )
+    batch_parser.add_argument(
+        '--dedup-plan', action='store_true',
+        help=("write the parts of plan.yml which repeat, such as the images and scripts "
+              "of the tasks of each platform, once as YAML anchors, and print how much "
+              "smaller that makes the plan"))
+    batch_parser.add_argument(
+        '--stage-mode', choices=('copy', 'link', 'reflink'), default='copy',
+        help=("how the files of each recipe are put into the output folder of each of its "
+              "jobs: copied, hardlinked, or reflinked where the filesystem supports it.  "
+              "Files which can not be linked are copied"))
+    batch_parser.add_argument(
+        '--group-by-feedstock', action='store_true',
+        help=("besides the pipeline groups of jobs by worker label and dependency level, "
+              "add a group of the jobs of each recipe folder"))
     batch_parser.add_argument(
         '--use-repo-access',
         help="Pass the repo access credentials to the workers",
@@ -296,46 +393,61 @@ def parse_args(parse_this=None):
         help="Uploads built packages to staging channel",
         action="store_true",
     )
+    serve_parser = sp.add_parser('serve', help=("keep conda-build, the channel indexes and the "
+                                                "rendered recipes in memory to examine quickly"))
+    serve_parser.add_argument('--socket', default=serve.DEFAULT_SOCKET, dest='socket_path',
+                              help="unix socket to listen on, default is %(default)s")
+    serve_parser.add_argument('--index-ttl', default=300, type=int,
+                              help=("seconds for which a channel index is reused before it is "
+                                    "fetched again, default is 300"))
     rm_parser = sp.add_parser('rm', help='remove pipelines from server')
     rm_parser.add_argument('pipeline_names', nargs="+",
                            help=("Specify pipeline names on server to remove"))
+    rm_parser.add_argument('--parallel', default=8, type=int,
+                           help="number of server operations to run at once, default is 8")
     rm_parser.add_argument('--config-root-dir',
-                           help="path containing config.yml and matrix definitions",
-                           default=cc_conda_build.get('matrix_base_dir'))
+                           help="path containing config.yml and matrix definitions")
     rm_parser.add_argument('--do-it-dammit', '-y', help="YOLO", action="store_true")
     rm_parser.add_argument('--days', help='only remove specified packages older than n days', action='store')
+    rm_parser.add_argument('--activity-cache-ttl', default=900, type=int,
+                           help=("seconds for which cached pipeline activity times are trusted "
+                                 "when selecting pipelines with --days, default is 900"))
 
     pause_parser = sp.add_parser('pause', help='pause pipelines on the server')
     pause_parser.add_argument('pipeline_names', nargs="+",
                            help=("Specify pipeline names on server to pause"))
+    pause_parser.add_argument('--parallel', default=8, type=int,
+                           help="number of server operations to run at once, default is 8")
     pause_parser.add_argument('--config-root-dir',
-                           help="path containing config.yml and matrix definitions",
-                           default=cc_conda_build.get('matrix_base_dir'))
+                           help="path containing config.yml and matrix definitions")
     pause_parser.add_argument('--do-it-dammit', '-y', help="YOLO", action="store_true")
 
     unpause_parser = sp.add_parser('unpause', help='pause pipelines on the server')
     unpause_parser.add_argument('pipeline_names', nargs="+",
                            help=("Specify pipeline names on server to pause"))
+    unpause_parser.add_argument('--parallel', default=8, type=int,
+                           help="number of server operations to run at once, default is 8")
     unpause_parser.add_argument('--config-root-dir',
-                           help="path containing config.yml and matrix definitions",
-                           default=cc_conda_build.get('matrix_base_dir'))
+                           help="path containing config.yml and matrix definitions")
     unpause_parser.add_argument('--do-it-dammit', '-y', help="YOLO", action="store_true")
 
     trigger_parser = sp.add_parser('trigger', help='trigger (failed) jobs of a pipeline')
     trigger_parser.add_argument('pipeline_names', nargs='+',
                            help=("Specify pipeline names to trigger"))
+    trigger_parser.add_argument('--parallel', default=8, type=int,
+                           help="number of server operations to run at once, default is 8")
     trigger_parser.add_argument('--config-root-dir',
-                           help="path containing config.yml and matrix definitions",
-                           default=cc_conda_build.get('matrix_base_dir'))
+                           help="path containing config.yml and matrix definitions")
     trigger_parser.add_argument('--all', dest="trigger_all",
                            action="store_true", help="trigger all jobs")
 
     abort_parser = sp.add_parser('abort', help='abort jobs of a pipeline')
     abort_parser.add_argument('pipeline_names', nargs='+',
                            help=("Specify pipeline names to abort"))
+    abort_parser.add_argument('--parallel', default=8, type=int,
+                           help="number of server operations to run at once, default is 8")
     abort_parser.add_argument('--config-root-dir',
-                           help="path containing config.yml and matrix definitions",
-                           default=cc_conda_build.get('matrix_base_dir'))
+                           help="path containing config.yml and matrix definitions")
 
     return parser.parse_known_args(parse_this)
 
@@ -351,6 +463,38 @@ def main(args=None):
     else:
         logging.basicConfig(level=logging.INFO)
 
+    profile, profile_dir = args.__dict__.pop('profile'), args.__dict__.pop('profile_dir')
+    # the server would not be profiled
+    server_socket = args.__dict__.pop('server_socket', None)
+    if server_socket and not profile:
+        if serve.forward(args.subparser_name, dict(args.__dict__, pass_throughs=pass_throughs),
+                         server_socket):
+            return
+
+    if profile:
+        from conda_concourse_ci import profiling
+        profiler = profiling.enable(profile_dir)
+        try:
+            _run(args, pass_throughs)
+        finally:
+            profiling.disable()
+            profiler.write(profile)
+    else:
+        _run(args, pass_throughs)
+
+
+def _run(args, pass_throughs):
+    option = _condarc_matrix_base_dir_options.get(args.subparser_name)
+    if option and getattr(args, option) is None:
+        from conda_build.conda_interface import cc_conda_build
+        setattr(args, option, cc_conda_build.get('matrix_base_dir'))
+
+    # only load what the subcommand needs
+    if args.subparser_name in ('rm', 'pause', 'unpause', 'trigger', 'abort'):
+        from conda_concourse_ci import pipelines
+    else:
+        from conda_concourse_ci import execute
+
     if args.subparser_name == 'submit':
         args_dict = args.__dict__
         if not args_dict.get('config_root_dir'):
@@ -364,16 +508,18 @@ def main(args=None):
         execute.submit_one_off(pass_throughs=pass_throughs, **args.__dict__)
     elif args.subparser_name == 'batch':
         execute.submit_batch(pass_throughs=pass_throughs, **args.__dict__)
+    elif args.subparser_name == 'serve':
+        serve.serve(**args.__dict__)
     elif args.subparser_name == 'rm':
-        execute.rm_pipeline(pass_throughs=pass_throughs, **args.__dict__)
+        pipelines.rm_pipeline(pass_throughs=pass_throughs, **args.__dict__)
     elif args.subparser_name == 'pause':
-        execute.pause_pipeline(pass_throughs=pass_throughs, **args.__dict__)
+        pipelines.pause_pipeline(pass_throughs=pass_throughs, **args.__dict__)
     elif args.subparser_name == 'unpause':
-        execute.unpause_pipeline(pass_throughs=pass_throughs, **args.__dict__)
+        pipelines.unpause_pipeline(pass_throughs=pass_throughs, **args.__dict__)
     elif args.subparser_name == 'trigger':
-        execute.trigger_pipeline(pass_throughs=pass_throughs, **args.__dict__)
+        pipelines.trigger_pipeline(pass_throughs=pass_throughs, **args.__dict__)
     elif args.subparser_name == 'abort':
-        execute.abort_pipeline(pass_throughs=pass_throughs, **args.__dict__)
+        pipelines.abort_pipeline(pass_throughs=pass_throughs, **args.__dict__)
     else:
         # this is here so that if future subcommands are added, you don't forget to add a bit
         #     here to enable them.
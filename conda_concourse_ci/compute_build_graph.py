@@ -1,20 +1,33 @@
 #!/usr/bin/env python
 from __future__ import division, print_function
 
+import glob
+import hashlib
+import json
 import logging
 import os
+import pickle
 import re
 import subprocess
+import sys
+import weakref
+from collections import OrderedDict, namedtuple
 
-from conda_build import api, conda_interface
+from conda_build import __version__ as conda_build_version, api, conda_interface
 from conda_build.build import is_package_built
 from conda_build.metadata import MetaData, find_recipe
+from conda_build.utils import HashableDict
+
+import jinja2
 
 import networkx as nx
 
 import pkg_resources
 
-from .utils import HashableDict, ensure_list
+import yaml
+
+from . import profiling
+from .utils import ensure_list
 
 
 log = logging.getLogger(__file__)
@@ -22,7 +35,7 @@ CONDA_BUILD_CACHE = os.environ.get("CONDA_BUILD_CACHE")
 hash_length = api.Config().hash_length
 
 
-def package_key(metadata, worker_label, run='build'):
+def _build_vars(metadata):
     # get the build string from whatever conda-build makes of the configuration
 
     used_loop_vars = metadata.get_used_loop_vars()
@@ -33,7 +46,16 @@ def package_key(metadata, worker_label, run='build'):
     tp = metadata.config.variant.get('target_platform')
     if tp and tp != metadata.config.subdir:
         build_vars += '-target_' + tp
-    key = [metadata.name(), metadata.version()]
+    return build_vars
+
+
+def package_key(metadata, worker_label, run='build'):
+    if isinstance(metadata, NodeRecord):
+        key = [metadata.name, metadata.version]
+        build_vars = metadata.build_vars
+    else:
+        key = [metadata.name(), metadata.version()]
+        build_vars = _build_vars(metadata)
     if build_vars:
         key.append(build_vars)
     key.extend(['on', worker_label])
@@ -44,6 +66,105 @@ def package_key(metadata, worker_label, run='build'):
     return key
 
 
+class NodeRecord(object):
+    """ The parts of a rendered recipe that the jobs of its graph node are made from
+
+    A MetaData keeps its config, variants and the rendered recipe text.  Once the
+    graph is built, its nodes hold one of these instead, so that those can be freed.
+
+    Parameters
+    ----------
+    name, version : str
+        Name and version of the package.
+    build_vars : str
+        The variant part of the node's package_key.
+    subdir, host_subdir : str
+        The platforms the package is built on and for.
+    squished_variants : dict
+        The variant written to the node's conda_build_config.yaml.
+    meta_path : str
+        Path of the recipe's meta.yaml, empty for outputs of a recipe.
+    parent_recipe_path : str
+        Path of the recipe folder which the package is an output of.
+    channel_urls : tuple
+        Channels to build with.
+    worker_tags : list
+        The extra/worker_tags of the recipe.
+    output_paths : list, optional
+        Paths of the packages built, when they were extracted.
+
+    """
+    __slots__ = ('name', 'version', 'build_vars', 'subdir', 'host_subdir', 'squished_variants',
+                 'meta_path', 'parent_recipe_path', 'channel_urls', 'worker_tags',
+                 'output_paths')
+
+    def __init__(self, name, version, build_vars='', subdir=None, host_subdir=None,
+                 squished_variants=None, meta_path='', parent_recipe_path='',
+                 channel_urls=(), worker_tags=(), output_paths=None):
+        self.name = name
+        self.version = version
+        self.build_vars = build_vars
+        self.subdir = subdir
+        self.host_subdir = host_subdir
+        self.squished_variants = squished_variants or {}
+        self.meta_path = meta_path
+        self.parent_recipe_path = parent_recipe_path
+        self.channel_urls = tuple(channel_urls or ())
+        self.worker_tags = list(ensure_list(worker_tags))
+        self.output_paths = output_paths
+
+    @classmethod
+    def from_metadata(cls, metadata, output_paths=False):
+        """ Extract the record of a MetaData
+
+        Output paths are only extracted when asked for, because for a recipe which is
+        not finalized conda-build renders it again to find them.
+        """
+        extra = metadata.meta.get('extra') or {}
+        return cls(metadata.name(), metadata.version(),
+                   build_vars=_build_vars(metadata),
+                   subdir=metadata.config.subdir,
+                   host_subdir=metadata.config.host_subdir,
+                   squished_variants=metadata.config.squished_variants,
+                   meta_path=metadata.meta_path,
+                   parent_recipe_path=(extra.get('parent_recipe') or {}).get('path', ''),
+                   channel_urls=metadata.config.channel_urls,
+                   worker_tags=extra.get('worker_tags'),
+                   output_paths=(api.get_output_file_paths(metadata) if output_paths
+                                 else None))
+
+    @property
+    def recipe_dir(self):
+        if self.meta_path:
+            return os.path.dirname(self.meta_path)
+        return self.parent_recipe_path
+
+    def __repr__(self):
+        return 'NodeRecord({}-{})'.format(self.name, self.version)
+
+
+def node_record(metadata, output_paths=False):
+    """ Return the NodeRecord of the metadata of a graph node, extracting it if needed """
+    if not isinstance(metadata, NodeRecord):
+        return NodeRecord.from_metadata(metadata, output_paths=output_paths)
+    if output_paths and metadata.output_paths is None:
+        raise ValueError("The output paths of {} were not extracted".format(metadata.name))
+    return metadata
+
+
+def compact_graph(graph, output_paths=False):
+    """ Replace the MetaData of each node of graph with its NodeRecord
+
+    With output_paths, the records keep the paths of the packages built, which
+    get_upload_tasks needs.
+    """
+    for node in graph.nodes():
+        if 'meta' in graph.nodes[node]:
+            graph.nodes[node]['meta'] = node_record(graph.nodes[node]['meta'],
+                                                    output_paths=output_paths)
+
+
+@profiling.timed('git diff-tree')
 def _git_changed_files(git_rev, stop_rev=None, git_root=''):
     if not git_root:
         git_root = os.getcwd()
@@ -70,6 +191,7 @@ def _get_base_folders(base_dir, changed_files):
     return recipe_dirs
 
 
+@profiling.timed('git diff-script')
 def git_changed_submodules(git_rev='HEAD@{1}', stop_rev=None, git_root='.'):
     if stop_rev is not None:
         git_rev = "{0}..{1}".format(git_rev, stop_rev)
@@ -89,6 +211,7 @@ def git_changed_submodules(git_rev='HEAD@{1}', stop_rev=None, git_root='.'):
     return submodules_with_recipe_changes
 
 
+@profiling.timed('git new-submodule-script')
 def git_new_submodules(git_rev='HEAD@{1}', stop_rev=None, git_root='.'):
     if stop_rev is not None:
         git_rev = "{0}..{1}".format(git_rev, stop_rev)
@@ -102,6 +225,7 @@ def git_new_submodules(git_rev='HEAD@{1}', stop_rev=None, git_root='.'):
     return diff.splitlines()
 
 
+@profiling.timed('git rename-script')
 def git_renamed_folders(git_rev='HEAD@{1}', stop_rev=None, git_root='.'):
     if stop_rev is not None:
         git_rev = "{0}..{1}".format(git_rev, stop_rev)
@@ -133,11 +257,12 @@ def git_changed_recipes(git_rev='HEAD@{1}', stop_rev=None, git_root='.'):
              git_rev=SOME_REV@{2} and stop_rev=SOME_REV   => two commits, SOME_REV and the
                                                              one before it
     """
-    changed_files = _git_changed_files(git_rev, stop_rev, git_root)
-    recipe_dirs = _get_base_folders(git_root, changed_files)
-    changed_submodules = git_changed_submodules(git_rev, stop_rev, git_root)
-    new_submodules = git_new_submodules(git_rev, stop_rev, git_root)
-    renamed_folders = git_renamed_folders(git_rev, stop_rev, git_root)
+    with profiling.phase('git change detection'):
+        changed_files = _git_changed_files(git_rev, stop_rev, git_root)
+        recipe_dirs = _get_base_folders(git_root, changed_files)
+        changed_submodules = git_changed_submodules(git_rev, stop_rev, git_root)
+        new_submodules = git_new_submodules(git_rev, stop_rev, git_root)
+        renamed_folders = git_renamed_folders(git_rev, stop_rev, git_root)
     return recipe_dirs + changed_submodules + new_submodules + renamed_folders
 
 
@@ -171,22 +296,351 @@ def get_run_test_deps(meta):
     return _deps_to_version_dict(run_reqs + test_reqs)
 
 
-_rendered_recipes = {}
+class RenderCache(OrderedDict):
+    """ Rendered recipes by (recipe, label, platform, arch), least recently used first
 
+    Parameters
+    ----------
+    max_entries : int, optional
+        Number of renders to hold at most.  When more are added, the least recently
+        used ones are evicted.  Unlimited by default.
 
-@conda_interface.memoized
+    """
+
+    def __init__(self, max_entries=None):
+        super(RenderCache, self).__init__()
+        self.max_entries = max_entries
+
+    def __getitem__(self, key):
+        value = super(RenderCache, self).__getitem__(key)
+        self.move_to_end(key)
+        return value
+
+    def __setitem__(self, key, value):
+        super(RenderCache, self).__setitem__(key, value)
+        self.move_to_end(key)
+        while self.max_entries and len(self) > self.max_entries:
+            self.popitem(last=False)
+            profiling.count('render cache evictions')
+
+
+# the only copy of the rendered recipes of this process, C3I_RENDER_CACHE_SIZE bounds its size
+_rendered_recipes = RenderCache(int(os.environ.get('C3I_RENDER_CACHE_SIZE') or 0) or None)
+# modification stamp of each rendered recipe when it was rendered, see forget_stale_renders
+_render_stamps = {}
+# stamps are only worth taking in processes which render again, as c3i serve does
+track_recipe_changes = False
+# render_cache_key of the configuration that the renders of each worker label were made with
+_render_keys = {}
+
+
+def _recipe_stamp(meta_file_or_recipe_dir):
+    """ The newest modification time and the number of the files of a recipe
+
+    The recipe log written by c3i is left out.  The folders are too: their times
+    change when c3i writes or removes the recipe log.
+    """
+    stat = os.stat(meta_file_or_recipe_dir)
+    if not os.path.isdir(meta_file_or_recipe_dir):
+        return stat.st_mtime_ns, 1
+    newest, count = 0, 0
+    for root, dirs, files in os.walk(meta_file_or_recipe_dir):
+        for name in files:
+            if name != 'recipe_log.txt':
+                newest = max(newest, os.lstat(os.path.join(root, name)).st_mtime_ns)
+                count += 1
+    return newest, count
+
+
+def _clear_memoized(func):
+    func = getattr(func, '__wrapped__', func)
+    if hasattr(func, 'cache_clear'):
+        func.cache_clear()
+    else:
+        func.cache.clear()
+
+
+def forget_renders():
+    """ Drop all rendered recipes, and the results of dependency lookups """
+    _rendered_recipes.clear()
+    _render_stamps.clear()
+    _render_keys.clear()
+    _scans.clear()
+    _clear_memoized(_installable)
+
+
+def forget_stale_renders():
+    """ Drop the rendered recipes which changed on disk since they were rendered
+
+    Returns the recipes which were dropped.  This lets a long running process reuse
+    the renders of all other recipes.
+    """
+    stale = set()
+    for recipe, stamp in list(_render_stamps.items()):
+        try:
+            changed = _recipe_stamp(recipe) != stamp
+        except OSError:
+            changed = True
+        if changed:
+            stale.add(recipe)
+            del _render_stamps[recipe]
+    for key in [key for key in _rendered_recipes if key[0] in stale]:
+        del _rendered_recipes[key]
+    # scanning is cheap enough to do again
+    _scans.clear()
+    return stale
+
+
+def forget_renders_of_other_config(label, key):
+    """ Drop the rendered recipes of worker label unless they were made with key
+
+    key is the render_cache_key of the configuration about to be rendered with.
+    Returns whether any renders were dropped.
+    """
+    if _render_keys.get(label, key) == key:
+        _render_keys[label] = key
+        return False
+    _render_keys[label] = key
+    for render_key in [render_key for render_key in _rendered_recipes if render_key[1] == label]:
+        del _rendered_recipes[render_key]
+    return True
+
+
+# what a recipe produces and depends on, as far as can be told without rendering it:
+#    names of its outputs, names of the requirements of all of them, and whether all of
+#    those are known.  Jinja that cannot be evaluated without a full render leaves gaps.
+RecipeScan = namedtuple('RecipeScan', 'names requirements complete')
+_scans = {}
+
+
+class _ScanUndefined(jinja2.Undefined):
+    """ Undefined jinja values which render as nothing, whatever is done with them """
+
+    def __call__(self, *args, **kwargs):
+        return self
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self
+
+    def __getitem__(self, key):
+        return self
+
+
+_scan_environment = jinja2.Environment(undefined=_ScanUndefined)
+_scan_environment.globals.update(
+    # these name the package they pin as their first word
+    pin_subpackage=lambda name, *args, **kwargs: name,
+    pin_compatible=lambda name, *args, **kwargs: name,
+)
+
+
+def _requirement_names(requirements):
+    """ Names of a list of requirements, with None for those that are not known """
+    if isinstance(requirements, dict):
+        requirements = [req for section in requirements.values() for req in (section or [])]
+    names = set()
+    for requirement in requirements or []:
+        words = requirement.split() if isinstance(requirement, str) else []
+        names.add(words[0].lower() if words else None)
+    return names
+
+
+def scan_recipe(recipe_dir):
+    """ Read the names of the outputs and requirements of a recipe, without rendering it
+
+    Much cheaper than api.render: jinja is evaluated with anything it cannot know, like
+    compilers or setup.py data, left empty, and all selectors count as true.  So the
+    requirements are a superset of the real ones, unless the scan is not complete.
+    """
+    if recipe_dir in _scans:
+        return _scans[recipe_dir]
+    with profiling.timer('recipe scans'):
+        try:
+            with open(find_recipe(recipe_dir)) as f:
+                meta = yaml.safe_load(_scan_environment.from_string(f.read()).render()) or {}
+            names = {(meta.get('package') or {}).get('name')}
+            requirements = _requirement_names(meta.get('requirements'))
+            requirements |= _requirement_names((meta.get('test') or {}).get('requires'))
+            for output in meta.get('outputs') or []:
+                names.add(output.get('name'))
+                requirements |= _requirement_names(output.get('requirements'))
+                requirements |= _requirement_names((output.get('test') or {}).get('requires'))
+        except (IOError, jinja2.TemplateError, yaml.YAMLError, AttributeError, TypeError) as e:
+            log.debug("Unable to scan %s, it will be rendered.  Error was: %s", recipe_dir, e)
+            scan = RecipeScan(set(), set(), False)
+        else:
+            names = {str(name).lower() if name else None for name in names}
+            scan = RecipeScan(names - {None}, requirements - {None},
+                              None not in names and None not in requirements)
+    _scans[recipe_dir] = scan
+    return scan
+
+
+def _json_default(value):
+    # sets are sorted, their order would change with the hash seed of each process
+    if isinstance(value, (set, frozenset)):
+        return sorted(value, key=str)
+    return str(value)
+
+
+def render_cache_key(recipes_dir, worker, config):
+    """ Digest of everything besides the recipes themselves which changes how they render
+
+    That includes the variants, so changes to any conda_build_config.yaml or variant
+    file outside of the recipe folders invalidate all stored renders.  Rendered recipes
+    hold absolute paths, so they are only reused for the same recipes_dir.
+    """
+    parts = [os.path.abspath(recipes_dir), conda_build_version, sys.version_info[:2], worker,
+             config.variants, config.channel_urls]
+    for config_file in ([config.clobber_sections_file, config.append_sections_file] +
+                        list(config.variant_config_files or [])):
+        if config_file and os.path.isfile(config_file):
+            with open(config_file) as f:
+                parts.append(f.read())
+    digest = hashlib.sha1(json.dumps(parts, sort_keys=True, default=_json_default).encode())
+    return digest.hexdigest()[:16]
+
+
+def _git_changed_folders(since_rev, git_root):
+    """ Top level folders with changes since since_rev, including uncommitted and new files """
+    with profiling.timer('git diff'):
+        changed = subprocess.check_output(['git', 'diff', '--relative', '--name-only',
+                                           '--ignore-submodules=untracked', since_rev],
+                                          cwd=git_root, stderr=subprocess.DEVNULL)
+        changed += subprocess.check_output(['git', 'ls-files', '--others', '--exclude-standard'],
+                                           cwd=git_root)
+    # c3i writes the recipe logs itself
+    return {path.split('/')[0] for path in changed.decode().splitlines()
+            if os.path.basename(path) != 'recipe_log.txt'}
+
+
+def _recipe_folder(render_key, recipes_dir):
+    return os.path.relpath(render_key[0], recipes_dir).split(os.sep)[0]
+
+
+def load_renders(cache_dir, recipes_dir, key, label):
+    """ Reuse the renders stored by save_renders for the recipes which did not change since
+
+    The renders of the last commit stored with the same key are loaded, and those of
+    the recipe folders which changed in git since that commit are dropped.  Returns the
+    number of renders reused.
+    """
+    recipes_dir = os.path.abspath(recipes_dir)
+    stored_files = glob.glob(os.path.join(cache_dir, 'renders-{}-*.pickle'.format(key)))
+    if not stored_files:
+        return 0
+    stored_file = max(stored_files, key=os.path.getmtime)
+    try:
+        with open(stored_file, 'rb') as f:
+            stored = pickle.load(f)
+        changed = _git_changed_folders(stored['commit'], recipes_dir)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError,
+            subprocess.CalledProcessError) as e:
+        log.warn("Unable to reuse the renders in %s, rendering everything.  Error was: %s",
+                 stored_file, e)
+        return 0
+    reused = 0
+    for render_key, rendered in stored['renders'].items():
+        if (render_key[1] != label or render_key in _rendered_recipes or
+                _recipe_folder(render_key, recipes_dir) in changed):
+            continue
+        if not track_recipe_changes:
+            if not os.path.exists(render_key[0]):
+                continue
+        else:
+            try:
+                _render_stamps[render_key[0]] = _recipe_stamp(render_key[0])
+            except OSError:
+                continue
+        _rendered_recipes[render_key] = rendered
+        reused += 1
+    print("reusing {} renders of commit {}".format(reused, stored['commit'][:8]))
+    return reused
+
+
+def save_renders(cache_dir, recipes_dir, key, label, keep=3):
+    """ Store the renders of recipes_dir for label, for load_renders of later commits
+
+    Only the `keep` most recently stored commits are kept for each key.
+    """
+    recipes_dir = os.path.abspath(recipes_dir)
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=recipes_dir,
+                                         stderr=subprocess.DEVNULL).decode().strip()
+    except subprocess.CalledProcessError:
+        log.warn("%s is not a git repository, not storing its renders", recipes_dir)
+        return
+    renders = {render_key: rendered for render_key, rendered in _rendered_recipes.items()
+               if render_key[1] == label and
+               not _recipe_folder(render_key, recipes_dir).startswith('..')}
+    os.makedirs(cache_dir, exist_ok=True)
+    path = os.path.join(cache_dir, 'renders-{}-{}.pickle'.format(key, commit))
+    try:
+        with open(path + '.tmp', 'wb') as f:
+            pickle.dump({'commit': commit, 'renders': renders}, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(path + '.tmp', path)
+    except (OSError, pickle.PicklingError, TypeError, AttributeError) as e:
+        log.warn("Unable to store the renders in %s.  Error was: %s", path, e)
+        if os.path.exists(path + '.tmp'):
+            os.remove(path + '.tmp')
+        return
+    stored_files = sorted(glob.glob(os.path.join(cache_dir, 'renders-{}-*.pickle'.format(key))),
+                          key=os.path.getmtime)
+    for old_file in stored_files[:-keep]:
+        os.remove(old_file)
+
+
+@profiling.counted('render cache lookups')
 def _get_or_render_metadata(meta_file_or_recipe_dir, worker, finalize, config=None):
-    global _rendered_recipes
-    label = worker['label']
     platform = worker['platform']
     arch = str(worker['arch'])
-    if (meta_file_or_recipe_dir, label, platform, arch) not in _rendered_recipes:
+    key = (meta_file_or_recipe_dir, worker['label'], platform, arch)
+    if key not in _rendered_recipes:
         print("rendering {0} for {1}".format(meta_file_or_recipe_dir, worker['label']))
-        _rendered_recipes[(meta_file_or_recipe_dir, label, platform, arch)] = \
-                            api.render(meta_file_or_recipe_dir, platform=platform, arch=arch,
-                                       verbose=False, permit_undefined_jinja=True,
-                                       bypass_env_check=True, config=config, finalize=finalize)
-    return _rendered_recipes[(meta_file_or_recipe_dir, label, platform, arch)]
+        profiling.count('render cache misses')
+        if track_recipe_changes:
+            _render_stamps[meta_file_or_recipe_dir] = _recipe_stamp(meta_file_or_recipe_dir)
+        _rendered_recipes[key] = api.render(meta_file_or_recipe_dir, platform=platform,
+                                            arch=arch, verbose=False,
+                                            permit_undefined_jinja=True, bypass_env_check=True,
+                                            config=config, finalize=finalize)
+    return _rendered_recipes[key]
+
+
+# subdirs, and (subdir, name, version, build) of the packages, in the index of each Resolve
+_index_packages = weakref.WeakKeyDictionary()
+
+
+def _packages_in_index(conda_resolve):
+    """ The subdirs and packages in the index of conda_resolve, leaving out the local channel """
+    cached = _index_packages.get(conda_resolve)
+    if cached is None:
+        with profiling.timer('index package set'):
+            packages = {(record.subdir, record.name, record.version, record.build)
+                        for record in conda_resolve.index.values()
+                        if record.channel.canonical_name != 'local'}
+        cached = _index_packages[conda_resolve] = ({package[0] for package in packages},
+                                                   packages)
+    return cached
+
+
+def _is_package_built(metadata, conda_resolve):
+    """ is_package_built(metadata, 'host', include_local=False), using the fetched index
+
+    The index of conda_resolve was fetched from the same channels, so that looking the
+    package up in it saves fetching the index again for every output.  Packages for a
+    subdir which is not in that index, as when cross-compiling, are looked up by
+    conda-build.
+    """
+    subdirs, packages = _packages_in_index(conda_resolve)
+    subdir = metadata.config.host_subdir
+    if subdir not in subdirs:
+        return is_package_built(metadata, 'host', include_local=False)
+    profiling.count('skip existing lookups')
+    key = (metadata.name(), metadata.version(), metadata.build_id())
+    return (subdir,) + key in packages or ('noarch',) + key in packages
 
 
 def add_recipe_to_graph(recipe_dir, graph, run, worker, conda_resolve,
@@ -200,8 +654,8 @@ def add_recipe_to_graph(recipe_dir, graph, run, worker, conda_resolve,
 
     name = None
     for (metadata, _, _) in rendered:
-        if (is_package_built(metadata, 'host', include_local=False) and config.skip_existing or
-                metadata.skip()):
+        if (config is not None and config.skip_existing and
+                _is_package_built(metadata, conda_resolve) or metadata.skip()):
             continue
 
         name = package_key(metadata, worker['label'], run)
@@ -228,6 +682,7 @@ def add_recipe_to_graph(recipe_dir, graph, run, worker, conda_resolve,
     return name
 
 
+@profiling.counted('match_peer_job calls')
 def match_peer_job(target_matchspec, other_m, this_m=None):
     """target_matchspec comes from the recipe.  target_variant is the variant from the recipe whose
     deps we are matching.  m is the peer job, which must satisfy conda and also have matching keys
@@ -383,7 +838,8 @@ def _write_recipe_log(path):
     if not os.path.exists(os.path.join(path, "meta.yaml")):
         path = os.path.join(path, "recipe")
     try:
-        output = subprocess.check_output(['git', 'log'], cwd=path)
+        with profiling.timer('git log'):
+            output = subprocess.check_output(['git', 'log'], cwd=path)
         with open(os.path.join(path, "recipe_log.txt"), "wb") as f:
             f.write(output)
     except subprocess.CalledProcessError as e:
@@ -430,16 +886,19 @@ def construct_graph(recipes_dir, worker, run, conda_resolve, folders=(),
 
         if not os.path.isdir(recipe_dir):
             raise ValueError("Specified folder {} does not exist".format(recipe_dir))
-        add_recipe_to_graph(recipe_dir, graph, run, worker, conda_resolve,
-                            recipes_dir, config=config, finalize=finalize)
+        with profiling.phase('render'):
+            add_recipe_to_graph(recipe_dir, graph, run, worker, conda_resolve,
+                                recipes_dir, config=config, finalize=finalize)
         count += 1
         print(f'rendered {count} out of {folders_len} folders')
     print('rendered all folders')
     print('adding intradependencies')
-    add_intradependencies(graph)
+    with profiling.phase('intradependencies'):
+        add_intradependencies(graph)
     print('successfully added intradependencies!')
     print('collapsing subpackage nodes')
-    collapse_subpackage_nodes(graph)
+    with profiling.phase('subpackage collapse'):
+        collapse_subpackage_nodes(graph)
     print('successfully collapsed subpackage nodes!')
     return graph
 
@@ -449,12 +908,14 @@ def _fix_any(value, config):
     return value
 
 
+@profiling.counted('installable lookups')
 @conda_interface.memoized
 def _installable(name, version, build_string, config, conda_resolve):
     """Can Conda install the package we need?"""
     ms = conda_interface.MatchSpec(" ".join([name, _fix_any(version, config),
                                              _fix_any(build_string, config)]))
-    installable = conda_resolve.find_matches(ms)
+    with profiling.timer('resolve queries'):
+        installable = conda_resolve.find_matches(ms)
     if not installable:
         log.warn("Dependency {name}, version {ver} is not installable from your "
                  "channels: {channels} with subdir {subdir}.  Seeing if we can build it..."
@@ -463,13 +924,21 @@ def _installable(name, version, build_string, config, conda_resolve):
     return installable
 
 
+def _may_produce(recipe_dir, name):
+    """ False if scanning the recipe shows that it does not produce package name """
+    scan = scan_recipe(recipe_dir)
+    return not scan.complete or name.lower() in scan.names
+
+
+@profiling.timed('buildable scans')
 def _buildable(name, version, recipes_dir, worker, config, finalize):
     """Does the recipe that we have available produce the package we need?"""
     possible_dirs = os.listdir(recipes_dir)
     packagename_re = re.compile(r'%s(?:\-[0-9]+[\.0-9\_\-a-zA-Z]*)?$' % name)
     likely_dirs = (dirname for dirname in possible_dirs if
                     (os.path.isdir(os.path.join(recipes_dir, dirname)) and
-                    packagename_re.match(dirname)))
+                    packagename_re.match(dirname) and
+                    _may_produce(os.path.join(recipes_dir, dirname), name)))
     metadata_tuples = [m for path in likely_dirs
                         for (m, _, _) in _get_or_render_metadata(os.path.join(recipes_dir,
                                                                  path), worker, finalize=finalize)]
@@ -522,6 +991,35 @@ def expand_run_upstream(graph, conda_resolve, worker, run, steps=0, max_downstre
     pass
 
 
+def _dependent_folders(graph, recipes_dir, recipe_dirs, steps, conda_resolve):
+    """ The recipe_dirs which may depend on the nodes of graph, up to steps levels down
+
+    The folders of the nodes themselves are included.  Recipes are scanned rather than
+    rendered to find this, and those which cannot be fully scanned are always included.
+    Requirements of the dependents which the channels cannot install will be built too,
+    so their dependents are followed as well.
+    """
+    recipes_dir = os.path.abspath(recipes_dir)
+    folders = {os.path.relpath(os.path.dirname(graph.nodes[node]['meta'].meta_path),
+                               recipes_dir).split(os.sep)[0] for node in graph.nodes()}
+    names = {graph.nodes[node]['meta'].name().lower() for node in graph.nodes()}
+    scans = {folder: scan_recipe(os.path.join(recipes_dir, folder)) for folder in recipe_dirs}
+    produced = {name for scan in scans.values() for name in scan.names}
+    step = 0
+    while steps < 0 or step < steps:
+        found = {folder for folder, scan in scans.items() if folder not in folders and
+                 (not scan.complete or scan.requirements & names)}
+        if not found:
+            break
+        folders.update(found)
+        for folder in found:
+            names.update(scans[folder].names)
+            names.update(name for name in scans[folder].requirements & produced - names
+                         if not conda_resolve.find_matches(conda_interface.MatchSpec(name)))
+        step += 1
+    return [folder for folder in recipe_dirs if folder in folders]
+
+
 def expand_run(graph, config, conda_resolve, worker, run, steps=0, max_downstream=5,
                recipes_dir=None, matrix_base_dir=None, finalize=False):
     """Apply the build label to any nodes that need (re)building or testing.
@@ -576,6 +1074,8 @@ def expand_run(graph, config, conda_resolve, worker, run, steps=0, max_downstrea
                 recipe_dirs.append(recipe_dir)
             except IOError:
                 pass
+        # only the recipes which may depend on our nodes within the steps need rendering
+        recipe_dirs = _dependent_folders(graph, recipes_dir, recipe_dirs, steps, conda_resolve)
 
         # constructing the graph for build will automatically also include the test deps
         full_graph = construct_graph(recipes_dir, worker, 'build', folders=recipe_dirs,
@@ -610,6 +1110,29 @@ def order_build(graph):
     return order
 
 
+def shard_graph(graph, max_jobs):
+    '''
+    Split graph into shards of at most max_jobs nodes which share no edges.
+
+    The weakly connected components of graph are packed into shards, largest first,
+    each into the first shard with room left for it.  Components are never split, so a
+    component larger than max_jobs is a shard of its own.  Returns a list of node
+    lists, in the same order for the same graph.
+    '''
+    components = sorted((sorted(component) for component in
+                         nx.weakly_connected_components(graph)),
+                        key=lambda component: (-len(component), component[0]))
+    shards = []
+    for component in components:
+        for shard in shards:
+            if len(shard) + len(component) <= max_jobs:
+                shard.extend(component)
+                break
+        else:
+            shards.append(list(component))
+    return shards
+
+
 def reorder_cyclical_test_dependencies(graph):
     """By default, we make things that depend on earlier outputs for build wait for tests of
     the earlier thing to pass.  However, circular dependencies spread across run/test and
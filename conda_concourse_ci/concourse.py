@@ -1,7 +1,18 @@
 import json
 import logging
+import os
 import subprocess
+import threading
+import time
 from contextlib import AbstractContextManager
+from urllib.parse import quote
+
+import requests
+
+from . import profiling
+
+# (url, target) pairs for which the fly version has been checked by this process
+_synced_targets = set()
 
 
 class Concourse(AbstractContextManager):
@@ -57,7 +68,8 @@ class Concourse(AbstractContextManager):
         """ Run a fly command with the stored target """
         args = ['fly', '-t', self.target] + fly_args
         logging.debug('command: ' + ' '.join(args))
-        complete = subprocess.run(args, capture_output=True)
+        with profiling.timer('fly ' + fly_args[0]):
+            complete = subprocess.run(args, capture_output=True)
         logging.debug('returncode: ' + str(complete.returncode))
         logging.debug('stdout: ' + complete.stdout.decode('utf-8'))
         logging.debug('stderr: ' + complete.stderr.decode('utf-8'))
@@ -86,6 +98,58 @@ class Concourse(AbstractContextManager):
     def sync(self):
         self._fly(['sync'])
 
+    def fly_logged_in(self):
+        """ True if fly holds a valid token for the target """
+        return self._fly(['status'], check=False).returncode == 0
+
+    def ensure_login(self):
+        """ Log in, unless a valid token is already held """
+        if not self.fly_logged_in():
+            self.login()
+
+    def fly_version(self):
+        return self._fly(['--version']).stdout.decode('utf-8').strip()
+
+    def server_version(self):
+        """ The version of the Concourse server, None if it can not be determined """
+        url = self.concourse_url.rstrip('/') + '/api/v1/info'
+        try:
+            return requests.get(url, timeout=30).json()['version']
+        except (requests.exceptions.RequestException, ValueError, KeyError):
+            return None
+
+    def sync_if_needed(self, cache_path=None, cache_ttl=3600):
+        """
+        Sync fly with the server, but only if their versions differ.
+
+        The check is done once per target and process.  When a cache_path is given,
+        the server version is stored there and not requested again for cache_ttl seconds.
+        """
+        if (self.concourse_url, self.target) in _synced_targets:
+            return
+        cache = {}
+        if cache_path:
+            try:
+                with open(cache_path) as f:
+                    cache = json.load(f)
+            except (OSError, IOError, ValueError):
+                cache = {}
+        entry = cache.get(self.concourse_url, {})
+        server_version = None
+        if time.time() - entry.get('checked', 0) < cache_ttl:
+            server_version = entry.get('server')
+        if server_version is None:
+            server_version = self.server_version()
+            if server_version is not None and cache_path:
+                cache[self.concourse_url] = {'checked': time.time(), 'server': server_version}
+                tmp = cache_path + '.tmp'
+                with open(tmp, 'w') as f:
+                    json.dump(cache, f)
+                os.replace(tmp, cache_path)
+        if server_version is None or server_version != self.fly_version():
+            self._fly(['sync'])
+        _synced_targets.add((self.concourse_url, self.target))
+
     def set_pipeline(self, pipeline, config_file, vars_path):
         self._fly([
             "set-pipeline",
@@ -125,8 +189,12 @@ class Concourse(AbstractContextManager):
     def get_jobs(self, pipeline):
         return self._flyj(['jobs', '-p', pipeline])
 
-    def get_builds(self, pipeline):
-        return self._flyj(['builds', '--pipeline', pipeline])
+    def get_builds(self, pipeline, limit=None):
+        """ Return the builds of a pipeline, newest first """
+        fly_args = ['builds', '--pipeline', pipeline]
+        if limit:
+            fly_args.extend(['--count', str(limit)])
+        return self._flyj(fly_args)
 
     def status_of_jobs(self, pipeline):
         statuses = {}
@@ -150,3 +218,298 @@ class Concourse(AbstractContextManager):
             '--job', f'{pipeline}/{job}',
             '--build', name
         ])
+
+
+class ConcourseAPI(Concourse):
+    """
+    A class for interacting with a Concourse CI instance through its REST API
+
+    Requests are made through a pooled ``requests.Session`` which holds the
+    bearer token obtained at login, so bulk operations do not pay for a fly
+    process, a TLS handshake and a login per call.  The interface is the same
+    as that of :class:`Concourse`.
+
+    Setting a pipeline requires fly, as the pipeline configuration and its
+    variables are interpolated client side.  fly is logged in and synced the
+    first time a pipeline is set.
+
+    Parameters
+    ----------
+    concourse_url : str
+        The URL of the Concourse CI server
+    username : str, optional
+        Concourse username.
+    password : str, optional
+        Password for user.
+    team_name : str, optional
+        Team to autheticate with, defaults to main.
+    target : str, optional
+        Concourse target name, used for fly.
+    timeout : float, optional
+        Timeout in seconds for each HTTP request.
+    max_connections : int, optional
+        Size of the connection pool, the number of requests which can be made
+        concurrently without opening new connections.
+
+    """
+
+    # the client credentials which fly itself uses with the concourse auth server
+    client_id = 'fly'
+    client_secret = 'Zmx5'
+
+    def __init__(
+            self,
+            concourse_url,
+            username=None,
+            password=None,
+            team_name=None,
+            target='conda-concourse-server',
+            timeout=30,
+            max_connections=16,
+            ):
+        super().__init__(concourse_url, username, password, team_name, target)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=max_connections, pool_maxsize=max_connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._token = None
+        self._token_expires = 0
+        self._fly_ready = False
+        self._sync_args = (None, 3600)
+        self._login_lock = threading.Lock()
+
+    @property
+    def team(self):
+        return self.team_name or 'main'
+
+    def _url(self, *parts):
+        path = '/'.join(quote(str(part), safe='') for part in parts)
+        return self.concourse_url.rstrip('/') + '/api/v1/' + path
+
+    def _team_url(self, *parts):
+        return self._url('teams', self.team, *parts)
+
+    def _request(self, method, url, **kwargs):
+        """ Make an authenticated request, logging in again if the token was rejected """
+        token = self._token
+        if not self.logged_in:
+            self._renew_login(token)
+            token = self._token
+        logging.debug('request: %s %s', method, url)
+        response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        if response.status_code == 401:
+            self._renew_login(token)
+            response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        logging.debug('status: %s', response.status_code)
+        response.raise_for_status()
+        return response
+
+    def _get_json(self, url, **params):
+        return self._request('GET', url, params=params or None).json()
+
+    @property
+    def logged_in(self):
+        """ True when a token is held which has not yet expired """
+        return self._token is not None and time.time() < self._token_expires
+
+    def login(self):
+        with self._login_lock:
+            self._login()
+
+    def _renew_login(self, token):
+        """ Log in again in place of token, unless another thread already did """
+        with self._login_lock:
+            if self._token == token:
+                self._login()
+
+    def _login(self):
+        response = self.session.post(
+            self.concourse_url.rstrip('/') + '/sky/issuer/token',
+            auth=(self.client_id, self.client_secret),
+            data={
+                'grant_type': 'password',
+                'username': self.username or '',
+                'password': self.password or '',
+                'scope': 'openid profile email federated:id groups',
+            },
+            timeout=self.timeout,
+        )
+        response.raise_for_status()
+        token = response.json()
+        # concourse 7 authenticates with the id token, earlier versions the access token
+        self._token = token.get('id_token') or token['access_token']
+        # renew a minute early rather than have a request rejected
+        self._token_expires = time.time() + int(token.get('expires_in', 3600)) - 60
+        self.session.headers['Authorization'] = 'Bearer ' + self._token
+
+    def logout(self):
+        self._token = None
+        self.session.headers.pop('Authorization', None)
+        if self._fly_ready:
+            super().logout()
+            self._fly_ready = False
+
+    def ensure_login(self):
+        if not self.logged_in:
+            self.login()
+
+    def sync(self):
+        """ fly is only synced when it is needed, see set_pipeline """
+        pass
+
+    def sync_if_needed(self, cache_path=None, cache_ttl=3600):
+        """ Remember the cache settings for when fly is first needed, see set_pipeline """
+        self._sync_args = (cache_path, cache_ttl)
+
+    def set_pipeline(self, pipeline, config_file, vars_path):
+        if not self._fly_ready:
+            if not self.fly_logged_in():
+                super().login()
+            if (self.concourse_url, self.target) not in _synced_targets:
+                super().sync_if_needed(*self._sync_args)
+            self._fly_ready = True
+        super().set_pipeline(pipeline, config_file, vars_path)
+
+    def expose_pipeline(self, pipeline):
+        self._request('PUT', self._team_url('pipelines', pipeline, 'expose'))
+
+    def destroy_pipeline(self, pipeline):
+        self._request('DELETE', self._team_url('pipelines', pipeline))
+
+    def pause_pipeline(self, pipeline):
+        self._request('PUT', self._team_url('pipelines', pipeline, 'pause'))
+
+    def unpause_pipeline(self, pipeline):
+        self._request('PUT', self._team_url('pipelines', pipeline, 'unpause'))
+
+    @property
+    def pipelines(self):
+        """ A list of pipelines names """
+        return [i['name'] for i in self._get_json(self._team_url('pipelines'))]
+
+    def get_jobs(self, pipeline):
+        return self._get_json(self._team_url('pipelines', pipeline, 'jobs'))
+
+    def get_builds(self, pipeline, limit=None):
+        """ Return the builds of a pipeline, newest first """
+        params = {'limit': limit} if limit else {}
+        return self._get_json(self._team_url('pipelines', pipeline, 'builds'), **params)
+
+    def trigger_job(self, pipeline, job):
+        self._request('POST', self._team_url('pipelines', pipeline, 'jobs', job, 'builds'))
+
+    def abort_build(self, pipeline, job, name):
+        build = self._get_json(self._team_url('pipelines', pipeline, 'jobs', job, 'builds', name))
+        self._request('PUT', self._url('builds', build['id'], 'abort'))
+
+
+class ActiveBuildTracker(object):
+    """
+    Follows the builds in flight on a Concourse CI instance
+
+    The first poll looks at the newest `lookback` builds.  Later polls only
+    request builds newer than the oldest build still in flight (or the newest
+    build seen when nothing is), so the builds in flight are kept current
+    without downloading the whole recent build list every time.  Requests go
+    through a single keep-alive ``requests.Session``.
+
+    Parameters
+    ----------
+    concourse_url : str
+        The URL of the Concourse CI server
+    lookback : int, optional
+        Number of builds to look at on the first poll.
+    timeout : float, optional
+        Timeout in seconds for each HTTP request.
+    min_interval : float, optional
+        Shortest time suggested between polls by :meth:`next_interval`.
+    page_size : int, optional
+        Number of builds requested at a time by later polls.
+
+    """
+
+    in_flight_statuses = ('pending', 'started')
+
+    def __init__(self, concourse_url, lookback=500, timeout=30, min_interval=10,
+                 page_size=100):
+        self.url = requests.compat.urljoin(concourse_url, 'api/v1/builds')
+        self.lookback = lookback
+        self.timeout = timeout
+        self.min_interval = min_interval
+        self.page_size = page_size
+        self.session = requests.Session()
+        # build id -> build, for the builds pending or started at the last poll
+        self.in_flight = {}
+        self._since = None
+        self._last_poll = None
+        # builds finishing per second, averaged over recent polls
+        self.finish_rate = 0.0
+
+    def _get(self, **params):
+        r = self.session.get(self.url, params=params, timeout=self.timeout)
+        r.raise_for_status()
+        return r.json()
+
+    def _get_since(self, since):
+        """ Return the builds with an id greater than since
+
+        Concourse pages builds newest first.  A page requested ``from`` an id holds the
+        oldest builds with that id or greater, so the pages are walked upwards from since.
+        A server which ignores ``from`` returns the same page again, which then brings
+        no newer builds and ends the walk.
+        """
+        builds = []
+        while True:
+            page = self._get(**{'from': since + 1, 'limit': self.page_size})
+            newer = [build for build in page if build['id'] > since]
+            builds.extend(newer)
+            if len(page) < self.page_size or not newer:
+                return builds
+            since = max(build['id'] for build in newer)
+
+    def poll(self):
+        """ Update and return the list of builds which are started """
+        if self._since is None:
+            builds = self._get(limit=self.lookback)
+        else:
+            builds = self._get_since(self._since)
+        seen = {build['id'] for build in builds}
+        # builds which are not in flight anymore, or which disappeared with their pipeline
+        finished = [build_id for build_id in self.in_flight if build_id not in seen]
+        for build in builds:
+            if build['status'] in self.in_flight_statuses:
+                self.in_flight[build['id']] = build
+            elif self.in_flight.pop(build['id'], None) is not None:
+                finished.append(build['id'])
+        for build_id in finished:
+            self.in_flight.pop(build_id, None)
+
+        newest = max(seen, default=self._since or 0)
+        self._since = min(self.in_flight) - 1 if self.in_flight else newest
+
+        now = time.time()
+        if self._last_poll is not None and now > self._last_poll:
+            rate = len(finished) / (now - self._last_poll)
+            self.finish_rate = 0.5 * self.finish_rate + 0.5 * rate
+        self._last_poll = now
+        return [build for build in self.in_flight.values() if build['status'] == 'started']
+
+    def next_interval(self, max_interval):
+        """ Seconds to wait before polling again for a build to finish
+
+        This is the expected time for the next build to finish at the recent rate,
+        between `min_interval` and `max_interval`.
+        """
+        if self.finish_rate <= 0:
+            return max_interval
+        return max(min(self.min_interval, max_interval),
+                   min(1.0 / self.finish_rate, max_interval))
+
+
+# backends which can be selected with the concourse-backend key of config.yml
+BACKENDS = {
+    'fly': Concourse,
+    'api': ConcourseAPI,
+}
@@ -4,7 +4,18 @@ Classes for representing Concourse pipeline configuration items
 These map to the schema's in https://concourse-ci.org/docs.html
 """
 
+import io
 import os
+import re
+
+import yaml
+from yaml.events import (DocumentEndEvent, DocumentStartEvent, SequenceEndEvent,
+                         SequenceStartEvent, StreamEndEvent, StreamStartEvent)
+
+try:
+    from yaml import CDumper as _FastDumper
+except ImportError:
+    _FastDumper = yaml.Dumper
 
 
 CONDA_SUBDIR_TO_CONCOURSE_PLATFORM = {
@@ -20,11 +31,14 @@ CONDA_SUBDIR_TO_CONCOURSE_PLATFORM = {
 class PipelineConfig:
     """ configuration for a concourse pipeline. """
     # https://concourse-ci.org/pipelines.html
-    jobs = []
-    resources = []
-    resource_types = []
-    var_sources = []
-    groups = []
+
+    def __init__(self):
+        # per-instance lists; class level lists would be shared between pipelines
+        self.jobs = []
+        self.resources = []
+        self.resource_types = []
+        self.var_sources = []
+        self.groups = []
 
     def add_job(self, name, plan=None, **kwargs):
         if plan is None:
@@ -40,6 +54,9 @@ class PipelineConfig:
         rtype = {'name': name, 'type': type_, "source": source, **kwargs}
         self.resource_types.append(rtype)
 
+    def add_group(self, name, jobs):
+        self.groups.append({'name': name, 'jobs': list(jobs)})
+
     def to_dict(self):
         out = {}
         attrs = ['jobs', 'resources', 'resource_types', 'var_sources', 'groups']
@@ -50,6 +67,46 @@ class PipelineConfig:
             out[attr] = [v if isinstance(v, dict) else v.to_dict() for v in items]
         return out
 
+    def _sections(self):
+        """ Yield the non-empty lists of to_dict by name, in the order yaml.dump writes them """
+        for attr in sorted(['jobs', 'resources', 'resource_types', 'var_sources', 'groups']):
+            items = getattr(self, attr)
+            if len(items):
+                yield attr, items
+
+    def dump(self, stream):
+        """ Write the pipeline as YAML to stream
+
+        The output is the same as that of ``yaml.dump(self.to_dict(), stream,
+        default_flow_style=False)``, but the jobs and resources are represented and
+        written one at a time, rather than building a YAML node for every value of the
+        pipeline first.  Items are written by libyaml, when it is available, unless they
+        hold strings which it would write differently from yaml.dump.
+        """
+        sections = list(self._sections())
+        if sections and _item_writer_works():
+            try:
+                _write_sections(stream, sections)
+                return
+            except _Unsupported:
+                pass
+        yaml.dump(self.to_dict(), stream, default_flow_style=False)
+
+    def share_identical(self, min_length=40):
+        """ Make the identical parts of the pipeline one object, so that dump writes them once
+
+        yaml gives a part which appears more than once an anchor where it is first
+        written, and refers to it with an alias everywhere else.  Only parts whose keys
+        and values add up to at least min_length characters are shared, aliasing smaller
+        ones saves little.  Returns the number of parts replaced by an identical one.
+        """
+        canonical, seen = {}, {}
+        shared = 0
+        for _, items in self._sections():
+            for item in items:
+                shared += _share_identical(item, canonical, seen, min_length)[3]
+        return shared
+
     def add_rsync_resource_type(self, docker_user=None, docker_pass=None):
         _source = {
                 'repository': 'public.ecr.aws/y0o4y9o3/concourse-rsync-resource',
@@ -130,7 +187,7 @@ class PipelineConfig:
         self.add_resource(resource_name, 'rsync-resource', source=source)
 
     def add_anaconda_upload(self, all_rsync, config_vars):
-        self.add_jobs(
+        self.add_job(
             name='anaconda_upload',
             plan=all_rsync + [{'put': 'anaconda_upload_resource'}]
         )
@@ -291,18 +348,219 @@ class PipelineConfig:
         self.add_job('destroy_pipeline', plan)
 
 
+class _Unsupported(Exception):
+    """ A value for which _scan_items can not tell how yaml.dump writes it """
+
+
+# strings which yaml.dump double quotes, and which libyaml folds differently when long
+_double_quoted = re.compile('[^\n\x20-\x7e]| \n|\n ')
+
+
+def _scan_items(items):
+    """ Find what the items of a pipeline need to be written the same as yaml.dump does
+
+    Returns the anchor yaml.dump gives to each object which appears more than once,
+    by id, and whether each item has strings which are double quoted.  This walks the
+    items in the order yaml.dump anchors them in, so that the anchors get the same
+    names.
+    """
+    anchors = {}
+    slow = []
+    count = 0
+    for item in items:
+        double_quoted = False
+        stack = [item]
+        while stack:
+            data = stack.pop()
+            if type(data) is str:
+                double_quoted = double_quoted or bool(_double_quoted.search(data))
+                continue
+            if data is None or type(data) in (bool, int, float):
+                # yaml.dump never aliases these
+                continue
+            if type(data) not in (dict, list):
+                raise _Unsupported(type(data))
+            key = id(data)
+            if key in anchors:
+                if anchors[key] is None:
+                    count += 1
+                    anchors[key] = yaml.Dumper.ANCHOR_TEMPLATE % count
+                continue
+            anchors[key] = None
+            if type(data) is dict:
+                children = list(data.items())
+                try:
+                    children = sorted(children)
+                except TypeError:
+                    pass
+                # multiline keys are double quoted too
+                double_quoted = double_quoted or any(isinstance(k, str) and '\n' in k
+                                                     for k, _ in children)
+                children = [child for pair in children for child in pair]
+            else:
+                children = list(data)
+            children.reverse()
+            stack.extend(children)
+        slow.append(double_quoted)
+    return {key: anchor for key, anchor in anchors.items() if anchor}, slow
+
+
+def _share_identical(data, canonical, seen, min_length):
+    """ Replace the parts of data by the first identical ones found before
+
+    canonical holds the first part found for each value and seen the result for each
+    part already looked at, by id.  Returns the part to use in place of data, a key
+    for its value, the length of its keys and values, and the number of parts replaced.
+    """
+    if id(data) in seen:
+        return seen[id(data)]
+    if data is None or type(data) in (str, bool, int, float):
+        return data, (type(data), data), len(str(data)), 0
+    if type(data) not in (dict, list):
+        # never equal to anything else
+        return data, (id(data),), 0, 0
+    length = shared = 0
+    keys = []
+    children = data.items() if type(data) is dict else enumerate(data)
+    for index, child in list(children):
+        new, key, child_length, child_shared = _share_identical(child, canonical, seen,
+                                                                min_length)
+        if new is not child:
+            data[index] = new
+        keys.append((index, key) if type(data) is dict else key)
+        length += child_length + (len(str(index)) if type(data) is dict else 0)
+        shared += child_shared
+    if type(data) is dict:
+        keys.sort(key=repr)
+    key = (type(data), tuple(keys))
+    if length >= min_length:
+        first = canonical.setdefault(key, data)
+        if first is not data:
+            # what was replaced within data does not count, data is dropped
+            shared = 1
+        # identical parts are the same object from here on, so this key is shorter
+        result = first, (id(first),), length, shared
+    else:
+        result = data, key, length, shared
+    seen[id(data)] = result
+    return result
+
+
+class _NoAnchors(dict):
+    def __missing__(self, node):
+        return None
+
+
+class _ItemWriter(object):
+    """ Writes the items of the lists of a pipeline, keeping the anchors between them
+
+    Each item is written as a document of its own, which is a list of just that item,
+    with an emitter of its own.  Without the document markers, which yaml.dump leaves
+    out, that is the same text as the item has within the pipeline.
+
+    Parameters
+    ----------
+    stream : file
+        Where to write the YAML.
+    shared : dict
+        The anchor of each object which appears more than once, by id.
+
+    """
+
+    def __init__(self, stream, shared):
+        self.stream = stream
+        self.shared = shared
+        self.anchors = _NoAnchors()
+        self.represented_objects = {}
+        self.serialized_nodes = {}
+
+    def write(self, item, dumper_class):
+        dumper = dumper_class(self.stream, default_flow_style=False)
+        dumper.anchors = self.anchors
+        dumper.represented_objects = self.represented_objects
+        dumper.serialized_nodes = self.serialized_nodes
+        try:
+            dumper.emit(StreamStartEvent())
+            dumper.emit(DocumentStartEvent(explicit=None))
+            dumper.emit(SequenceStartEvent(None, dumper.DEFAULT_SEQUENCE_TAG, True,
+                                           flow_style=False))
+            dumper.serialize_node(self.represent(dumper, item), None, 0)
+            dumper.emit(SequenceEndEvent())
+            dumper.emit(DocumentEndEvent(explicit=None))
+            dumper.emit(StreamEndEvent())
+        finally:
+            dumper.dispose()
+        # only the nodes which later items may refer to again are kept
+        self.represented_objects = {key: node for key, node in self.represented_objects.items()
+                                    if key in self.shared}
+        self.serialized_nodes = {node: True for node in self.serialized_nodes
+                                 if node in self.anchors}
+
+    def represent(self, dumper, item):
+        node = dumper.represent_data(item)
+        for key, represented in dumper.represented_objects.items():
+            anchor = self.shared.get(key)
+            if anchor:
+                self.anchors[represented] = anchor
+        return node
+
+
+def _write_sections(stream, sections):
+    """ Write the (name, items) sections of a pipeline as yaml.dump does, with _ItemWriter
+
+    Raises _Unsupported, before anything is written, for items which it can not write.
+    """
+    shared, slow = _scan_items(item for _, items in sections for item in items)
+    writer = _ItemWriter(stream, shared)
+    slow = iter(slow)
+    for attr, items in sections:
+        stream.write(attr + ':\n')
+        for item in items:
+            writer.write(item, yaml.Dumper if next(slow) else _FastDumper)
+
+
+# whether _ItemWriter works with the PyYAML installed, see _item_writer_works
+_item_writer_checked = []
+
+
+def _item_writer_works():
+    """ Whether _write_sections writes a sample pipeline the same as yaml.dump
+
+    _ItemWriter relies on internals of PyYAML, and _scan_items on how it quotes and
+    folds strings.  Pipelines are written by yaml.dump with versions of PyYAML which
+    changed those.  This is checked once per process.
+    """
+    if not _item_writer_checked:
+        shared = {'image': 'repository/' * 8, 'tag': 'latest'}
+        sample = [('jobs', [{'name': 'a', 'config': shared,
+                             'args': ['plain text ' * 12, 'ünïcödé text ' * 12]},
+                            {'name': 'b', 'config': shared, 'args': ['a\n b ' * 20]}])]
+        stream = io.StringIO()
+        try:
+            _write_sections(stream, sample)
+            works = stream.getvalue() == yaml.dump(dict(sample), default_flow_style=False)
+        except (AttributeError, TypeError, yaml.YAMLError, _Unsupported):
+            works = False
+        _item_writer_checked.append(works)
+    return _item_writer_checked[0]
+
+
 class JobConfig:
     """ configuration for a concourse job. """
     # https://concourse-ci.org/jobs.html
 
-    def __init__(self, name="placeholder", plan=None):
+    def __init__(self, name="placeholder", plan=None, serial_groups=None):
         self.name = name
         self.plan = plan
         if plan is None:
             self.plan = []
+        self.serial_groups = serial_groups
 
     def to_dict(self):
-        return {"name": self.name, "plan": self.plan}
+        job = {"name": self.name, "plan": self.plan}
+        if self.serial_groups:
+            job["serial_groups"] = self.serial_groups
+        return job
 
     def add_rsync_recipes(self):
         self.plan.append({
@@ -1,31 +1,38 @@
 import contextlib
 import glob
+import heapq
 import logging
 import os
+import re
 import shutil
 import stat
 import subprocess
 import tempfile
 import time
 
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
+from concurrent.futures import (FIRST_COMPLETED, Future, ProcessPoolExecutor,
+                                ThreadPoolExecutor, wait)
 from fnmatch import fnmatch
 
 import conda_build.api
 from conda_build.conda_interface import Resolve, TemporaryDirectory, cc_conda_build
 from conda_build.index import get_build_index
+from conda_build.utils import HashableDict
 from conda_build.variants import get_package_variants
 
 import networkx as nx
 
-import requests
-
 import yaml
 
-from .compute_build_graph import construct_graph, expand_run, order_build, package_key
-from .concourse import Concourse
+from . import compute_build_graph, profiling
+from .compute_build_graph import (compact_graph, construct_graph, expand_run, node_record,
+                                  order_build, package_key, shard_graph)
+from .concourse import ActiveBuildTracker
 from .concourse_config import PipelineConfig, JobConfig, BuildStepConfig
-from .utils import HashableDict, ensure_list, load_yaml_config_dir
+from .pipelines import (_ensure_login_and_sync, abort_pipeline, pause_pipeline,  # NOQA
+                        rm_pipeline, trigger_pipeline, unpause_pipeline)
+from .utils import ensure_list, load_json, load_yaml_config_dir, save_json
 
 log = logging.getLogger(__file__)
 bootstrap_path = os.path.join(os.path.dirname(__file__), 'bootstrap')
@@ -35,6 +42,16 @@ try:
 except NameError:
     pass
 
+try:
+    import fcntl
+except ImportError:  # windows
+    fcntl = None
+
+# ioctl of linux/fs.h which makes a file share the data of another, on btrfs, xfs and the like
+_FICLONE = 0x40049409
+# (source, destination) devices between which _FICLONE failed
+_no_reflink = set()
+
 # get rid of the special object notation in the yaml file for HashableDict instances that we dump
 yaml.add_representer(HashableDict, yaml.representer.SafeRepresenter.represent_dict)
 yaml.add_representer(set, yaml.representer.SafeRepresenter.represent_list)
@@ -80,9 +97,22 @@ def collect_tasks(
         append_sections_file=None,
         pass_throughs=None,
         skip_existing=True,
-        build_config_vars={}
+        build_config_vars={},
+        index_ttl=0,
+        cache_dir=None,
+        output_paths=False,
         ):
-    """ Return a graph of build tasks """
+    """ Return a graph of build tasks
+
+    index_ttl is the number of seconds for which the channel index of a platform may be
+    reused by later calls.  By default it is fetched again every time.
+
+    When cache_dir is given, the rendered recipes are stored there for each commit, and
+    only the recipes changed since the last stored commit are rendered again.
+
+    With output_paths, the nodes keep the paths of the packages they build, so that
+    upload tasks can be made for them.
+    """
     task_graph = nx.DiGraph()
     parsed_cli_args = _parse_python_numpy_from_pass_throughs(pass_throughs)
     config = conda_build.api.Config(
@@ -100,8 +130,12 @@ def collect_tasks(
         config.variants = get_package_variants(path, config, platform.get('variants'))
         config.channel_urls = channels or []
         config.variant_config_files = variant_config_files or []
-        conda_resolve = Resolve(get_build_index(
-            subdir=subdir, bldpkgs_dir=config.bldpkgs_dir, channel_urls=channels)[0])
+        conda_resolve = _get_resolve(subdir, config.bldpkgs_dir, channels, ttl=index_ttl)
+        # renders of an earlier call are only reused for the same variants and platform
+        render_key = compute_build_graph.render_cache_key(path, platform, config)
+        compute_build_graph.forget_renders_of_other_config(platform['label'], render_key)
+        if cache_dir:
+            compute_build_graph.load_renders(cache_dir, path, render_key, platform['label'])
         # this graph is potentially different for platform and for build or test mode ("run")
         graph = construct_graph(
             path,
@@ -113,23 +147,51 @@ def collect_tasks(
             config=config,
         )
         # Apply the build label to any nodes that need (re)building or testing
-        expand_run(
-            graph,
-            config=config.copy(),
-            conda_resolve=conda_resolve,
-            worker=platform,
-            run="build",
-            steps=steps,
-            max_downstream=max_downstream,
-            recipes_dir=path,
-            matrix_base_dir=matrix_base_dir,
-        )
+        with profiling.phase('expansion'):
+            expand_run(
+                graph,
+                config=config.copy(),
+                conda_resolve=conda_resolve,
+                worker=platform,
+                run="build",
+                steps=steps,
+                max_downstream=max_downstream,
+                recipes_dir=path,
+                matrix_base_dir=matrix_base_dir,
+            )
+        if cache_dir:
+            compute_build_graph.save_renders(cache_dir, path, render_key, platform['label'])
+        # only a few fields of the rendered recipes are needed from here on
+        compact_graph(graph, output_paths=output_paths)
         # merge this graph with the main one
         task_graph = nx.compose(task_graph, graph)
-    collapse_noarch_python_nodes(task_graph)
+    with profiling.phase('noarch collapse'):
+        collapse_noarch_python_nodes(task_graph)
     return task_graph
 
 
+# (time, Resolve) by (subdir, bldpkgs_dir, channels), for collect_tasks with an index_ttl
+_resolve_cache = {}
+
+
+def _get_resolve(subdir, bldpkgs_dir, channels, ttl=0):
+    """ Return a Resolve of the channel index, reusing one up to ttl seconds old """
+    key = (subdir, bldpkgs_dir, tuple(channels or ()))
+    cached = _resolve_cache.get(key)
+    if cached and time.time() - cached[0] < ttl:
+        profiling.count('index cache hits')
+        return cached[1]
+    with profiling.phase('index fetch'):
+        conda_resolve = Resolve(get_build_index(
+            subdir=subdir, bldpkgs_dir=bldpkgs_dir, channel_urls=channels)[0])
+    if ttl:
+        if cached:
+            # the lookups of the old index would keep it alive
+            compute_build_graph.forget_renders()
+        _resolve_cache[key] = (time.time(), conda_resolve)
+    return conda_resolve
+
+
 def collapse_noarch_python_nodes(graph):
     """ Collapse nodes for noarch python packages into a single node
 
@@ -144,7 +206,7 @@ def collapse_noarch_python_nodes(graph):
     noarch_groups = defaultdict(list)
     for node in graph.nodes():
         if graph.nodes[node].get('noarch_pkg', False):
-            pkg_name = graph.nodes[node]['meta'].name()
+            pkg_name = node_record(graph.nodes[node]['meta']).name
             noarch_groups[pkg_name].append(node)
 
     for pkg_name, nodes in noarch_groups.items():
@@ -152,7 +214,7 @@ def collapse_noarch_python_nodes(graph):
         build_nodes = []
         test_nodes = []
         for node in nodes:
-            if graph.nodes[node]['meta'].config.subdir == build_subdir:
+            if node_record(graph.nodes[node]['meta']).subdir == build_subdir:
                 build_nodes.append(node)
             else:
                 test_nodes.append(node)
@@ -198,8 +260,8 @@ def get_build_task(
         pull_recipes_resource=None,
         ):
 
-    worker_tags = (ensure_list(worker_tags) +
-                   ensure_list(meta.meta.get('extra', {}).get('worker_tags')))
+    meta = node_record(meta)
+    worker_tags = ensure_list(worker_tags) + meta.worker_tags
     stepconfig = BuildStepConfig(test_only, worker['platform'], worker_tags)
 
     # setup the task config
@@ -216,7 +278,7 @@ def get_build_task(
     stepconfig.cb_args.append(f'--stats-file={stats_file}')
     if test_only:
         stepconfig.cb_args.append('--test')
-    for channel in meta.config.channel_urls:
+    for channel in meta.channel_urls:
         stepconfig.cb_args.extend(['-c', channel])
     if artifact_input:
         stepconfig.cb_args.extend(('-c', os.path.join('indexed-artifacts')))
@@ -269,6 +331,60 @@ def get_build_task(
     return stepconfig.to_dict()
 
 
+def get_serial_groups(worker, group_counts):
+    """ Return the serial groups for the next job on a worker, or None if unlimited.
+
+    Workers with a ``capacity`` in their build_platforms.d entry have their jobs
+    spread round-robin over that many serial groups, so no more than ``capacity`` of
+    them can run at the same time.  ``group_counts`` tracks the number of jobs already
+    assigned to each worker label and is updated in place.
+    """
+    capacity = int(worker.get('capacity') or 0)
+    if capacity <= 0:
+        return None
+    label = worker['label']
+    group = '{0}-{1}'.format(label, group_counts[label] % capacity)
+    group_counts[label] += 1
+    return [group]
+
+
+def _job_name(graph, node):
+    """ Name of the job of a node of the task graph """
+    name = package_key(node_record(graph.nodes[node]['meta']), graph.nodes[node]['worker']['label'])
+    if graph.nodes[node].get('test_only', False):
+        name = 'test-' + name
+    return name
+
+
+def add_pipeline_groups(plconfig, graph, recipes_dir=None):
+    """Group the jobs of a plan by worker label and dependency level
+
+    Concourse shows one group of a pipeline at a time, so that large pipelines need not
+    be drawn whole.  Level 0 holds the jobs which depend on no other job in graph, level
+    1 those which depend on level 0 jobs only, and so on.  With recipes_dir, the jobs
+    are also grouped by the top level folder of recipes_dir that their recipe is in.
+    Jobs which are not of a node of graph, such as uploads, are grouped as 'other'.
+    """
+    level = {}
+    for node in reversed(list(nx.topological_sort(graph))):
+        level[node] = 1 + max((level[dep] for dep in graph.successors(node)), default=-1)
+    groups = defaultdict(list)
+    folder_groups = defaultdict(list)
+    for node in sorted(graph.nodes(), key=lambda node: (level[node], node)):
+        name = _job_name(graph, node)
+        groups[(graph.nodes[node]['worker']['label'], level[node])].append(name)
+        if recipes_dir:
+            folder_groups[_recipe_folder(graph.nodes[node]['meta'], recipes_dir)].append(name)
+    for (label, node_level), jobs in sorted(groups.items()):
+        plconfig.add_group('{}-level-{}'.format(label, node_level), jobs)
+    for folder, jobs in sorted(folder_groups.items()):
+        plconfig.add_group(folder, jobs)
+    grouped = {name for group in plconfig.groups for name in group['jobs']}
+    other = [job['name'] for job in plconfig.jobs if job['name'] not in grouped]
+    if other:
+        plconfig.add_group('other', other)
+
+
 def graph_to_plan_with_jobs(
         base_path, graph, commit_id, matrix_base_dir, config_vars,
         public=True, worker_tags=None, pass_throughs=None,
@@ -308,18 +424,18 @@ def graph_to_plan_with_jobs(
     if any(graph.nodes[node]['worker']['platform'] in ["win", "osx"] for node in order):
         plconfig.add_rsync_build_pack(config_vars)
 
+    serial_group_counts = defaultdict(int)
     for node in order:
-        meta = graph.nodes[node]['meta']
+        meta = node_record(graph.nodes[node]['meta'])
         worker = graph.nodes[node]['worker']
         test_only = graph.nodes[node].get('test_only', False)
         rsync_artifacts = worker.get("rsync") in [None, True]
-        name = package_key(meta, worker['label'])
-        if test_only:
-            name = 'test-' + name
-        jobconfig = JobConfig(name=name)
+        name = _job_name(graph, node)
+        jobconfig = JobConfig(name=name,
+                              serial_groups=get_serial_groups(worker, serial_group_counts))
         if automated_pipeline:
             # TODO use mapping between node -> folder/feedstock
-            feedstock_name = meta.meta['package']['name']
+            feedstock_name = meta.name
             pull_recipes_resource = f"pull-recipes-{feedstock_name}"
             jobconfig.plan.append(
                 {'get': pull_recipes_resource, 'trigger': True}
@@ -336,7 +452,7 @@ def graph_to_plan_with_jobs(
             if rsync_artifacts:
                 jobconfig.add_rsync_prereq(prereq)
         if prereqs:
-            jobconfig.add_consolidate_task(prereqs, meta.config.host_subdir,
+            jobconfig.add_consolidate_task(prereqs, meta.host_subdir,
                     docker_user=docker_user, docker_pass=docker_pass)
         jobconfig.plan.append(get_build_task(
             node, meta, worker,
@@ -351,7 +467,7 @@ def graph_to_plan_with_jobs(
             pull_recipes_resource=pull_recipes_resource,
         ))
         if not test_only:
-            jobconfig.add_convert_task(meta.config.host_subdir,
+            jobconfig.add_convert_task(meta.host_subdir,
                     docker_user=docker_user, docker_pass=docker_pass)
             resource_name = 'rsync_' + node
             jobconfig.add_put_artifacts(resource_name)
@@ -416,60 +532,10 @@ def _get_current_git_rev(path, branch=False):
     return out[:8] if not branch else out
 
 
-def _ensure_login_and_sync(config_root_dir):
-    """
-    Return Concourse object after logging in and syncing the fly version.
-    """
-    config_path = os.path.expanduser(os.path.join(config_root_dir, 'config.yml'))
-    with open(config_path) as src:
-        config_vars = yaml.safe_load(src)
-    con = Concourse(
-        concourse_url=config_vars['concourse-url'],
-        username=config_vars.get('concourse-username'),
-        password=config_vars.get('concourse-password'),
-        team_name=config_vars.get('concourse-team'),
-    )
-    con.login()
-    con.sync()
-    return con
-
-
-def _filter_existing_pipelines(con, pipeline_patterns):
-    """Iterate over the list of existing pipelines and filter out those which
-    match any pattern in the given list (passed as an argument to this
-    function). This function can be called before performing bulk operations on
-    pipelines.
-    """
-    pipelines = con.pipelines
-    filtered_pipelines = []
-    for pattern in ensure_list(pipeline_patterns):
-        filtered_pipelines.extend([p for p in pipelines if fnmatch(p, pattern)])
-    return filtered_pipelines
-
-
-def _filter_pipelines_by_time(con, pipelines, days):
-    """
-    Will return pipelines that are older than the number of days specified.
-    """
-    # for each pipeline in pipelines we should get their builds
-    # if the most recent build is older than $days old then we should add it to
-    # the list of things to remove.
-    from datetime import datetime
-    filtered_pipelines = []
-    now = datetime.now()
-    for pipeline in pipelines:
-        builds = con.get_builds(pipeline)
-        times = []
-        for build in builds:
-            try:
-                curtime = datetime.fromtimestamp(build.get('end_time', build.get('start_time')))
-                times.append(curtime)
-            except TypeError:
-                continue
-        most_recent_build = max(times)
-        if most_recent_build and (now - most_recent_build).days > days:
-            filtered_pipelines.append(pipeline)
-    return filtered_pipelines
+def _check_call(args):
+    """ subprocess.check_call, timed in the metrics under the command name """
+    with profiling.timer(args[0]):
+        subprocess.check_call(args)
 
 
 def submit(pipeline_file, base_name, pipeline_name, src_dir, config_root_dir,
@@ -498,49 +564,53 @@ def submit(pipeline_file, base_name, pipeline_name, src_dir, config_root_dir,
     key_handle.close()
     os.chmod(key_file, stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
 
-    # this is a plan director job.  Sync config.
-    if not config_overrides:
-        subprocess.check_call(['ssh', '-o', 'UserKnownHostsFile=/dev/null',
-                        '-o', 'StrictHostKeyChecking=no', '-i', key_file,
-                        '{intermediate-user}@{intermediate-server}'.format(**data),
-                        'mkdir -p {intermediate-base-folder}/{base-name}/config'.format(**data)])
-        subprocess.check_call(['rsync', '--delete', '-av', '-e',
-                               'ssh -o UserKnownHostsFile=/dev/null '
-                               '-o StrictHostKeyChecking=no -i ' + key_file,
-                               config_root_dir + '/',
-                               ('{intermediate-user}@{intermediate-server}:'
-                                '{intermediate-base-folder}/{base-name}/config'.format(**data))
-                               ])
-    # this is a one-off job.  Sync the recipes we've computed locally.
-    else:
-        subprocess.check_call(['ssh', '-o', 'UserKnownHostsFile=/dev/null',
-                        '-o', 'StrictHostKeyChecking=no', '-i', key_file,
-                        '{intermediate-user}@{intermediate-server}'.format(**data),
-                        'mkdir -p {intermediate-base-folder}/{base-name}'.format(**data)])
-        # create the PR file
-        if kw.get('pr_num', None):
-            with open(f"{src_dir}/pr_num", 'w') as pr_file:
-                pr_file.write(kw.get('pr_num'))
-
-        subprocess.check_call(['rsync', '--delete', '-av', '-e',
-                               'ssh -o UserKnownHostsFile=/dev/null '
-                               '-o StrictHostKeyChecking=no -i ' + key_file,
-                               '-p', '--chmod=a=rwx',
-                               src_dir + '/',
-                               ('{intermediate-user}@{intermediate-server}:'
-                                '{intermediate-base-folder}/{base-name}/plan_and_recipes'
-                                .format(**data))
-                               ])
-        # remove any existing artifacts for sanity's sake - artifacts are only from this build.
-        subprocess.check_call(['ssh', '-o', 'UserKnownHostsFile=/dev/null',
-                        '-o', 'StrictHostKeyChecking=no', '-i', key_file,
-                        '{intermediate-user}@{intermediate-server}'.format(**data),
-                        'rm -rf {intermediate-base-folder}/{base-name}/artifacts'.format(**data)])
-        # create the status dir
-        subprocess.check_call(['ssh', '-o', 'UserKnownHostsFile=/dev/null',
-                        '-o', 'StrictHostKeyChecking=no', '-i', key_file,
-                        '{intermediate-user}@{intermediate-server}'.format(**data),
-                        'mkdir -p {intermediate-base-folder}/{base-name}/status'.format(**data)])
+    with profiling.phase('submit rsync'):
+        # this is a plan director job.  Sync config.
+        if not config_overrides:
+            _check_call(['ssh', '-o', 'UserKnownHostsFile=/dev/null',
+                         '-o', 'StrictHostKeyChecking=no', '-i', key_file,
+                         '{intermediate-user}@{intermediate-server}'.format(**data),
+                         'mkdir -p {intermediate-base-folder}/{base-name}/config'
+                         .format(**data)])
+            _check_call(['rsync', '--delete', '-av', '-e',
+                         'ssh -o UserKnownHostsFile=/dev/null '
+                         '-o StrictHostKeyChecking=no -i ' + key_file,
+                         config_root_dir + '/',
+                         ('{intermediate-user}@{intermediate-server}:'
+                          '{intermediate-base-folder}/{base-name}/config'.format(**data))
+                         ])
+        # this is a one-off job.  Sync the recipes we've computed locally.
+        else:
+            _check_call(['ssh', '-o', 'UserKnownHostsFile=/dev/null',
+                         '-o', 'StrictHostKeyChecking=no', '-i', key_file,
+                         '{intermediate-user}@{intermediate-server}'.format(**data),
+                         'mkdir -p {intermediate-base-folder}/{base-name}'.format(**data)])
+            # create the PR file
+            if kw.get('pr_num', None):
+                with open(f"{src_dir}/pr_num", 'w') as pr_file:
+                    pr_file.write(kw.get('pr_num'))
+
+            _check_call(['rsync', '--delete', '-av', '-e',
+                         'ssh -o UserKnownHostsFile=/dev/null '
+                         '-o StrictHostKeyChecking=no -i ' + key_file,
+                         '-p', '--chmod=a=rwx',
+                         src_dir + '/',
+                         ('{intermediate-user}@{intermediate-server}:'
+                          '{intermediate-base-folder}/{base-name}/plan_and_recipes'
+                          .format(**data))
+                         ])
+            # remove any existing artifacts for sanity's sake - artifacts are only from this build.
+            _check_call(['ssh', '-o', 'UserKnownHostsFile=/dev/null',
+                         '-o', 'StrictHostKeyChecking=no', '-i', key_file,
+                         '{intermediate-user}@{intermediate-server}'.format(**data),
+                         'rm -rf {intermediate-base-folder}/{base-name}/artifacts'
+                         .format(**data)])
+            # create the status dir
+            _check_call(['ssh', '-o', 'UserKnownHostsFile=/dev/null',
+                         '-o', 'StrictHostKeyChecking=no', '-i', key_file,
+                         '{intermediate-user}@{intermediate-server}'.format(**data),
+                         'mkdir -p {intermediate-base-folder}/{base-name}/status'
+                         .format(**data)])
     os.remove(key_file)
 
     con = _ensure_login_and_sync(config_root_dir)
@@ -550,6 +620,39 @@ def submit(pipeline_file, base_name, pipeline_name, src_dir, config_root_dir,
         con.expose_pipeline(pipeline_name)
 
 
+def _read_build_config_vars(matrix_base_dir):
+    """ Return the variables from build-config.yml in matrix_base_dir, if there is one """
+    build_config_yml = os.path.join(matrix_base_dir, 'build-config.yml')
+    try:
+        with open(build_config_yml) as build_config_file:
+            return yaml.safe_load(build_config_file) or {}
+    except (OSError, IOError):
+        print('WARNING :: open(build_config_yml={}) failed'.format(build_config_yml))
+        return {}
+
+
+def _shard_label(label, index, count):
+    """ Name of the pipeline of the index-th of count shards, counting from 1 """
+    return '{}-{}-of-{}'.format(label, index, count)
+
+
+# matches the labels of _shard_label
+_shard_label_re = re.compile(r'.+-\d+-of-\d+$')
+
+
+def _shard_task_graph(task_graph, label, max_jobs=None):
+    """Split task_graph into pipelines of at most max_jobs jobs each
+
+    Returns a list of (pipeline label, graph) pairs, with a label of None when the
+    graph is not split.
+    """
+    shards = shard_graph(task_graph, max_jobs) if max_jobs else []
+    if len(shards) < 2:
+        return [(None, task_graph)]
+    return [(_shard_label(label, index, len(shards)), task_graph.subgraph(nodes).copy())
+            for index, nodes in enumerate(shards, 1)]
+
+
 def compute_builds(path, base_name, folders, matrix_base_dir=None,
                    steps=0, max_downstream=5, test=False, public=True, output_dir='../output',
                    output_folder_label='git', config_overrides=None, platform_filters=None,
@@ -566,6 +669,12 @@ def compute_builds(path, base_name, folders, matrix_base_dir=None,
             raise ValueError(
                     "--destroy-pipeline requires that --push-branch "
                     "and stage-for-upload be specified as well.")
+    if kw.get('max_shard_jobs'):
+        for option in ('automated_pipeline', 'stage_for_upload', 'push_branch',
+                       'destroy_pipeline'):
+            if kw.get(option):
+                raise ValueError("--max-shard-jobs can not be combined with --{}".format(
+                    option.replace('_', '-')))
     folders = folders
     path = path.replace('"', '')
     if not folders:
@@ -581,15 +690,8 @@ def compute_builds(path, base_name, folders, matrix_base_dir=None,
     repo_commit = ''
     git_identifier = ''
 
-    build_config_yml = os.path.join(matrix_base_dir, 'build-config.yml')
     matched = {}
-    build_config_vars = {}
-    try:
-        with open(build_config_yml) as build_config_file:
-            build_config_vars = yaml.safe_load(build_config_file)
-    except (OSError, IOError):
-        print('WARNING :: open(build_config_yml={}) failed'.format(build_config_yml))
-        pass
+    build_config_vars = _read_build_config_vars(matrix_base_dir)
     for bcv in build_config_vars:
         for var_val in build_config:
             var = var_val.split('=', 1)[0]
@@ -621,7 +723,9 @@ def compute_builds(path, base_name, folders, matrix_base_dir=None,
         clobber_sections_file=clobber_sections_file,
         pass_throughs=pass_throughs,
         skip_existing=skip_existing,
-        build_config_vars=build_config_vars
+        build_config_vars=build_config_vars,
+        index_ttl=kw.get('index_ttl', 0),
+        cache_dir=kw.get('cache_dir'),
     )
 
     with open(os.path.join(matrix_base_dir, 'config.yml')) as src:
@@ -631,122 +735,227 @@ def compute_builds(path, base_name, folders, matrix_base_dir=None,
     if config_overrides:
         config_vars.update(config_overrides)
 
-    plconfig = graph_to_plan_with_jobs(
-        os.path.abspath(path),
-        task_graph,
-        commit_id=repo_commit,
-        matrix_base_dir=matrix_base_dir,
-        config_vars=config_vars,
-        public=public,
-        worker_tags=worker_tags,
-        pass_throughs=pass_throughs,
-        use_repo_access=use_repo_access,
-        use_staging_channel=use_staging_channel,
-        automated_pipeline=kw.get("automated_pipeline", False),
-        branches=kw.get("branches", None),
-        pr_num=kw.get("pr_num", None),
-        repository=kw.get("repository", None),
-        folders=folders
-    )
+    output_dir = output_dir.format(base_name=base_name, git_identifier=git_identifier)
+    # a sharded plan is recognized by its folders, so none of an earlier run may be left
+    _remove_stale_plans(output_dir)
+    shards = _shard_task_graph(task_graph, config_vars['base-name'], kw.get('max_shard_jobs'))
+    if len(shards) > 1:
+        print("Split the plan into {} pipelines: {}".format(
+            len(shards), ', '.join(label for label, _ in shards)))
+    for label, graph in shards:
+        if label is None:
+            pipeline_config_vars, pipeline_output_dir = config_vars, output_dir
+        else:
+            pipeline_config_vars = dict(config_vars, **{'base-name': label})
+            pipeline_output_dir = os.path.join(output_dir, label)
+        with profiling.phase('plan build'):
+            plconfig = graph_to_plan_with_jobs(
+                os.path.abspath(path),
+                graph,
+                commit_id=repo_commit,
+                matrix_base_dir=matrix_base_dir,
+                config_vars=pipeline_config_vars,
+                public=public,
+                worker_tags=worker_tags,
+                pass_throughs=pass_throughs,
+                use_repo_access=use_repo_access,
+                use_staging_channel=use_staging_channel,
+                automated_pipeline=kw.get("automated_pipeline", False),
+                branches=kw.get("branches", None),
+                pr_num=kw.get("pr_num", None),
+                repository=kw.get("repository", None),
+                folders=folders
+            )
 
-    if kw.get('pr_file'):
-        pr_merged_resource = "pr-merged"  # TODO actually a name
-        plconfig.add_pr_merged_resource(config_vars['pr-repo'], kw.get("pr_file"))
-    else:
-        pr_merged_resource = None
+        if kw.get('pr_file'):
+            pr_merged_resource = "pr-merged"  # TODO actually a name
+            plconfig.add_pr_merged_resource(pipeline_config_vars['pr-repo'], kw.get("pr_file"))
+        else:
+            pr_merged_resource = None
 
-    if kw.get('stage_for_upload', False):
-        # TODO move this
-        if 'stage-for-upload-config' not in config_vars:
-            raise Exception(
-                ("--stage-for-upload specified but configuration file contains "
-                "to 'stage-for-upload-config entry"))
-        plconfig.add_upload_job(config_vars, kw['commit_msg'], pr_merged_resource)
-
-    if kw.get('push_branch', False):
-        # TODO move this
-        if 'push-branch-config' not in config_vars:
-            raise Exception(
-                ("--push-branch specified but configuration file contains "
-                "to 'push-branch-config entry"))
         if kw.get('stage_for_upload', False):
-            stage_job_name = 'stage_for_upload'
-        else:
-            stage_job_name = None
-        plconfig.add_push_branch_job(
-            config_vars, folders, kw['branches'], kw['feedstock_pr_num'], pr_merged_resource, stage_job_name)
-    if kw.get('destroy_pipeline', False):
-        # TODO move this
-        if 'destroy-pipeline-config' not in config_vars:
-            raise Exception(
-                "--destroy-pipeline specified but configuration file does not "
-                "have that entry."
-                    )
-        plconfig.add_destroy_pipeline_job(config_vars, folders)
-    output_dir = output_dir.format(base_name=base_name, git_identifier=git_identifier)
+            # TODO move this
+            if 'stage-for-upload-config' not in pipeline_config_vars:
+                raise Exception(
+                    ("--stage-for-upload specified but configuration file contains "
+                    "to 'stage-for-upload-config entry"))
+            plconfig.add_upload_job(pipeline_config_vars, kw['commit_msg'], pr_merged_resource)
+
+        if kw.get('push_branch', False):
+            # TODO move this
+            if 'push-branch-config' not in pipeline_config_vars:
+                raise Exception(
+                    ("--push-branch specified but configuration file contains "
+                    "to 'push-branch-config entry"))
+            if kw.get('stage_for_upload', False):
+                stage_job_name = 'stage_for_upload'
+            else:
+                stage_job_name = None
+            plconfig.add_push_branch_job(
+                pipeline_config_vars, folders, kw['branches'], kw['feedstock_pr_num'],
+                pr_merged_resource, stage_job_name)
+        if kw.get('destroy_pipeline', False):
+            # TODO move this
+            if 'destroy-pipeline-config' not in pipeline_config_vars:
+                raise Exception(
+                    "--destroy-pipeline specified but configuration file does not "
+                    "have that entry."
+                        )
+            plconfig.add_destroy_pipeline_job(pipeline_config_vars, folders)
+        add_pipeline_groups(plconfig, graph, path if kw.get('group_by_feedstock') else None)
+
+        with profiling.phase('yaml dump'):
+            write_plan(plconfig, pipeline_output_dir, dedup=kw.get('dedup_plan', False))
+        with profiling.phase('recipe copy'):
+            write_recipes(graph, path, pipeline_output_dir,
+                          clobber_sections_file=clobber_sections_file,
+                          append_sections_file=append_sections_file,
+                          stage_mode=kw.get('stage_mode') or 'copy')
+
+
+class _CharCounter(object):
+    """ A text stream which only counts what is written to it """
 
+    def __init__(self):
+        self.count = 0
+
+    def write(self, text):
+        self.count += len(text)
+        return len(text)
+
+
+def write_plan(plconfig, output_dir, dedup=False):
+    """ Write the pipeline configuration to plan.yml in output_dir
+
+    With dedup, the identical parts of the plan are written once, as YAML anchors,
+    and referred to by aliases elsewhere.  How much smaller that makes plan.yml is
+    printed.
+    """
     if not os.path.isdir(output_dir):
         os.makedirs(output_dir)
+    if dedup:
+        full = _CharCounter()
+        plconfig.dump(full)
+        shared = plconfig.share_identical()
     with open(os.path.join(output_dir, 'plan.yml'), 'w') as f:
-        yaml.dump(plconfig.to_dict(), f, default_flow_style=False)
+        plconfig.dump(f)
+        size = f.tell()
+    if dedup:
+        print("plan.yml is {} bytes, {} bytes ({:.0%}) less than without the {} shared parts"
+              .format(size, full.count - size, 1 - size / max(full.count, 1), shared))
+
+
+def _link_file(src, dst):
+    """ Hardlink dst to src, copying it where that is not possible """
+    try:
+        os.link(src, dst)
+    except OSError:
+        return shutil.copy2(src, dst)
+    return dst
+
 
+def _reflink_file(src, dst):
+    """ Copy src to dst sharing its data on disk, copying it in full where that is not possible """
+    devices = (os.stat(src).st_dev, os.stat(os.path.dirname(dst)).st_dev)
+    if fcntl is None or devices in _no_reflink:
+        return shutil.copy2(src, dst)
+    try:
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            fcntl.ioctl(fdst.fileno(), _FICLONE, fsrc.fileno())
+    except OSError:
+        # most likely the filesystem does not support it, so do not try again there
+        _no_reflink.add(devices)
+        return shutil.copy2(src, dst)
+    shutil.copystat(src, dst)
+    return dst
+
+
+# how each file of a recipe is staged into the folder of a node
+_stage_functions = {'copy': shutil.copy2, 'link': _link_file, 'reflink': _reflink_file}
+
+
+def _stage_recipe(recipe_dir, out_folder, squished_variants, clobber_sections_file=None,
+                  append_sections_file=None, stage_mode='copy'):
+    """ Put a copy of recipe_dir with the variant of a node into out_folder """
+    if os.path.isdir(out_folder):
+        shutil.rmtree(out_folder)
+
+    try:
+        shutil.copytree(recipe_dir, out_folder, copy_function=_stage_functions[stage_mode])
+    except: # noqa
+        os.system("cp -Rf '{}' '{}'".format(recipe_dir, out_folder))
+
+    # the files written for this node must not be links to the files of the recipe
+    node_files = {'conda_build_config.yaml': None,
+                  'recipe_clobber.yaml': clobber_sections_file,
+                  'recipe_append.yaml': append_sections_file}
+    for fn in node_files:
+        if os.path.lexists(os.path.join(out_folder, fn)):
+            os.remove(os.path.join(out_folder, fn))
+
+    # write the conda_build_config.yml for this particular metadata into that recipe
+    #   This should sit alongside meta.yaml, where conda-build will be able to find it
+    with open(os.path.join(out_folder, 'conda_build_config.yaml'), 'w') as f:
+        yaml.dump(squished_variants, f, default_flow_style=False)
+
+    # copy any clobber or append file that is specified either on CLI or via condarc
+    for fn, src in node_files.items():
+        if src:
+            shutil.copyfile(src, os.path.join(out_folder, fn))
+
+
+def write_recipes(task_graph, path, output_dir, clobber_sections_file=None,
+                  append_sections_file=None, stage_mode='copy'):
+    """ Copy the recipe of each node in the task graph into a folder of output_dir.
+
+    The variant of the node is written alongside its meta.yaml, and the order in which
+    the nodes are built on each worker label to output_order_<label> files.  With a
+    stage_mode of 'link' or 'reflink', the files of the recipe are hardlinked or reflinked
+    rather than copied, where the filesystem allows.  The recipes are staged in parallel.
+    """
+    if stage_mode not in _stage_functions:
+        raise ValueError("Unknown stage mode {}, expected one of {}".format(
+            stage_mode, ', '.join(sorted(_stage_functions))))
     # expand folders to include any dependency builds or tests
     if not os.path.isabs(path):
         path = os.path.normpath(os.path.join(os.getcwd(), path))
+    os.makedirs(output_dir, exist_ok=True)
     for fn in glob.glob(os.path.join(output_dir, 'output_order*')):
         os.remove(fn)
     last_recipe_dir = None
     nodes = list(nx.topological_sort(task_graph))
     nodes.reverse()
-    for node in nodes:
-        meta = task_graph.nodes[node]['meta']
-        if meta.meta_path:
-            recipe = os.path.dirname(meta.meta_path)
-        else:
-            recipe = meta.meta.get('extra', {}).get('parent_recipe', {}).get('path', '')
-        assert recipe, ("no parent recipe set, and no path associated "
-                                "with this metadata")
-        # make recipe path relative
-        recipe = recipe.replace(path + '/', '')
-        # copy base recipe into a folder named for this node
-        out_folder = os.path.join(output_dir, node)
-        if os.path.isdir(out_folder):
-            shutil.rmtree(out_folder)
-
-        try:
-            shutil.copytree(os.path.join(path, recipe), out_folder)
-        except: # noqa
-            os.system("cp -Rf '{}' '{}'".format(os.path.join(path, recipe), out_folder))
-
-        # write the conda_build_config.yml for this particular metadata into that recipe
-        #   This should sit alongside meta.yaml, where conda-build will be able to find it
-        with open(os.path.join(out_folder, 'conda_build_config.yaml'), 'w') as f:
-            yaml.dump(meta.config.squished_variants, f, default_flow_style=False)
-
-        # copy any clobber or append file that is specified either on CLI or via condarc
-        if clobber_sections_file:
-            shutil.copyfile(clobber_sections_file, os.path.join(out_folder, 'recipe_clobber.yaml'))
-
-        if append_sections_file:
-            shutil.copyfile(append_sections_file, os.path.join(out_folder, 'recipe_append.yaml'))
-
-        order_fn = 'output_order_' + task_graph.nodes[node]['worker']['label']
-        with open(os.path.join(output_dir, order_fn), 'a') as f:
-            f.write(node + '\n')
-        recipe_dir = os.path.dirname(recipe) if os.sep in recipe else recipe
-        if not last_recipe_dir or last_recipe_dir != recipe_dir:
-            order_recipes_fn = 'output_order_recipes_' + task_graph.nodes[node]['worker']['label']
-            with open(os.path.join(output_dir, order_recipes_fn), 'a') as f:
-                f.write(recipe_dir + '\n')
-            last_recipe_dir = recipe_dir
+    with ThreadPoolExecutor() as executor:
+        staged = []
+        for node in nodes:
+            meta = node_record(task_graph.nodes[node]['meta'])
+            recipe = meta.recipe_dir
+            assert recipe, ("no parent recipe set, and no path associated "
+                                    "with this metadata")
+            # make recipe path relative
+            recipe = recipe.replace(path + '/', '')
+            # copy base recipe into a folder named for this node
+            staged.append(executor.submit(
+                _stage_recipe, os.path.join(path, recipe), os.path.join(output_dir, node),
+                meta.squished_variants, clobber_sections_file=clobber_sections_file,
+                append_sections_file=append_sections_file, stage_mode=stage_mode))
+
+            order_fn = 'output_order_' + task_graph.nodes[node]['worker']['label']
+            with open(os.path.join(output_dir, order_fn), 'a') as f:
+                f.write(node + '\n')
+            recipe_dir = os.path.dirname(recipe) if os.sep in recipe else recipe
+            if not last_recipe_dir or last_recipe_dir != recipe_dir:
+                order_recipes_fn = ('output_order_recipes_' +
+                                    task_graph.nodes[node]['worker']['label'])
+                with open(os.path.join(output_dir, order_recipes_fn), 'a') as f:
+                    f.write(recipe_dir + '\n')
+                last_recipe_dir = recipe_dir
+        for future in staged:
+            future.result()
 
     # clean up recipe_log.txt so that we don't leave a dirty git state
     for node in nodes:
-        meta = task_graph.nodes[node]['meta']
-        if meta.meta_path:
-            recipe = os.path.dirname(meta.meta_path)
-        else:
-            recipe = meta.meta.get('extra', {}).get('parent_recipe', {}).get('path', '')
+        recipe = node_record(task_graph.nodes[node]['meta']).recipe_dir
         if os.path.isfile(os.path.join(recipe, 'recipe_log.json')):
             os.remove(os.path.join(recipe, 'recipe_log.json'))
         if os.path.isfile(os.path.join(recipe, 'recipe_log.txt')):
@@ -813,6 +1022,67 @@ Overview:
     """.format(base_name))
 
 
+def compute_one_off(pipeline_label, recipe_root_dir, folders, config_root_dir, output_dir,
+                    pass_throughs=None, **kwargs):
+    """Compute the plan and recipes for a one-off job into output_dir.
+
+    This is entirely local; nothing is sent to the server.  Returns the number of
+    build jobs for each worker label in the plan.  The rendered recipes are kept for
+    the one-offs computed after it, as those of a batch share most of their recipes;
+    collect_tasks drops them when a one-off renders with another configuration.
+    """
+    config_overrides = {'base-name': pipeline_label}
+    config_root_dir = os.path.expanduser(config_root_dir)
+    kwargs['output_dir'] = output_dir
+    compute_builds(path=recipe_root_dir, base_name=pipeline_label, folders=folders,
+                   matrix_base_dir=config_root_dir, config_overrides=config_overrides,
+                   pass_throughs=pass_throughs, **kwargs)
+    return _jobs_per_label(output_dir)
+
+
+def _computed_shards(output_dir):
+    """ Return the pipeline labels of the shards computed into output_dir, if it was split """
+    return sorted(label for label in (os.path.basename(os.path.dirname(fn)) for fn in
+                                      glob.glob(os.path.join(output_dir, '*', 'plan.yml')))
+                  if _shard_label_re.match(label))
+
+
+def _remove_stale_plans(output_dir):
+    """ Remove the plans an earlier run computed into output_dir, whether split or not """
+    for fn in glob.glob(os.path.join(output_dir, 'output_order_*')) + [
+            os.path.join(output_dir, 'plan.yml')]:
+        if os.path.isfile(fn):
+            os.remove(fn)
+    for shard in _computed_shards(output_dir):
+        shutil.rmtree(os.path.join(output_dir, shard))
+
+
+def _jobs_per_label(output_dir):
+    """ Return the number of build jobs for each worker label in a computed plan """
+    jobs = {}
+    for shard in _computed_shards(output_dir):
+        for label, count in _jobs_per_label(os.path.join(output_dir, shard)).items():
+            jobs[label] = jobs.get(label, 0) + count
+    for fn in glob.glob(os.path.join(output_dir, 'output_order_*')):
+        label = os.path.basename(fn)[len('output_order_'):]
+        if label.startswith('recipes_'):
+            continue
+        with open(fn) as f:
+            jobs[label] = jobs.get(label, 0) + len([line for line in f if line.strip()])
+    return jobs
+
+
+def submit_computed_one_off(pipeline_label, config_root_dir, output_dir, pass_throughs=None,
+                            **kwargs):
+    """Submit a one-off job whose plan and recipes were computed into output_dir"""
+    config_overrides = {'base-name': pipeline_label}
+    config_root_dir = os.path.expanduser(config_root_dir)
+    kwargs.pop('output_dir', None)
+    submit(pipeline_file=os.path.join(output_dir, 'plan.yml'), base_name=pipeline_label,
+           pipeline_name=pipeline_label, src_dir=output_dir, config_root_dir=config_root_dir,
+           config_overrides=config_overrides, pass_throughs=pass_throughs, **kwargs)
+
+
 def submit_one_off(pipeline_label, recipe_root_dir, folders, config_root_dir, pass_throughs=None,
                    **kwargs):
     """A 'one-off' job is a submission of local recipes that use the concourse build workers.
@@ -830,67 +1100,311 @@ def submit_one_off(pipeline_label, recipe_root_dir, folders, config_root_dir, pa
     # the intermediate paths are set up for the configuration name.  With one-offs, we're ignoring
     #    the configuration's tie to a github repo.  What we should do is replace the base_name in
     #    the configuration locations with our pipeline label
-    config_overrides = {'base-name': pipeline_label}
-    config_root_dir = os.path.expanduser(config_root_dir)
     ctx = (contextlib.contextmanager(lambda: (yield kwargs.get('output_dir'))) if
            kwargs.get('output_dir') else TemporaryDirectory)
     with ctx() as tmpdir:
-        kwargs['output_dir'] = tmpdir
-        compute_builds(path=recipe_root_dir, base_name=pipeline_label, folders=folders,
-                       matrix_base_dir=config_root_dir, config_overrides=config_overrides,
-                       pass_throughs=pass_throughs, **kwargs)
+        kwargs.pop('output_dir', None)
+        compute_one_off(pipeline_label, recipe_root_dir, folders, config_root_dir, tmpdir,
+                        pass_throughs=pass_throughs, **kwargs)
         if kwargs.get("dry_run", False):
             print("!!! Dry run, pipeline not submitted to concourse")
             print(f"!!! Prepared plans and recipes stored in {tmpdir}")
+        elif _computed_shards(tmpdir):
+            # a plan split by --max-shard-jobs is submitted as one pipeline per shard
+            for shard in _computed_shards(tmpdir):
+                submit_computed_one_off(shard, config_root_dir, os.path.join(tmpdir, shard),
+                                        pass_throughs=pass_throughs, **kwargs)
         else:
-            submit(pipeline_file=os.path.join(tmpdir, 'plan.yml'), base_name=pipeline_label,
-                pipeline_name=pipeline_label, src_dir=tmpdir, config_root_dir=config_root_dir,
-                config_overrides=config_overrides, pass_throughs=pass_throughs, **kwargs)
+            submit_computed_one_off(pipeline_label, config_root_dir, tmpdir,
+                                    pass_throughs=pass_throughs, **kwargs)
+
+
+def _run_now(func, *args, **kwargs):
+    """ Call func immediately, returning a Future holding its outcome """
+    future = Future()
+    try:
+        future.set_result(func(*args, **kwargs))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def _platform_capacities(config_root_dir):
+    """ Return the capacity set for each worker label in build_platforms.d
+
+    Labels without a ``capacity`` entry are left out.
+    """
+    platforms = parse_platforms(config_root_dir, ['*'], _read_build_config_vars(config_root_dir))
+    return {platform['label']: int(platform['capacity'])
+            for platform in platforms if platform.get('capacity')}
+
+
+def _has_capacity(labels, running, capacities, default_capacity):
+    """ Whether every worker label needed has fewer running builds than it can take """
+    return all(running.get(label, 0) < capacities.get(label, default_capacity)
+               for label in labels)
+
+
+def _recipe_folder(meta, recipes_dir):
+    """ Return the top level folder in recipes_dir that a node's recipe lives in """
+    return os.path.relpath(node_record(meta).recipe_dir, recipes_dir).split(os.sep)[0]
+
+
+def _order_items_by_dependencies(batch_items, task_graph, recipes_dir):
+    """ Order batch items so each comes after the items it depends on.
+
+    Among the items whose dependencies are all placed, the one heading the longest
+    chain of dependent build jobs goes first, then the batch file order.  Returns the
+    ordered items and a dict of the items each item depends on.
+    """
+    item_for_folder = {}
+    for item in batch_items:
+        for folder in item.folders:
+            item_for_folder.setdefault(folder.rstrip('/'), item)
+    jobs = Counter()
+    item_graph = nx.DiGraph()
+    item_graph.add_nodes_from(batch_items)
+    node_items = {}
+    for node in task_graph.nodes():
+        item = item_for_folder.get(_recipe_folder(task_graph.nodes[node]['meta'], recipes_dir))
+        node_items[node] = item
+        if item is not None:
+            jobs[item] += 1
+    for node, dependency in task_graph.edges():
+        item, dep_item = node_items[node], node_items[dependency]
+        if item is not None and dep_item is not None and item is not dep_item:
+            item_graph.add_edge(item, dep_item)
+
+    # items depending on each other are submitted together, in batch file order
+    condensed = nx.condensation(item_graph)
+    members = condensed.graph['mapping']
+    position = {item: i for i, item in enumerate(batch_items)}
+    groups = {c: sorted(condensed.nodes[c]['members'], key=position.get) for c in condensed}
+    # length of the longest chain of jobs depending on each group, including its own
+    critical = {}
+    for c in nx.topological_sort(condensed):
+        critical[c] = (sum(max(jobs[item], 1) for item in groups[c]) +
+                       max((critical[p] for p in condensed.predecessors(c)), default=0))
+    ordered = []
+    waiting = {c: condensed.out_degree(c) for c in condensed}
+    ready = [c for c, n in waiting.items() if not n]
+    while ready:
+        ready.sort(key=lambda c: (-critical[c], position[groups[c][0]]))
+        c = ready.pop(0)
+        ordered.extend(groups[c])
+        for p in condensed.predecessors(c):
+            waiting[p] -= 1
+            if not waiting[p]:
+                ready.append(p)
+    depends_on = {item: {dep for dep in item_graph.successors(item)
+                         if members[dep] != members[item]}
+                  for item in batch_items}
+    return ordered, depends_on
+
+
+def order_batch_items(batch_items, recipe_root_dir, config_root_dir, channel=None,
+                      variant_config_files=None, platform_filters=None,
+                      clobber_sections_file=None, append_sections_file=None,
+                      pass_throughs=None, skip_existing=True, **kwargs):
+    """ Render the recipes of all batch items and order the items by their dependencies.
+
+    Only the batch-wide options are used for rendering; per-item overrides in the batch
+    file do not affect the order.
+    """
+    recipe_root_dir = os.path.abspath(os.path.expanduser(recipe_root_dir))
+    folders = [folder for item in batch_items for folder in item.folders]
+    task_graph = collect_tasks(
+        recipe_root_dir,
+        folders=folders,
+        matrix_base_dir=config_root_dir,
+        channels=channel or [],
+        variant_config_files=variant_config_files or [],
+        platform_filters=platform_filters,
+        clobber_sections_file=(clobber_sections_file or
+                               cc_conda_build.get('clobber_sections_file')),
+        append_sections_file=append_sections_file or cc_conda_build.get('append_sections_file'),
+        pass_throughs=pass_throughs,
+        skip_existing=skip_existing,
+        build_config_vars=_read_build_config_vars(config_root_dir),
+    )
+    return _order_items_by_dependencies(batch_items, task_graph, recipe_root_dir)
 
 
 def submit_batch(
         batch_file, recipe_root_dir, config_root_dir,
         max_builds, poll_time, build_lookback, label_prefix,
-        pass_throughs=None, **kwargs):
+        pass_throughs=None, precompute=2, order='alpha', checkpoint=None,
+        retries=3, retry_delay=60, **kwargs):
     """
     Submit a batch of 'one-off' jobs with controlled submission based on the
     number of running builds.
+
+    Plans are computed locally ahead of submission by `precompute` background
+    processes (or just before submission when it is 0), so only the submission
+    itself waits for free capacity on the server.
+
+    Capacity is tracked per worker label: an item is submitted once every label its
+    plan uses has fewer running builds than the ``capacity`` of that platform in
+    build_platforms.d, or `max_builds` for platforms without one.  An item waiting
+    for a busy platform does not hold back computed items that need other platforms.
+
+    With `order` 'deps', the recipes of all items are rendered first and items are
+    submitted only after the items they depend on, longest chain of dependent jobs
+    first.  The default 'alpha' submits items in sorted batch file order.
+
+    Items which fail are retried up to `retries` times, waiting `retry_delay` seconds
+    before the first retry and twice as long before each following one.  When a
+    `checkpoint` file is given, the status of every item is recorded there as the
+    batch progresses, and a rerun with the same file skips the items already
+    submitted.  The failures of earlier runs count towards `retries`.
     """
     with open(batch_file) as f:
         batch_lines = sorted([line for line in f])
         batch_items = [BatchItem(line) for line in batch_lines]
 
-    config_path = os.path.expanduser(os.path.join(config_root_dir, 'config.yml'))
+    config_root_dir = os.path.expanduser(config_root_dir)
+    state = BatchCheckpoint(checkpoint)
+    submitted_before = [item for item in batch_items if state.status(item) == 'submitted']
+    if submitted_before:
+        print("Skipping {} jobs submitted by an earlier run".format(len(submitted_before)))
+    attempts = Counter({item: state.attempts(item) for item in batch_items})
+    failed_before = [item for item in batch_items
+                     if item not in submitted_before and attempts[item] > retries]
+    if failed_before:
+        print("Skipping {} jobs which failed too often in earlier runs".format(
+            len(failed_before)))
+    depends_on = {}
+    if order == 'deps':
+        batch_items, depends_on = order_batch_items(
+            batch_items, recipe_root_dir, config_root_dir, pass_throughs=pass_throughs,
+            **kwargs)
+    config_path = os.path.join(config_root_dir, 'config.yml')
     with open(config_path) as src:
         data = yaml.safe_load(src)
 
-    concourse_url = data['concourse-url']
+    tracker = ActiveBuildTracker(data['concourse-url'], lookback=build_lookback)
+    capacities = _platform_capacities(config_root_dir)
 
     success = []
-    failed = []
-    while len(batch_items):
-        num_activate_builds = _get_activate_builds(concourse_url, build_lookback)
-        if num_activate_builds < max_builds:
-            # use a try/except block here so a single failed one-off does not
-            # break the batch
-            try:
-                batch_item = batch_items.pop(0)
+    failed = list(failed_before)
+    finished = set(submitted_before + failed_before)
+    # labels of pipelines submitted recently enough that their builds may not have
+    # started yet
+    recently_submitted = []
+    position = {item: index for index, item in enumerate(batch_items)}
+    pending = deque((position[item], item) for item in batch_items if item not in finished)
+    # (time, position, item) of the failed items waiting to be retried
+    delayed = []
+    retrying = set()
+    computing = deque()
+    pool = ProcessPoolExecutor(max_workers=precompute) if precompute > 0 else None
+    # plans are kept if an output folder was requested, otherwise they go to a temporary one
+    keep_output = bool(kwargs.get('output_dir'))
+    ctx = (contextlib.contextmanager(lambda: (yield kwargs['output_dir'])) if
+           keep_output else TemporaryDirectory)
+    try:
+        with ctx() as workdir:
+            while pending or computing or delayed:
+                # retries go ahead of the other items once their wait is over
+                due = []
+                while delayed and delayed[0][0] <= time.time():
+                    due.append(heapq.heappop(delayed)[1:])
+                pending.extendleft(reversed(due))
+                retrying.update(item for _, item in due)
+                # keep the background workers busy with the plans of upcoming items
+                while pending and (len(computing) < max(1, 2 * precompute) or
+                                   pending[0][1] in retrying):
+                    index, batch_item = pending.popleft()
+                    retrying.discard(batch_item)
+                    pipeline_label = batch_item.get_label(label_prefix)
+                    output_dir = os.path.join(workdir, '{}-{}'.format(index, pipeline_label))
+                    extra = kwargs.copy()
+                    extra.update(batch_item.item_kwargs)
+                    args = (pipeline_label, recipe_root_dir, batch_item.folders, config_root_dir)
+                    kw = dict(extra, output_dir=output_dir, pass_throughs=pass_throughs)
+                    if (keep_output and state.status(batch_item) == 'computed' and
+                            os.path.isfile(os.path.join(output_dir, 'plan.yml'))):
+                        # computed by an earlier run
+                        future = _run_now(_jobs_per_label, output_dir)
+                    elif pool:
+                        future = pool.submit(compute_one_off, *args, **kw)
+                    else:
+                        future = _run_now(compute_one_off, *args, **kw)
+                    computing.append((batch_item, pipeline_label, output_dir, extra, future))
+
+                # submit the first computed item whose platforms have free capacity
+                ready = None
+                running = None
+                for entry in computing:
+                    future = entry[-1]
+                    if not future.done():
+                        continue
+                    if future.exception() is None and state.status(entry[0]) != 'computed':
+                        state.update(entry[0], 'computed', pipeline=entry[1])
+                    if not depends_on.get(entry[0], set()) <= finished:
+                        continue
+                    if future.exception() is not None:
+                        ready = entry
+                        break
+                    if running is None:
+                        now = time.time()
+                        recently_submitted = [(t, labels) for t, labels in recently_submitted
+                                              if now - t < poll_time]
+                        running = _get_active_builds(tracker)
+                        for _, labels in recently_submitted:
+                            running.update(labels)
+                    if _has_capacity(future.result(), running, capacities, max_builds):
+                        ready = entry
+                        break
+                if ready is None:
+                    computing_futures = [entry[-1] for entry in computing
+                                         if not entry[-1].done()]
+                    next_retry = delayed[0][0] - time.time() if delayed else None
+                    if running is not None:
+                        print("Too many active builds:", dict(running))
+                        time.sleep(tracker.next_interval(poll_time))
+                    elif computing_futures:
+                        wait(computing_futures, timeout=next_retry,
+                             return_when=FIRST_COMPLETED)
+                    elif next_retry is not None:
+                        time.sleep(max(0, next_retry))
+                    continue
+
+                computing.remove(ready)
+                batch_item, pipeline_label, output_dir, extra, future = ready
                 print("Starting build for:", batch_item)
-
-                pipeline_label = batch_item.get_label(label_prefix)
-                extra = kwargs.copy()
-                extra.update(batch_item.item_kwargs)
-                submit_one_off(pipeline_label, recipe_root_dir, batch_item.folders,
-                               config_root_dir, pass_throughs=pass_throughs, **extra)
-                print("Success", batch_item)
-                success.append(batch_item)
-            except Exception as e:
-                print("Fail", batch_item)
-                print("Exception was:", e)
-                failed.append(batch_item)
-        else:
-            print("Too many active builds:", num_activate_builds)
-        time.sleep(poll_time)
+                # use a try/except block here so a single failed one-off does not
+                # break the batch
+                try:
+                    labels = future.result()
+                    submit_computed_one_off(pipeline_label, config_root_dir, output_dir,
+                                            pass_throughs=pass_throughs, **extra)
+                    recently_submitted.append((time.time(), list(labels)))
+                    state.update(batch_item, 'submitted', pipeline=pipeline_label)
+                    print("Success", batch_item)
+                    success.append(batch_item)
+                    finished.add(batch_item)
+                except Exception as e:
+                    attempts[batch_item] += 1
+                    print("Fail", batch_item)
+                    print("Exception was:", e)
+                    if attempts[batch_item] <= retries:
+                        delay = retry_delay * 2 ** (attempts[batch_item] - 1)
+                        print("Retrying in {} seconds".format(delay))
+                        heapq.heappush(delayed, (time.time() + delay, position[batch_item],
+                                                 batch_item))
+                    else:
+                        failed.append(batch_item)
+                        finished.add(batch_item)
+                    state.update(batch_item, 'failed', error=str(e),
+                                 attempts=attempts[batch_item])
+                if not keep_output:
+                    shutil.rmtree(output_dir, ignore_errors=True)
+    finally:
+        if pool:
+            for entry in computing:
+                entry[-1].cancel()
+            pool.shutdown()
 
     print("one-off jobs submitted:", len(success))
     if len(failed):
@@ -916,6 +1430,7 @@ class BatchItem(object):
             item_kwargs = {}
         self.folders = folders_str.split()
         self.item_kwargs = item_kwargs
+        self.line = line.strip()
 
     def get_label(self, prefix):
         return prefix + self.folders[0].rsplit('-', 1)[0]
@@ -924,110 +1439,40 @@ class BatchItem(object):
         return ' '.join(self.folders)
 
 
-def _get_activate_builds(concourse_url, limit):
-    """ Return the number of active builds on the server. """
-    url = requests.compat.urljoin(concourse_url, 'api/v1/builds')
-    r = requests.get(url, params={'limit': limit})
-    all_items = r.json()
-    if len(all_items) < 5:
-        raise ValueError("Something wrong")
-    running = [i for i in all_items if i['status'] == 'started']
-    return len(running)
+class BatchCheckpoint(object):
+    """ Status of the items of a batch, saved to a JSON file after every change.
 
+    Items are keyed by their line in the batch file.  Their status is one of
+    'pending', 'computed', 'submitted' or 'failed'; the pipeline created and the
+    last error are recorded along with it.  Without a path nothing is saved.
+    """
 
-def rm_pipeline(pipeline_names, config_root_dir, do_it_dammit=False, pass_throughs=None, days=None, **kwargs):
-    con = _ensure_login_and_sync(config_root_dir)
-    pipelines_to_remove = _filter_existing_pipelines(con, pipeline_names)
-    if days:
-        pipelines_to_remove = _filter_pipelines_by_time(con, pipelines_to_remove, int(days))
-    print("Removing pipelines:")
-    for p in pipelines_to_remove:
-        print(p)
-    if not do_it_dammit:
-        confirmation = input("Confirm [y]/n: ") or 'y'
-    else:
-        print("YOLO! removing all listed pipelines")
-    if do_it_dammit or confirmation == 'y':
-        # make sure we have aborted all pipelines and their jobs ...
-        abort_pipeline(pipelines_to_remove, config_root_dir)
-        # remove the specified pipelines
-        for pipeline_name in pipelines_to_remove:
-            con.destroy_pipeline(pipeline_name)
-    else:
-        print("aborted")
+    def __init__(self, path=None):
+        self.path = path
+        self.items = load_json(path) if path else {}
 
+    def status(self, item):
+        return self.items.get(item.line, {}).get('status', 'pending')
 
-def pause_pipeline(pipeline_names, config_root_dir, do_it_dammit=False, pass_throughs=None, **kwargs):
-    con = _ensure_login_and_sync(config_root_dir)
-    pipelines_to_pause = _filter_existing_pipelines(con, pipeline_names)
-    print("Pausing pipelines:")
-    for p in pipelines_to_pause:
-        print(p)
-    if not do_it_dammit:
-        confirmation = input("Confirm [y]/n: ") or 'y'
-    else:
-        print("YOLO! pausing all listed pipelines")
-    if do_it_dammit or confirmation == 'y':
-        # make sure we have aborted all pipelines and their jobs ...
-        abort_pipeline(pipelines_to_pause, config_root_dir)
-        # pause the specified pipelines
-        for pipeline_name in pipelines_to_pause:
-            con.pause_pipeline(pipeline_name)
-    else:
-        print("aborted")
+    def attempts(self, item):
+        return self.items.get(item.line, {}).get('attempts', 0)
 
+    def update(self, item, status, **info):
+        entry = self.items.setdefault(item.line, {})
+        entry.update(info, status=status, updated=time.time())
+        if status != 'failed':
+            entry.pop('error', None)
+        if self.path:
+            save_json(self.path, self.items)
 
-def unpause_pipeline(pipeline_names, config_root_dir, do_it_dammit=False, pass_throughs=None, **kwargs):
-    con = _ensure_login_and_sync(config_root_dir)
-    pipelines_to_unpause = _filter_existing_pipelines(con, pipeline_names)
-    print("Unpausing pipelines:")
-    for p in pipelines_to_unpause:
-        print(p)
-    if not do_it_dammit:
-        confirmation = input("Confirm [y]/n: ") or 'y'
-    else:
-        print("YOLO! unpausing all listed pipelines")
-    if do_it_dammit or confirmation == 'y':
-        # unpause the specified pipelines
-        for pipeline_name in pipelines_to_unpause:
-            con.unpause_pipeline(pipeline_name)
-    else:
-        print("aborted")
 
+def _label_from_job_name(job_name):
+    """ Return the worker label a build job runs on, or None for other jobs """
+    if job_name and '-on-' in job_name:
+        return job_name.rsplit('-on-', 1)[1]
+    return None
 
-def trigger_pipeline(pipeline_names, config_root_dir, trigger_all=False, **kwargs):
-    con = _ensure_login_and_sync(config_root_dir)
-    pipelines_to_trigger = _filter_existing_pipelines(con, pipeline_names)
-    print("Triggering jobs:")
-    for pipeline in pipelines_to_trigger:
-        for job in con.get_jobs(pipeline):
-            if trigger_all:
-                print(f"{pipeline}/{job['name']}")
-                con.trigger_job(pipeline, job['name'])
-                continue
-            if job["next_build"]:  # next build has already been triggered
-                continue
-            status = job.get('finished_build', {})
-            if status:
-                status = job.get('status', 'n/a')
-            else:
-                status = 'n/a'
-            if any(sub in job.get('name') for sub in [
-                    'stage_for_upload',
-                    'push_branch_to',
-                    'destroy_pipeline']):
-                continue
-            if status != 'succeeded':
-                print(f"{pipeline}/{job['name']}")
-                con.trigger_job(pipeline, job['name'])
-
-
-def abort_pipeline(pipeline_names, config_root_dir, **kwargs):
-    con = _ensure_login_and_sync(config_root_dir)
-    pipelines_to_abort = _filter_existing_pipelines(con, pipeline_names)
-    print("Aborting pipelines:")
-    for pipeline in pipelines_to_abort:
-        for job in con.get_builds(pipeline):
-            if job["status"] == "started":
-                print(f"{pipeline}/{job['job_name']}")
-                con.abort_build(pipeline, job["job_name"], job["name"])
+
+def _get_active_builds(tracker):
+    """ Return the number of active builds on the server for each worker label. """
+    return Counter(_label_from_job_name(build.get('job_name')) for build in tracker.poll())
@@ -0,0 +1,275 @@
+"""
+Management of the pipelines on a Concourse server: removing, pausing,
+unpausing, triggering and aborting them.
+
+This module is kept free of conda-build imports so that these commands start
+quickly.
+"""
+import logging
+import os
+import time
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from fnmatch import fnmatch
+
+import yaml
+
+from .concourse import BACKENDS
+from .utils import cache_dir, ensure_list, load_json, save_json
+
+log = logging.getLogger(__file__)
+
+
+# Concourse objects by config.yml path, reused for the rest of the process
+_sessions = {}
+
+
+def _ensure_login_and_sync(config_root_dir):
+    """
+    Return Concourse object after logging in and syncing the fly version.
+
+    The object is kept for the rest of the process.  Login only happens when no valid token
+    is held, and fly is only synced when its version differs from the server's.  The server
+    version is cached for `fly-version-cache-ttl` seconds (config.yml, default 3600).
+    """
+    config_path = os.path.abspath(
+        os.path.expanduser(os.path.join(config_root_dir, 'config.yml')))
+    with open(config_path) as src:
+        config_vars = yaml.safe_load(src)
+    con = _sessions.get(config_path)
+    if con is None:
+        backend = config_vars.get('concourse-backend', 'fly')
+        if backend not in BACKENDS:
+            raise ValueError("Unknown concourse-backend {}, choose one of: {}".format(
+                backend, ', '.join(sorted(BACKENDS))))
+        con = BACKENDS[backend](
+            concourse_url=config_vars['concourse-url'],
+            username=config_vars.get('concourse-username'),
+            password=config_vars.get('concourse-password'),
+            team_name=config_vars.get('concourse-team'),
+        )
+        _sessions[config_path] = con
+    con.ensure_login()
+    con.sync_if_needed(os.path.join(cache_dir(), 'fly_versions.json'),
+                       int(config_vars.get('fly-version-cache-ttl', 3600)))
+    return con
+
+
+def _filter_existing_pipelines(con, pipeline_patterns):
+    """Iterate over the list of existing pipelines and filter out those which
+    match any pattern in the given list (passed as an argument to this
+    function). This function can be called before performing bulk operations on
+    pipelines.
+    """
+    pipelines = con.pipelines
+    filtered_pipelines = []
+    for pattern in ensure_list(pipeline_patterns):
+        filtered_pipelines.extend([p for p in pipelines if fnmatch(p, pattern)])
+    return filtered_pipelines
+
+
+def _build_time(build):
+    """ Return the time of the last activity of a build, None if it never started """
+    timestamp = build.get('end_time') or build.get('start_time')
+    if timestamp is None:
+        # pending builds count as activity now
+        return time.time() if build.get('status') == 'pending' else None
+    return timestamp
+
+
+def _last_activity(con, pipeline, page_size=10):
+    """ Return the time of the most recent activity of a pipeline, None if there was none
+
+    The newest builds which never started, such as builds aborted while pending, are
+    passed over, so only when none of the first page_size builds has a time are all
+    builds of the pipeline requested.
+    """
+    builds = con.get_builds(pipeline, limit=page_size)
+    if len(builds) >= page_size and all(_build_time(build) is None for build in builds):
+        builds = con.get_builds(pipeline)
+    times = (_build_time(build) for build in builds)
+    return next((timestamp for timestamp in times if timestamp is not None), None)
+
+
+def _filter_pipelines_by_time(con, pipelines, days, parallel=8, cache_ttl=900):
+    """
+    Will return pipelines that are older than the number of days specified.
+
+    Only the newest builds of each pipeline are requested, `parallel` pipelines at a time.
+    Last activity times are cached per server.  A cached time newer than the cutoff is
+    conclusive (activity can only get more recent), so those pipelines are not queried
+    again.  Pipelines are only removed based on a time looked up in the last `cache_ttl`
+    seconds.  Pipelines which have never run a build are kept.
+    """
+    now = time.time()
+    cutoff = now - days * 24 * 60 * 60
+    cache_path = os.path.join(cache_dir(), 'pipeline_activity.json')
+    cache = load_json(cache_path)
+    server_cache = cache.setdefault(con.concourse_url, {})
+
+    to_query = []
+    for pipeline in pipelines:
+        checked, last_activity = server_cache.get(pipeline, (0, None))
+        recent = last_activity is not None and last_activity > cutoff
+        if not recent and now - checked > cache_ttl:
+            to_query.append(pipeline)
+    for pipeline, last_activity in zip(
+            to_query, _map_concurrently(lambda p: _last_activity(con, p), to_query, parallel)):
+        server_cache[pipeline] = (now, last_activity)
+    save_json(cache_path, cache)
+
+    filtered_pipelines = []
+    for pipeline in pipelines:
+        last_activity = server_cache[pipeline][1]
+        if last_activity is None:
+            log.info("pipeline %s has no builds, keeping it", pipeline)
+        elif last_activity < cutoff:
+            filtered_pipelines.append(pipeline)
+    return filtered_pipelines
+
+
+def _run_concurrently(func, items, parallel, describe=str):
+    """Call func(item) for each item on a pool of at most `parallel` threads.
+
+    Progress is printed as each call completes.  All items are attempted even if some
+    fail; a RuntimeError summarizing the failures is raised at the end.
+    """
+    items = list(items)
+    failures = []
+    with ThreadPoolExecutor(max_workers=max(1, int(parallel or 1))) as pool:
+        futures = {pool.submit(func, item): item for item in items}
+        for count, future in enumerate(as_completed(futures), 1):
+            item = futures[future]
+            try:
+                future.result()
+                print("[{}/{}] {}".format(count, len(items), describe(item)))
+            except Exception as e:
+                print("[{}/{}] FAILED {}: {}".format(count, len(items), describe(item), e))
+                failures.append(item)
+    if failures:
+        raise RuntimeError("{} of {} operations failed: {}".format(
+            len(failures), len(items), ', '.join(describe(item) for item in failures)))
+
+
+def _map_concurrently(func, items, parallel):
+    """ Return [func(item) for item in items], evaluated on a pool of threads """
+    with ThreadPoolExecutor(max_workers=max(1, int(parallel or 1))) as pool:
+        return list(pool.map(func, items))
+
+
+def _abort_builds(con, pipelines, parallel=8):
+    """ Abort all running builds of the given pipelines """
+    all_builds = _map_concurrently(con.get_builds, pipelines, parallel)
+    to_abort = [(pipeline, build['job_name'], build['name'])
+                for pipeline, builds in zip(pipelines, all_builds)
+                for build in builds if build['status'] == 'started']
+    _run_concurrently(lambda build: con.abort_build(*build), to_abort, parallel,
+                      describe=lambda build: "aborted {}/{} #{}".format(*build))
+
+
+def rm_pipeline(pipeline_names, config_root_dir, do_it_dammit=False, pass_throughs=None,
+                days=None, parallel=8, activity_cache_ttl=900, **kwargs):
+    con = _ensure_login_and_sync(config_root_dir)
+    pipelines_to_remove = _filter_existing_pipelines(con, pipeline_names)
+    if days:
+        pipelines_to_remove = _filter_pipelines_by_time(
+            con, pipelines_to_remove, int(days), parallel=parallel,
+            cache_ttl=activity_cache_ttl)
+    print("Removing pipelines:")
+    for p in pipelines_to_remove:
+        print(p)
+    if not do_it_dammit:
+        confirmation = input("Confirm [y]/n: ") or 'y'
+    else:
+        print("YOLO! removing all listed pipelines")
+    if do_it_dammit or confirmation == 'y':
+        # make sure we have aborted all pipelines and their jobs ...
+        _abort_builds(con, pipelines_to_remove, parallel)
+        # remove the specified pipelines
+        _run_concurrently(con.destroy_pipeline, pipelines_to_remove, parallel,
+                          describe="removed {}".format)
+    else:
+        print("aborted")
+
+
+def pause_pipeline(pipeline_names, config_root_dir, do_it_dammit=False, pass_throughs=None,
+                   parallel=8, **kwargs):
+    con = _ensure_login_and_sync(config_root_dir)
+    pipelines_to_pause = _filter_existing_pipelines(con, pipeline_names)
+    print("Pausing pipelines:")
+    for p in pipelines_to_pause:
+        print(p)
+    if not do_it_dammit:
+        confirmation = input("Confirm [y]/n: ") or 'y'
+    else:
+        print("YOLO! pausing all listed pipelines")
+    if do_it_dammit or confirmation == 'y':
+        # make sure we have aborted all pipelines and their jobs ...
+        _abort_builds(con, pipelines_to_pause, parallel)
+        # pause the specified pipelines
+        _run_concurrently(con.pause_pipeline, pipelines_to_pause, parallel,
+                          describe="paused {}".format)
+    else:
+        print("aborted")
+
+
+def unpause_pipeline(pipeline_names, config_root_dir, do_it_dammit=False, pass_throughs=None,
+                     parallel=8, **kwargs):
+    con = _ensure_login_and_sync(config_root_dir)
+    pipelines_to_unpause = _filter_existing_pipelines(con, pipeline_names)
+    print("Unpausing pipelines:")
+    for p in pipelines_to_unpause:
+        print(p)
+    if not do_it_dammit:
+        confirmation = input("Confirm [y]/n: ") or 'y'
+    else:
+        print("YOLO! unpausing all listed pipelines")
+    if do_it_dammit or confirmation == 'y':
+        # unpause the specified pipelines
+        _run_concurrently(con.unpause_pipeline, pipelines_to_unpause, parallel,
+                          describe="unpaused {}".format)
+    else:
+        print("aborted")
+
+
+def _jobs_to_trigger(jobs, trigger_all=False):
+    """ Return the names of the jobs which should be (re)triggered """
+    names = []
+    for job in jobs:
+        if trigger_all:
+            names.append(job['name'])
+            continue
+        if job["next_build"]:  # next build has already been triggered
+            continue
+        status = job.get('finished_build', {})
+        if status:
+            status = job.get('status', 'n/a')
+        else:
+            status = 'n/a'
+        if any(sub in job.get('name') for sub in [
+                'stage_for_upload',
+                'push_branch_to',
+                'destroy_pipeline']):
+            continue
+        if status != 'succeeded':
+            names.append(job['name'])
+    return names
+
+
+def trigger_pipeline(pipeline_names, config_root_dir, trigger_all=False, parallel=8, **kwargs):
+    con = _ensure_login_and_sync(config_root_dir)
+    pipelines_to_trigger = _filter_existing_pipelines(con, pipeline_names)
+    print("Triggering jobs:")
+    all_jobs = _map_concurrently(con.get_jobs, pipelines_to_trigger, parallel)
+    to_trigger = [(pipeline, name)
+                  for pipeline, jobs in zip(pipelines_to_trigger, all_jobs)
+                  for name in _jobs_to_trigger(jobs, trigger_all)]
+    _run_concurrently(lambda job: con.trigger_job(*job), to_trigger, parallel,
+                      describe=lambda job: "{}/{}".format(*job))
+
+
+def abort_pipeline(pipeline_names, config_root_dir, parallel=8, **kwargs):
+    con = _ensure_login_and_sync(config_root_dir)
+    pipelines_to_abort = _filter_existing_pipelines(con, pipeline_names)
+    print("Aborting pipelines:")
+    _abort_builds(con, pipelines_to_abort, parallel)
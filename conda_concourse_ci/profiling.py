@@ -0,0 +1,201 @@
+"""
+Timing of the phases of c3i commands.
+
+The code marks its phases with ``profiling.phase(name)``, which does nothing
+until profiling is enabled with :func:`enable`.  Then the wall time, CPU time
+and memory high-water mark of each phase are recorded, summed over all the
+times the phase runs, and optionally a cProfile of each phase is collected.
+
+Independently of that, the hot paths always update a registry of counters and
+timers (:func:`count`, :func:`timer`, :func:`counted` and :func:`timed`), such as
+render cache hits and misses, resolve queries and calls of fly, git, ssh and
+rsync.  It is cheap enough to leave on, is part of the profile report, and is
+written to the file named by the C3I_METRICS environment variable at exit.
+"""
+import atexit
+import cProfile
+import functools
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    # not available on Windows
+    resource = None
+
+_profiler = None
+
+_metrics_lock = threading.Lock()
+_counters = Counter()
+_timers = defaultdict(float)
+
+
+def _max_rss_mb():
+    """ The memory high-water mark of this process in MB, None if unknown """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss / (1024.0 * 1024.0) if sys.platform == 'darwin' else rss / 1024.0
+
+
+class Profiler(object):
+    """ Records the time spent in each phase of a command
+
+    Parameters
+    ----------
+    cprofile_dir : str, optional
+        Folder to write a cProfile dump of each phase to, as <phase>.prof.
+        cProfile only covers the outermost phase running at any time.
+
+    """
+
+    def __init__(self, cprofile_dir=None):
+        self.cprofile_dir = cprofile_dir
+        self.phases = OrderedDict()
+        self._profiles = {}
+        self._active = []
+        self.start = time.time()
+        self.start_cpu = time.process_time()
+
+    @contextmanager
+    def phase(self, name):
+        stats = self.phases.setdefault(name, {'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                                              'max_rss_mb': None, 'rss_growth_mb': 0.0})
+        profile = None
+        if self.cprofile_dir and not self._active:
+            profile = self._profiles.setdefault(name, cProfile.Profile())
+        self._active.append(name)
+        rss_before = _max_rss_mb()
+        start, start_cpu = time.time(), time.process_time()
+        if profile:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile:
+                profile.disable()
+            stats['calls'] += 1
+            stats['wall'] += time.time() - start
+            stats['cpu'] += time.process_time() - start_cpu
+            rss_after = _max_rss_mb()
+            if rss_after is not None:
+                stats['max_rss_mb'] = rss_after
+                stats['rss_growth_mb'] += rss_after - rss_before
+            self._active.pop()
+
+    def report(self):
+        return {
+            'wall': time.time() - self.start,
+            'cpu': time.process_time() - self.start_cpu,
+            'max_rss_mb': _max_rss_mb(),
+            'phases': self.phases,
+            'metrics': metrics(),
+        }
+
+    def write(self, path):
+        """ Write the report to path as JSON, and the cProfile dumps if requested """
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        if self.cprofile_dir:
+            os.makedirs(self.cprofile_dir, exist_ok=True)
+            for name, profile in self._profiles.items():
+                profile.dump_stats(os.path.join(self.cprofile_dir,
+                                                name.replace(' ', '_') + '.prof'))
+
+
+def enable(cprofile_dir=None):
+    """ Start recording phases, returning the Profiler which records them """
+    global _profiler
+    _profiler = Profiler(cprofile_dir)
+    return _profiler
+
+
+def disable():
+    global _profiler
+    _profiler = None
+
+
+@contextmanager
+def _no_phase():
+    yield
+
+
+def phase(name):
+    """ Context manager marking a phase of a command, recorded when profiling is enabled """
+    if _profiler is None:
+        return _no_phase()
+    return _profiler.phase(name)
+
+
+def count(name, n=1):
+    """ Add n to the counter called name """
+    with _metrics_lock:
+        _counters[name] += n
+
+
+@contextmanager
+def timer(name):
+    """ Context manager counting the calls of name and the seconds spent in them """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        with _metrics_lock:
+            _counters[name] += 1
+            _timers[name] += elapsed
+
+
+def counted(name):
+    """ Decorator counting the calls of a function """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            count(name)
+            return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def timed(name):
+    """ Decorator counting the calls of a function and the seconds spent in them """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def metrics():
+    """ The counters, and the calls and seconds of the timers, sorted by name """
+    with _metrics_lock:
+        return {
+            'counters': {name: _counters[name] for name in sorted(_counters)
+                         if name not in _timers},
+            'timers': {name: {'calls': _counters[name], 'seconds': _timers[name]}
+                       for name in sorted(_timers)},
+        }
+
+
+def reset_metrics():
+    with _metrics_lock:
+        _counters.clear()
+        _timers.clear()
+
+
+def write_metrics(path):
+    with open(path, 'w') as f:
+        json.dump(metrics(), f, indent=2)
+
+
+if os.environ.get('C3I_METRICS'):
+    atexit.register(write_metrics, os.environ['C3I_METRICS'])
@@ -0,0 +1,169 @@
+"""
+A long running c3i process which examines recipes on request.
+
+Each run of c3i examine imports conda-build, fetches the channel indexes and
+renders all of its recipes.  ``c3i serve`` does that once and keeps the results
+in memory: c3i examine sends its work to the server listening on the socket
+when there is one, and the server renders again only the recipes which changed
+on disk since the last request.
+
+Only the server imports conda-build, so that sending work to it is quick.
+"""
+import io
+import json
+import logging
+import os
+import socket
+import socketserver
+import sys
+import traceback
+from contextlib import redirect_stdout
+
+DEFAULT_SOCKET = os.path.join(os.path.expanduser('~'), '.c3i', 'serve.sock')
+
+# arguments of examine which do not change how the recipes are rendered
+_per_request_args = ('base_name', 'debug', 'dedup_plan', 'folders', 'git_rev',
+                     'group_by_feedstock', 'max_downstream', 'output_dir', 'public',
+                     'stage_mode', 'steps', 'stop_rev', 'subparser_name', 'worker_tags')
+
+log = logging.getLogger(__file__)
+
+
+class ServerError(Exception):
+    """ The server failed to run a request """
+
+
+def _connect(socket_path):
+    """ Return a socket connected to the server at socket_path, None if none listens there """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        sock.close()
+        return None
+    return sock
+
+
+def forward(command, kwargs, socket_path=DEFAULT_SOCKET):
+    """ Run command on the server at socket_path, printing its output as it comes
+
+    Returns False if no server listens on socket_path.  Raises ServerError when the
+    command failed on the server.
+    """
+    sock = _connect(socket_path)
+    if sock is None:
+        return False
+    with sock, sock.makefile('rw') as stream:
+        stream.write(json.dumps({'command': command, 'cwd': os.getcwd(),
+                                 'kwargs': kwargs}) + '\n')
+        stream.flush()
+        for line in stream:
+            message = json.loads(line)
+            if 'output' in message:
+                sys.stdout.write(message['output'])
+                sys.stdout.flush()
+            else:
+                if message['error']:
+                    raise ServerError(message['error'])
+                return True
+    raise ServerError("the c3i server closed the connection before finishing")
+
+
+class _Output(io.TextIOBase):
+    """ Text stream which sends everything written to it to the client """
+
+    def __init__(self, send):
+        self.send = send
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if text:
+            self.send({'output': text})
+        return len(text)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+
+    def send(self, message):
+        self.wfile.write((json.dumps(message) + '\n').encode())
+
+    def handle(self):
+        request = json.loads(self.rfile.readline())
+        error = None
+        try:
+            with redirect_stdout(_Output(self.send)):
+                self.server.run(request)
+        except (Exception, SystemExit):
+            error = traceback.format_exc()
+            log.error(error)
+        self.send({'error': error})
+
+
+class Server(socketserver.UnixStreamServer):
+    """ Examines recipes on request, keeping the indexes and rendered recipes in memory
+
+    Parameters
+    ----------
+    socket_path : str
+        Path of the unix socket to listen on.
+    index_ttl : int, optional
+        Number of seconds for which a channel index is reused before it is fetched again.
+
+    """
+
+    def __init__(self, socket_path, index_ttl=300):
+        # importing these is much of the time that examine takes
+        from conda_build.conda_interface import cc_conda_build
+        from . import compute_build_graph, execute
+        compute_build_graph.track_recipe_changes = True
+        self.cc_conda_build = cc_conda_build
+        self.compute_build_graph = compute_build_graph
+        self.execute = execute
+        self.index_ttl = index_ttl
+        self.render_key = None
+        super(Server, self).__init__(socket_path, _Handler)
+        os.chmod(socket_path, 0o600)
+
+    def run(self, request):
+        if request['command'] != 'examine':
+            raise ValueError("The c3i server cannot run {}".format(request['command']))
+        os.chdir(request['cwd'])
+        kwargs = dict(request['kwargs'])
+        if kwargs.get('matrix_base_dir') is None:
+            kwargs['matrix_base_dir'] = self.cc_conda_build.get('matrix_base_dir')
+        # renders of other recipe repositories or arguments can not be reused.  Those for
+        # changed variant or platform files are dropped by collect_tasks, for each platform
+        render_key = json.dumps([request['cwd'], {key: value for key, value in kwargs.items()
+                                                  if key not in _per_request_args}],
+                                sort_keys=True)
+        if render_key != self.render_key:
+            self.compute_build_graph.forget_renders()
+            self.render_key = render_key
+        else:
+            stale = self.compute_build_graph.forget_stale_renders()
+            if stale:
+                log.info("recipes changed since the last request: %s", ', '.join(sorted(stale)))
+        self.execute.compute_builds(index_ttl=self.index_ttl, **kwargs)
+
+
+def serve(socket_path=DEFAULT_SOCKET, index_ttl=300, **kw):
+    """ Examine recipes on request of c3i examine, until interrupted """
+    if os.path.exists(socket_path):
+        sock = _connect(socket_path)
+        if sock is not None:
+            sock.close()
+            raise ValueError("A c3i server is already listening on {}".format(socket_path))
+        # left behind by a server which did not shut down cleanly
+        os.remove(socket_path)
+    os.makedirs(os.path.dirname(os.path.abspath(socket_path)), exist_ok=True)
+    server = Server(socket_path, index_ttl=index_ttl)
+    print("c3i server listening on {}".format(socket_path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
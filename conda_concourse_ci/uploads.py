@@ -10,10 +10,9 @@ to run additional tasks (for example, to update the index on the remote side)
 import logging
 import os
 
-from conda_build import api
-
 from six.moves.urllib import parse
 
+from .compute_build_graph import node_record
 from .utils import ensure_list, load_yaml_config_dir
 
 log = logging.getLogger(__file__)
@@ -155,12 +154,12 @@ def upload_commands(package_path, commands, config_vars, **file_contents):
 
 def get_upload_tasks(graph, node, upload_config_path, config_vars, commit_id, public=True):
     upload_tasks = []
-    meta = graph.nodes[node]['meta']
+    meta = node_record(graph.nodes[node]['meta'], output_paths=True)
     worker = graph.nodes[node]['worker']
     configurations = load_yaml_config_dir(upload_config_path)
-    for package in api.get_output_file_paths(meta):
+    for package in meta.output_paths:
         filename = os.path.basename(package)
-        package_path = os.path.join('output-artifacts', commit_id, meta.config.host_subdir,
+        package_path = os.path.join('output-artifacts', commit_id, meta.host_subdir,
                                     filename)
         for config in configurations:
             if 'token' in config:
@@ -1,11 +1,11 @@
 import fnmatch
+import json
 import os
 
 import six
 
 import yaml
 
-from conda_build.utils import HashableDict  # NOQA
 from jinja2 import Environment, FileSystemLoader
 
 
@@ -18,6 +18,31 @@ def ensure_list(arg):
     return arg
 
 
+def cache_dir(*parts):
+    """ Return (and create) a folder in the c3i cache, $C3I_CACHE_DIR or ~/.cache/c3i """
+    base = os.environ.get('C3I_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'c3i')
+    path = os.path.join(base, *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def load_json(path):
+    """ Return the data saved by save_json, or an empty dict if there is none """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, IOError, ValueError):
+        return {}
+
+
+def save_json(path, data):
+    """ Write data to path as JSON, replacing the file only once it is complete """
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
 def load_yaml_config_dir(platforms_dir, platform_filters, build_config_vars):
     platforms = []
     # for f in os.listdir(platforms_dir):
@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+
+import yaml
+
+from conda_concourse_ci.concourse_config import PipelineConfig
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+benchmarks_dir = os.path.join(root_dir, 'benchmarks')
+sys.path.insert(0, benchmarks_dir)
+
+from synthetic_repo import generate_repo  # NOQA
+
+
+def test_synthetic_config_has_plan_settings(tmpdir):
+    repo = generate_repo(str(tmpdir), feedstocks=3, variants=1)
+    with open(os.path.join(repo['config_dir'], 'config.yml')) as f:
+        config_vars = yaml.safe_load(f)
+    plconfig = PipelineConfig()
+    plconfig.add_rsync_recipes(config_vars, '/ci/bench/plan_and_recipes')
+    plconfig.add_rsync_source(config_vars)
+    plconfig.add_rsync_stats(config_vars)
+    plconfig.add_rsync_build_pack(config_vars)
+    assert len(plconfig.resources) == 4
+
+
+def test_run_benchmarks(tmpdir):
+    # the runs are made in fresh interpreters, which must find this checkout
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [root_dir] + [p for p in os.environ.get('PYTHONPATH', '').split(os.pathsep) if p]))
+    output = subprocess.check_output(
+        [sys.executable, os.path.join(benchmarks_dir, 'run_benchmarks.py'), '--feedstocks', '3',
+         '--variants', '1', '--repeat', '1', '--no-save'],
+        cwd=str(tmpdir), env=env, universal_newlines=True)
+    assert 'run 1/1' in output
+    assert 'graph_to_plan_with_jobs' in output
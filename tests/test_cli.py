@@ -1,9 +1,11 @@
 import logging
 import os
+import subprocess
+import sys
 
 import pytest
 
-from conda_concourse_ci import cli
+from conda_concourse_ci import cli, execute, pipelines
 
 
 def test_argparse_input():
@@ -13,10 +15,10 @@ def test_argparse_input():
 
 
 def test_submit(mocker):
-    mocker.patch.object(cli.execute, 'submit')
+    mocker.patch.object(execute, 'submit')
     args = ['submit', 'frank']
     cli.main(args)
-    cli.execute.submit.assert_called_once_with(base_name='frank', config_root_dir='frank',
+    execute.submit.assert_called_once_with(base_name='frank', config_root_dir='frank',
                                                debug=False, pipeline_file='plan_director.yml',
                                                pipeline_name='{base_name} plan director',
                                                public=True, src_dir=os.getcwd(),
@@ -24,10 +26,10 @@ def test_submit(mocker):
 
 
 def test_submit_one_off(mocker):
-    mocker.patch.object(cli.execute, 'submit_one_off')
+    mocker.patch.object(execute, 'submit_one_off')
     args = ['one-off', 'frank', 'bzip2', '--config-root-dir', '../config']
     cli.main(args)
-    cli.execute.submit_one_off.assert_called_once_with(
+    execute.submit_one_off.assert_called_once_with(
         pipeline_label='frank',
         config_root_dir=mocker.ANY,
         debug=False,
@@ -46,6 +48,10 @@ def test_submit_one_off(mocker):
         append_sections_file=None,
         pass_throughs=[],
         skip_existing=True,
+        dedup_plan=False,
+        group_by_feedstock=False,
+        stage_mode='copy',
+        max_shard_jobs=None,
         use_repo_access=False,
         use_staging_channel=False,
         automated_pipeline=False,
@@ -61,10 +67,10 @@ def test_submit_one_off(mocker):
 
 
 def test_submit_batch(mocker):
-    mocker.patch.object(cli.execute, 'submit_batch')
+    mocker.patch.object(execute, 'submit_batch')
     args = ['batch', 'batch_file.txt', '--config-root-dir', '../config']
     cli.main(args)
-    cli.execute.submit_batch.assert_called_once_with(
+    execute.submit_batch.assert_called_once_with(
         batch_file='batch_file.txt',
         recipe_root_dir=os.getcwd(),
         config_root_dir=mocker.ANY,
@@ -72,6 +78,11 @@ def test_submit_batch(mocker):
         poll_time=120,
         build_lookback=500,
         label_prefix='autobot_',
+        precompute=2,
+        order='alpha',
+        checkpoint=None,
+        retries=3,
+        retry_delay=60,
         debug=False,
         public=True,
         subparser_name='batch',
@@ -82,6 +93,9 @@ def test_submit_batch(mocker):
         worker_tags=None,
         clobber_sections_file=None,
         append_sections_file=None,
+        dedup_plan=False,
+        group_by_feedstock=False,
+        stage_mode='copy',
         use_repo_access=False,
         use_staging_channel=False,
         pass_throughs=[],
@@ -96,10 +110,10 @@ def test_submit_without_base_name_raises():
 
 
 def test_bootstrap(mocker):
-    mocker.patch.object(cli.execute, 'bootstrap')
+    mocker.patch.object(execute, 'bootstrap')
     args = ['bootstrap', 'frank']
     cli.main(args)
-    cli.execute.bootstrap.assert_called_once_with(base_name='frank', debug=False,
+    execute.bootstrap.assert_called_once_with(base_name='frank', debug=False,
                                                   subparser_name='bootstrap', pass_throughs=[])
 
 
@@ -118,7 +132,7 @@ def test_examine_without_base_name_raises():
 # not sure what the right syntax for this is yet.  TODO.
 @pytest.mark.xfail
 def test_logger_sets_debug_level(mocker):
-    mocker.patch.object(cli.execute, 'submit')
+    mocker.patch.object(execute, 'submit')
     cli.main(['--debug', 'submit', 'frank'])
     assert logging.getLogger().isEnabledFor(logging.DEBUG)
 
@@ -126,3 +140,29 @@ def test_logger_sets_debug_level(mocker):
 def test_bad_command_raises():
     with pytest.raises(SystemExit):
         cli.main(['llama'])
+
+
+def test_rm(mocker):
+    mocker.patch.object(pipelines, 'rm_pipeline')
+    cli.main(['rm', 'frank-*', '--config-root-dir', '../config', '-y'])
+    pipelines.rm_pipeline.assert_called_once_with(
+        pipeline_names=['frank-*'], config_root_dir='../config', do_it_dammit=True,
+        days=None, parallel=8, activity_cache_ttl=900, debug=False, subparser_name='rm',
+        pass_throughs=[])
+
+
+def test_pipeline_commands_start_without_conda_build():
+    # conda-build, networkx and the build graph code take seconds to import, and are not
+    #    needed to manage pipelines
+    code = '; '.join([
+        "import sys, time",
+        "start = time.time()",
+        "from conda_concourse_ci import cli, pipelines",
+        "cli.parse_args(['pause', 'frank', '--config-root-dir', '.'])",
+        "print(time.time() - start)",
+        "print(' '.join(sorted(m for m in sys.modules if m.split('.')[0] in "
+        "('conda', 'conda_build', 'networkx') or m == 'conda_concourse_ci.execute')))",
+    ])
+    out = subprocess.check_output([sys.executable, '-c', code]).decode().splitlines()
+    assert out[1:] == [''] or len(out) == 1
+    assert float(out[0]) < 1.5
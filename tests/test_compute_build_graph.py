@@ -1,4 +1,5 @@
 import os
+from types import SimpleNamespace
 
 from conda_build.metadata import MetaData
 from conda_build.api import Config
@@ -48,6 +49,25 @@ def test_package_key(testing_metadata):
             'c3itest-test_package_key-1.0-python_3.6-on-linux')
 
 
+def test_node_record(testing_metadata):
+    testing_metadata.config.channel_urls = ['conda_build_test']
+    testing_metadata.meta['extra'] = {'worker_tags': 'gpu'}
+    record = compute_build_graph.node_record(testing_metadata)
+    assert not hasattr(record, '__dict__')
+    assert record.name == 'test_node_record'
+    assert record.version == '1.0'
+    assert record.host_subdir == testing_metadata.config.host_subdir
+    assert record.channel_urls == ('conda_build_test',)
+    assert record.worker_tags == ['gpu']
+    assert record.output_paths is None
+    assert (compute_build_graph.package_key(record, 'linux') ==
+            compute_build_graph.package_key(testing_metadata, 'linux'))
+    # a record is its own record, but output paths can not be added to it later
+    assert compute_build_graph.node_record(record) is record
+    with pytest.raises(ValueError):
+        compute_build_graph.node_record(record, output_paths=True)
+
+
 def test_platform_specific_graph(mocker, testing_conda_resolve):
     """the recipes herein have selectors on dependencies.  We're making sure they work correctly.
 
@@ -294,6 +314,23 @@ def test_order_build(testing_graph):
     assert order.index('c3itest-c-on-linux') > order.index('b-on-linux')
 
 
+def test_shard_graph():
+    g = nx.DiGraph()
+    nx.add_path(g, ['a', 'b', 'c', 'd'])
+    nx.add_path(g, ['e', 'f'])
+    nx.add_path(g, ['g', 'h'])
+    g.add_node('i')
+    assert compute_build_graph.shard_graph(g, 4) == [['a', 'b', 'c', 'd'],
+                                                     ['e', 'f', 'g', 'h'],
+                                                     ['i']]
+    # components are never split
+    assert compute_build_graph.shard_graph(g, 3) == [['a', 'b', 'c', 'd'],
+                                                     ['e', 'f', 'i'],
+                                                     ['g', 'h']]
+    assert compute_build_graph.shard_graph(g, 10) == [['a', 'b', 'c', 'd', 'e', 'f', 'g', 'h',
+                                                      'i']]
+
+
 def test_get_base_folders(testing_workdir):
     make_recipe('some_recipe')
     os.makedirs('not_a_recipe')
@@ -404,3 +441,125 @@ def test_version_matching(testing_conda_resolve):
     assert len(g.nodes()) == 4
     assert ('downstream-1.0-upstream_1.0-on-linux', 'upstream-1.0.1-on-linux') in g.edges()
     assert ('downstream-1.0-upstream_2.0-on-linux', 'upstream-2.0.2-on-linux') in g.edges()
+
+
+def test_forget_stale_renders(tmpdir):
+    changed, unchanged = tmpdir.mkdir('changed'), tmpdir.mkdir('unchanged')
+    unchanged.join('recipe_log.txt').write('commit 1')
+    for recipe in (changed, unchanged):
+        recipe.join('meta.yaml').write('package: {name: x}')
+        compute_build_graph._render_stamps[str(recipe)] = \
+            compute_build_graph._recipe_stamp(str(recipe))
+        compute_build_graph._rendered_recipes[(str(recipe), 'linux', 'linux', '64')] = []
+    try:
+        # c3i removes and writes the recipe log itself, that does not invalidate the render
+        unchanged.join('recipe_log.txt').remove()
+        os.utime(str(unchanged), ns=(0, 2 ** 62))
+        unchanged.join('recipe_log.txt').write('commit 2')
+        os.utime(str(unchanged.join('recipe_log.txt')), ns=(0, 2 ** 62))
+        changed.join('build.sh').write('make')
+        os.utime(str(changed.join('build.sh')), ns=(0, 2 ** 62))
+
+        assert compute_build_graph.forget_stale_renders() == {str(changed)}
+        assert list(compute_build_graph._rendered_recipes) == [
+            (str(unchanged), 'linux', 'linux', '64')]
+        assert compute_build_graph.forget_stale_renders() == set()
+    finally:
+        compute_build_graph.forget_renders()
+
+
+def test_renders_reused_for_unchanged_recipes(testing_git_repo, tmpdir):
+    cache_dir = str(tmpdir.join('cache'))
+    recipes_dir = os.getcwd()
+    keys = [(os.path.join(recipes_dir, folder), 'linux', 'linux', '64')
+            for folder in ('test_dir_1', 'test_dir_2', 'test_dir_3')]
+    compute_build_graph.forget_renders()
+    try:
+        for key in keys:
+            compute_build_graph._rendered_recipes[key] = [key[0]]
+        compute_build_graph.save_renders(cache_dir, recipes_dir, 'abc', 'linux')
+        assert len(os.listdir(cache_dir)) == 1
+        compute_build_graph.forget_renders()
+
+        with open(os.path.join('test_dir_2', 'meta.yaml'), 'a') as f:
+            f.write('\n# changed\n')
+        # written by c3i when rendering, it does not count as a change
+        with open(os.path.join('test_dir_3', 'recipe_log.txt'), 'w') as f:
+            f.write('commit 4')
+        assert compute_build_graph.load_renders(cache_dir, recipes_dir, 'abc', 'linux') == 2
+        assert sorted(compute_build_graph._rendered_recipes) == [keys[0], keys[2]]
+        assert compute_build_graph._rendered_recipes[keys[0]] == [keys[0][0]]
+
+        # renders of other configurations are not reused
+        compute_build_graph.forget_renders()
+        assert compute_build_graph.load_renders(cache_dir, recipes_dir, 'def', 'linux') == 0
+    finally:
+        compute_build_graph.forget_renders()
+
+
+def test_is_package_built_uses_index(mocker):
+    def record(subdir, name, channel='defaults'):
+        return SimpleNamespace(subdir=subdir, name=name, version='1.0', build='h1_0',
+                               channel=SimpleNamespace(canonical_name=channel))
+
+    def metadata(name, subdir='linux-64'):
+        return SimpleNamespace(name=lambda: name, version=lambda: '1.0', build_id=lambda: 'h1_0',
+                               config=SimpleNamespace(host_subdir=subdir))
+
+    class Resolve(object):
+        def __init__(self, records):
+            self.index = {i: r for i, r in enumerate(records)}
+
+    conda_resolve = Resolve([record('linux-64', 'a'), record('noarch', 'b'),
+                             record('linux-64', 'c', 'local')])
+    is_package_built = mocker.patch.object(compute_build_graph, 'is_package_built',
+                                           return_value=True)
+
+    assert compute_build_graph._is_package_built(metadata('a'), conda_resolve)
+    assert compute_build_graph._is_package_built(metadata('b'), conda_resolve)
+    # packages in the local channel do not count
+    assert not compute_build_graph._is_package_built(metadata('c'), conda_resolve)
+    assert not compute_build_graph._is_package_built(metadata('d'), conda_resolve)
+    assert not is_package_built.called
+    # other subdirs are looked up by conda-build
+    assert compute_build_graph._is_package_built(metadata('d', 'linux-aarch64'), conda_resolve)
+    is_package_built.assert_called_once_with(mocker.ANY, 'host', include_local=False)
+
+
+def test_scan_recipe():
+    scan = compute_build_graph.scan_recipe(os.path.join(graph_data_dir, 'e'))
+    assert scan == compute_build_graph.RecipeScan({'e'}, {'b', 'd'}, True)
+    # compilers are only known after rendering
+    scan = compute_build_graph.scan_recipe(os.path.join(test_data_dir,
+                                                        'win_split_outputs_compiler_reduction'))
+    assert 'postgresql-split' in scan.names
+    assert 'openssl' in scan.requirements
+    assert not scan.complete
+
+
+def test_dependent_folders():
+    graph = nx.DiGraph()
+    graph.add_node('a-on-linux', meta=SimpleNamespace(
+        meta_path=os.path.join(graph_data_dir, 'a', 'meta.yaml'), name=lambda: 'a'))
+    conda_resolve = SimpleNamespace(find_matches=lambda ms: [ms])
+    folders = ['a', 'b', 'c', 'd', 'e']
+    assert compute_build_graph._dependent_folders(
+        graph, graph_data_dir, folders, 0, conda_resolve) == ['a']
+    assert compute_build_graph._dependent_folders(
+        graph, graph_data_dir, folders, 1, conda_resolve) == ['a', 'b', 'c']
+    assert compute_build_graph._dependent_folders(
+        graph, graph_data_dir, folders, -1, conda_resolve) == folders
+
+
+def test_render_cache_evicts_least_recently_used():
+    cache = compute_build_graph.RenderCache(max_entries=2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache['a'] == 1
+    cache['c'] = 3
+    assert list(cache) == ['a', 'c']
+    assert 'b' not in cache
+    unlimited = compute_build_graph.RenderCache()
+    for key in range(100):
+        unlimited[key] = key
+    assert len(unlimited) == 100
@@ -0,0 +1,239 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+import pytest
+
+from conda_concourse_ci import concourse
+from conda_concourse_ci.concourse import ActiveBuildTracker, Concourse, ConcourseAPI
+
+
+class FakeConcourseHandler(BaseHTTPRequestHandler):
+    """ Serves just enough of the Concourse API for the client to be tested """
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=None):
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _handle(self, method):
+        server = self.server
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        server.requests.append((method, self.path))
+        if self.path == '/sky/issuer/token':
+            server.logins += 1
+            return self._reply(200, {'access_token': 'token-%d' % server.logins,
+                                     'token_type': 'bearer', 'expires_in': 3600})
+        if self.path.startswith('/api/v1/builds?'):
+            return self._reply(200, server.builds_handler(self.path))
+        if self.headers.get('Authorization') != 'Bearer token-%d' % server.logins:
+            return self._reply(401)
+        if server.expire_next:
+            server.expire_next = False
+            return self._reply(401)
+        team = '/api/v1/teams/main'
+        routes = {
+            ('GET', team + '/pipelines'): [{'name': 'one'}, {'name': 'two'}],
+            ('GET', team + '/pipelines/one/jobs'): [{'name': 'job', 'next_build': None}],
+            ('GET', team + '/pipelines/one/builds'): [{'id': 7, 'name': '3',
+                                                       'job_name': 'job',
+                                                       'status': 'started'}],
+            ('GET', team + '/pipelines/one/jobs/job/builds/3'): {'id': 7, 'name': '3'},
+        }
+        if (method, self.path) in routes:
+            return self._reply(200, routes[(method, self.path)])
+        return self._reply(200 if method != 'GET' else 404)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+
+@pytest.fixture(scope='function')
+def fake_concourse(request):
+    server = HTTPServer(('127.0.0.1', 0), FakeConcourseHandler)
+    server.requests = []
+    server.logins = 0
+    server.expire_next = False
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def shutdown():
+        server.shutdown()
+        server.server_close()
+
+    request.addfinalizer(shutdown)
+    return server
+
+
+def _client(server):
+    return ConcourseAPI('http://127.0.0.1:%d' % server.server_address[1], 'user', 'pass')
+
+
+def test_api_logs_in_once_and_reuses_token(fake_concourse):
+    con = _client(fake_concourse)
+    assert con.pipelines == ['one', 'two']
+    assert con.get_jobs('one') == [{'name': 'job', 'next_build': None}]
+    assert con.get_builds('one')[0]['status'] == 'started'
+    assert fake_concourse.logins == 1
+
+
+def test_api_relogin_on_rejected_token(fake_concourse):
+    con = _client(fake_concourse)
+    con.login()
+    fake_concourse.expire_next = True
+    assert con.pipelines == ['one', 'two']
+    assert fake_concourse.logins == 2
+
+
+def test_api_concurrent_rejections_log_in_once(fake_concourse):
+    con = _client(fake_concourse)
+    con.login()
+    # a token which the server does not accept anymore, but which has not yet expired
+    con._token = 'stale'
+    con.session.headers['Authorization'] = 'Bearer stale'
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(con.pipelines))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [['one', 'two']] * 8
+    assert fake_concourse.logins == 2
+
+
+def test_api_pipeline_operations(fake_concourse):
+    con = _client(fake_concourse)
+    con.pause_pipeline('one')
+    con.unpause_pipeline('one')
+    con.expose_pipeline('one')
+    con.trigger_job('one', 'job')
+    con.abort_build('one', 'job', '3')
+    con.destroy_pipeline('one')
+    team = '/api/v1/teams/main/pipelines/one'
+    assert [r for r in fake_concourse.requests if r[1] != '/sky/issuer/token'] == [
+        ('PUT', team + '/pause'),
+        ('PUT', team + '/unpause'),
+        ('PUT', team + '/expose'),
+        ('POST', team + '/jobs/job/builds'),
+        ('GET', team + '/jobs/job/builds/3'),
+        ('PUT', '/api/v1/builds/7/abort'),
+        ('DELETE', team),
+    ]
+
+
+def test_api_set_pipeline_uses_fly(mocker, fake_concourse):
+    fly = mocker.patch.object(ConcourseAPI, '_fly')
+    con = _client(fake_concourse)
+    con.set_pipeline('one', 'plan.yml', 'config.yml')
+    con.set_pipeline('two', 'plan.yml', 'config.yml')
+    commands = [call[0][0][0] for call in fly.call_args_list]
+    # fly is logged in and synced only once
+    assert commands == ['status', 'login', 'sync', 'set-pipeline', 'set-pipeline']
+
+
+def test_fly_session_reuse(mocker, tmpdir):
+    fly = mocker.patch.object(Concourse, '_fly')
+    fly.return_value.returncode = 0
+    fly.return_value.stdout = b'7.4.0\n'
+    mocker.patch.object(Concourse, 'server_version', return_value='7.4.0')
+    cache_path = str(tmpdir.join('versions.json'))
+    con = Concourse('http://reuse', target='reuse')
+    con.ensure_login()
+    con.sync_if_needed(cache_path)
+    # logged in and versions match: neither login nor sync
+    assert [call[0][0][0] for call in fly.call_args_list] == ['status', '--version']
+
+    # the version is checked only once per process
+    fly.reset_mock()
+    con.sync_if_needed(cache_path)
+    fly.assert_not_called()
+
+    # and the server version is cached across processes
+    concourse._synced_targets.clear()
+    fly.return_value.stdout = b'7.5.0\n'
+    fly.return_value.returncode = 1
+    con.ensure_login()
+    con.sync_if_needed(cache_path)
+    Concourse.server_version.assert_called_once_with()
+    assert [call[0][0][0] for call in fly.call_args_list] == [
+        'status', 'login', '--version', 'sync']
+
+
+def _concourse_builds_page(builds, path):
+    """ A page of builds as /api/v1/builds returns it: newest first, from and to inclusive """
+    params = dict(parse_qsl(urlparse(path).query))
+    limit = int(params['limit'])
+    newest_first = sorted(builds.values(), key=lambda b: b['id'], reverse=True)
+    if 'from' in params:
+        oldest_first = [b for b in reversed(newest_first) if b['id'] >= int(params['from'])]
+        return list(reversed(oldest_first[:limit]))
+    if 'to' in params:
+        newest_first = [b for b in newest_first if b['id'] <= int(params['to'])]
+    return newest_first[:limit]
+
+
+def test_active_build_tracker_polls_incrementally(fake_concourse):
+    builds = {
+        1: {'id': 1, 'job_name': 'a-on-linux', 'status': 'succeeded'},
+        2: {'id': 2, 'job_name': 'b-on-linux', 'status': 'started'},
+        3: {'id': 3, 'job_name': 'c-on-win', 'status': 'started'},
+    }
+
+    fake_concourse.builds_handler = lambda path: _concourse_builds_page(builds, path)
+    tracker = ActiveBuildTracker('http://127.0.0.1:%d' % fake_concourse.server_address[1],
+                                 lookback=10, page_size=2)
+    assert sorted(b['id'] for b in tracker.poll()) == [2, 3]
+
+    builds[2]['status'] = 'succeeded'
+    builds[4] = {'id': 4, 'job_name': 'd-on-linux', 'status': 'pending'}
+    builds[5] = {'id': 5, 'job_name': 'e-on-linux', 'status': 'started'}
+    assert sorted(b['id'] for b in tracker.poll()) == [3, 5]
+    assert sorted(tracker.in_flight) == [3, 4, 5]
+    assert tracker.finish_rate > 0
+    assert tracker.next_interval(120) <= 120
+
+    builds.pop(3)
+    builds[4]['status'] = 'started'
+    assert sorted(b['id'] for b in tracker.poll()) == [4, 5]
+    queries = [path for method, path in fake_concourse.requests
+               if path.startswith('/api/v1/builds?')]
+    # only the first poll looks back; later ones start at the oldest build in flight
+    assert queries == [
+        '/api/v1/builds?limit=10',
+        '/api/v1/builds?from=2&limit=2',
+        '/api/v1/builds?from=4&limit=2',
+        '/api/v1/builds?from=6&limit=2',
+        '/api/v1/builds?from=3&limit=2',
+        '/api/v1/builds?from=6&limit=2',
+    ]
+
+
+def test_active_build_tracker_stops_when_from_is_ignored(fake_concourse):
+    builds = {i: {'id': i, 'job_name': 'a-on-linux', 'status': 'started'} for i in range(1, 6)}
+    # a server which does not know from returns the newest builds every time
+    fake_concourse.builds_handler = lambda path: _concourse_builds_page(
+        builds, path.replace('from=', 'ignored='))
+    tracker = ActiveBuildTracker('http://127.0.0.1:%d' % fake_concourse.server_address[1],
+                                 lookback=2, page_size=2)
+    assert sorted(b['id'] for b in tracker.poll()) == [4, 5]
+    builds[6] = {'id': 6, 'job_name': 'a-on-linux', 'status': 'started'}
+    assert sorted(b['id'] for b in tracker.poll()) == [5, 6]
@@ -1,10 +1,18 @@
+import glob
+import io
+import json
 import os
+import re
 import subprocess
+from collections import Counter
 
 from conda_concourse_ci import execute
+from conda_concourse_ci.compute_build_graph import NodeRecord
 import conda_concourse_ci
-from conda_concourse_ci.utils import HashableDict
 
+from conda_build.utils import HashableDict
+
+import networkx as nx
 import pytest
 import yaml
 
@@ -61,6 +69,80 @@ def test_graph_to_plan_with_jobs(mocker, testing_graph):
     assert len(pipeline.jobs) == 3
 
 
+def test_graph_to_plan_serial_groups_follow_capacity(testing_graph):
+    with open(os.path.join(test_config_dir, 'config.yml')) as f:
+        config_vars = yaml.safe_load(f)
+    worker = dict(testing_graph.nodes['a-on-linux']['worker'], capacity='2')
+    for node in testing_graph.nodes():
+        testing_graph.nodes[node]['worker'] = worker
+    pipeline = execute.graph_to_plan_with_jobs(graph_data_dir, testing_graph, 'abc123',
+                                               test_config_dir, config_vars)
+    groups = [job['serial_groups'] for job in pipeline.jobs]
+    # three jobs, spread round-robin over two serial groups
+    assert groups == [['linux-0'], ['linux-1'], ['linux-0']]
+
+
+def test_write_plan_matches_yaml_dump(testing_graph, tmpdir):
+    with open(os.path.join(test_config_dir, 'config.yml')) as f:
+        config_vars = yaml.safe_load(f)
+    # both upload jobs get the same artifacts, which yaml writes with anchors
+    config_vars.update({'anaconda-upload-token': 'abc', 'repo-username': 'frank',
+                        'repo-token': 'abc', 'repo-password': 'weee', 'repo-channel': 'main'})
+    pipeline = execute.graph_to_plan_with_jobs(graph_data_dir, testing_graph, 'abc123',
+                                               test_config_dir, config_vars)
+    execute.write_plan(pipeline, str(tmpdir))
+    with open(str(tmpdir.join('plan.yml'))) as f:
+        plan = f.read()
+    assert '&id001' in plan
+    assert plan == yaml.dump(pipeline.to_dict(), default_flow_style=False)
+
+
+def test_write_plan_dedup(testing_graph, tmpdir, capsys):
+    with open(os.path.join(test_config_dir, 'config.yml')) as f:
+        config_vars = yaml.safe_load(f)
+    pipeline = execute.graph_to_plan_with_jobs(graph_data_dir, testing_graph, 'abc123',
+                                               test_config_dir, config_vars)
+    full = yaml.dump(pipeline.to_dict(), default_flow_style=False)
+    execute.write_plan(pipeline, str(tmpdir), dedup=True)
+    with open(str(tmpdir.join('plan.yml'))) as f:
+        plan = f.read()
+    assert '*id001' in plan
+    assert len(plan) < len(full)
+    assert yaml.safe_load(plan) == yaml.safe_load(full)
+    assert '{} bytes less'.format(len(full) - len(plan)) in capsys.readouterr().out
+
+
+def test_pipeline_dump_checks_item_writer(mocker):
+    shared = {'source': {'repository': 'busybox', 'tag': 'latest'}}
+    pipeline = execute.PipelineConfig()
+    pipeline.add_resource_type('rsync-resource', 'docker-image', shared['source'])
+    pipeline.add_job('one', [{'get': 'rsync-recipes', 'params': shared}])
+    pipeline.add_job('two', [{'get': 'rsync-recipes', 'params': shared}])
+    full = yaml.dump(pipeline.to_dict(), default_flow_style=False)
+
+    mocker.patch.object(conda_concourse_ci.concourse_config, '_item_writer_checked', [])
+    assert conda_concourse_ci.concourse_config._item_writer_works()
+    stream = io.StringIO()
+    pipeline.dump(stream)
+    assert stream.getvalue() == full
+    assert yaml.safe_load(stream.getvalue()) == pipeline.to_dict()
+
+    # a PyYAML which quotes strings otherwise than expected is only used through yaml.dump
+    mocker.patch.object(conda_concourse_ci.concourse_config, '_item_writer_checked', [])
+    mocker.patch.object(conda_concourse_ci.concourse_config, '_double_quoted',
+                        re.compile('never matches$^'))
+    assert not conda_concourse_ci.concourse_config._item_writer_works()
+    write = mocker.patch.object(conda_concourse_ci.concourse_config, '_write_sections')
+    stream = io.StringIO()
+    pipeline.dump(stream)
+    assert stream.getvalue() == full
+    write.assert_not_called()
+
+
+def test_get_serial_groups_without_capacity():
+    assert execute.get_serial_groups({'label': 'linux'}, {}) is None
+
+
 def test_submit(mocker):
     mocker.patch.object(execute, 'subprocess')
     mocker.patch.object(conda_concourse_ci.concourse, 'subprocess')
@@ -89,26 +171,236 @@ def test_submit_one_off(mocker):
                                 '/ci/frank/plan_and_recipes')
                                ])])
 
+def test_compute_one_off_keeps_renders(mocker, tmpdir):
+    # the next one-off of a batch reuses them, e.g. those rendered to order the batch
+    key = (os.path.join(graph_data_dir, 'a'), 'centos5-64', 'linux', '64')
+    mocker.patch.object(execute, 'compute_builds')
+    mocker.patch.dict(execute.compute_build_graph._rendered_recipes, {key: []})
+    assert execute.compute_one_off('frank', graph_data_dir, ['a'], test_config_dir,
+                                   str(tmpdir)) == {}
+    assert key in execute.compute_build_graph._rendered_recipes
+
+
 @pytest.mark.serial
 def test_submit_batch(mocker):
     mocker.patch.object(execute, 'subprocess')
     mocker.patch.object(conda_concourse_ci.concourse, 'subprocess')
-    submit_one_off = mocker.patch.object(execute, 'submit_one_off')
-    get_activate_builds = mocker.patch.object(execute, '_get_activate_builds', return_value=3)
+    compute_one_off = mocker.patch.object(execute, 'compute_one_off',
+                                          return_value={'centos5-64': 2})
+    submit_computed = mocker.patch.object(execute, 'submit_computed_one_off')
+    get_active_builds = mocker.patch.object(execute, '_get_active_builds',
+                                            return_value=Counter({'centos5-64': 3}))
+    sleep = mocker.patch.object(execute.time, 'sleep')
 
     execute.submit_batch(
         os.path.join(test_data_dir, 'batch_sample.txt'),
         os.path.join(test_data_dir, 'one-off-recipes'),
         config_root_dir=test_config_dir,
-        max_builds=999, poll_time=0, build_lookback=500, label_prefix='sentinel_')
-    # submit_one_off should be called twice
-    submit_one_off.assert_has_calls([
-        mocker.call('sentinel_bzip', mocker.ANY, ['bzip'],
-                    mocker.ANY, pass_throughs=None, clobber_sections_file='example.yaml'),
-        mocker.call('sentinel_pytest', mocker.ANY, ['pytest', 'pytest-cov'],
-                    mocker.ANY, pass_throughs=None),
+        max_builds=999, poll_time=0, build_lookback=500, label_prefix='sentinel_',
+        precompute=0)
+    # both plans are computed and submitted
+    compute_one_off.assert_has_calls([
+        mocker.call('sentinel_bzip', mocker.ANY, ['bzip'], mocker.ANY, output_dir=mocker.ANY,
+                    pass_throughs=None, clobber_sections_file='example.yaml'),
+        mocker.call('sentinel_pytest', mocker.ANY, ['pytest', 'pytest-cov'], mocker.ANY,
+                    output_dir=mocker.ANY, pass_throughs=None),
     ])
-    get_activate_builds.assert_called()
+    submit_computed.assert_has_calls([
+        mocker.call('sentinel_bzip', mocker.ANY, mocker.ANY, pass_throughs=None,
+                    clobber_sections_file='example.yaml'),
+        mocker.call('sentinel_pytest', mocker.ANY, mocker.ANY, pass_throughs=None),
+    ])
+    get_active_builds.assert_called()
+    # there was capacity, so no waiting
+    sleep.assert_not_called()
+
+
+@pytest.mark.serial
+def test_submit_batch_waits_for_capacity(mocker):
+    # bzip builds on linux, pytest on windows
+    mocker.patch.object(execute, 'compute_one_off',
+                        side_effect=[{'centos5-64': 1}, {'win-32': 1}])
+    submit_computed = mocker.patch.object(execute, 'submit_computed_one_off')
+    mocker.patch.object(execute, '_platform_capacities', return_value={'win-32': 2})
+    busy_linux = Counter({'centos5-64': 6, 'win-32': 1})
+    mocker.patch.object(execute, '_get_active_builds',
+                        side_effect=[busy_linux, busy_linux, busy_linux,
+                                     Counter({'win-32': 1})])
+    sleep = mocker.patch.object(execute.time, 'sleep')
+    # compute in this process, so the mocks apply
+    mocker.patch.object(execute, 'ProcessPoolExecutor',
+                        return_value=mocker.Mock(submit=execute._run_now))
+
+    execute.submit_batch(
+        os.path.join(test_data_dir, 'batch_sample.txt'),
+        os.path.join(test_data_dir, 'one-off-recipes'),
+        config_root_dir=test_config_dir,
+        max_builds=6, poll_time=120, build_lookback=500, label_prefix='sentinel_',
+        precompute=1)
+    # the windows item does not wait behind the linux one
+    assert [call[0][0] for call in submit_computed.call_args_list] == [
+        'sentinel_pytest', 'sentinel_bzip']
+    # then waited twice for linux capacity
+    assert sleep.call_count == 2
+
+
+@pytest.mark.serial
+def test_submit_batch_retries_and_resumes(mocker, tmpdir):
+    mocker.patch.object(execute, 'compute_one_off', return_value={'centos5-64': 1})
+    # pytest fails once, then for good
+    submit_computed = mocker.patch.object(
+        execute, 'submit_computed_one_off',
+        side_effect=[None, RuntimeError('fly failed'), RuntimeError('fly failed')])
+    mocker.patch.object(execute, '_get_active_builds', return_value=Counter())
+    clock = [1000.0]
+    mocker.patch.object(execute.time, 'time', side_effect=lambda: clock[0])
+    sleep = mocker.patch.object(execute.time, 'sleep',
+                                side_effect=lambda seconds: clock.append(clock.pop() + seconds))
+    checkpoint = str(tmpdir.join('batch.json'))
+    kwargs = dict(batch_file=os.path.join(test_data_dir, 'batch_sample.txt'),
+                  recipe_root_dir=os.path.join(test_data_dir, 'one-off-recipes'),
+                  config_root_dir=test_config_dir, max_builds=6, poll_time=120,
+                  build_lookback=500, label_prefix='sentinel_', precompute=0,
+                  checkpoint=checkpoint, retries=1, retry_delay=30)
+
+    execute.submit_batch(**kwargs)
+    assert submit_computed.call_count == 3
+    sleep.assert_called_once_with(30)
+    with open(checkpoint) as f:
+        state = json.load(f)
+    assert state['bzip; clobber_sections_file=example.yaml']['status'] == 'submitted'
+    assert state['pytest pytest-cov']['status'] == 'failed'
+    assert state['pytest pytest-cov']['error'] == 'fly failed'
+    assert state['pytest pytest-cov']['attempts'] == 2
+
+    # the failures of the first run count towards the retries of a rerun
+    submit_computed.reset_mock(side_effect=True)
+    execute.submit_batch(**kwargs)
+    submit_computed.assert_not_called()
+    with open(checkpoint) as f:
+        assert json.load(f)['pytest pytest-cov']['attempts'] == 2
+
+    # a rerun only retries what failed
+    execute.submit_batch(**dict(kwargs, retries=2))
+    submit_computed.assert_called_once_with(
+        'sentinel_pytest', mocker.ANY, mocker.ANY, pass_throughs=None)
+    with open(checkpoint) as f:
+        assert json.load(f)['pytest pytest-cov']['status'] == 'submitted'
+
+
+@pytest.mark.serial
+def test_submit_batch_computes_past_delayed_retries(mocker, tmpdir):
+    mocker.patch.object(execute, 'compute_one_off', return_value={'centos5-64': 1})
+    submit_computed = mocker.patch.object(execute, 'submit_computed_one_off',
+                                          side_effect=[RuntimeError('fly failed'), None, None,
+                                                       None])
+    mocker.patch.object(execute, '_get_active_builds', return_value=Counter())
+    clock = [1000.0]
+    mocker.patch.object(execute.time, 'time', side_effect=lambda: clock[0])
+    sleep = mocker.patch.object(execute.time, 'sleep',
+                                side_effect=lambda seconds: clock.append(clock.pop() + seconds))
+    batch_file = tmpdir.join('batch.txt')
+    batch_file.write('a\nb\nc\n')
+
+    execute.submit_batch(str(batch_file), os.path.join(test_data_dir, 'one-off-recipes'),
+                         config_root_dir=test_config_dir, max_builds=6, poll_time=120,
+                         build_lookback=500, label_prefix='sentinel_', precompute=0,
+                         retries=1, retry_delay=30)
+    # the items after the failed one do not wait for its retry
+    assert [call[0][0] for call in submit_computed.call_args_list] == [
+        'sentinel_a', 'sentinel_b', 'sentinel_c', 'sentinel_a']
+    sleep.assert_called_once_with(30)
+
+
+@pytest.mark.parametrize('stage_mode', ['copy', 'link', 'reflink'])
+def test_write_recipes_stage_mode(tmpdir, stage_mode):
+    recipes = tmpdir.mkdir('recipes')
+    recipe = recipes.mkdir('zlib')
+    recipe.join('meta.yaml').write('package:\n  name: zlib\n')
+    recipe.join('conda_build_config.yaml').write('zlib: 1.2\n')
+    recipe.mkdir('patches').join('fix.patch').write('patch')
+    clobber = tmpdir.join('clobber.yaml')
+    clobber.write('extra: {}\n')
+    graph = nx.DiGraph()
+    for py in ('3.7', '3.8'):
+        graph.add_node('zlib-1.2-python_{}-on-linux'.format(py), worker={'label': 'linux'},
+                       meta=NodeRecord('zlib', '1.2', squished_variants={'python': py},
+                                       meta_path=str(recipe.join('meta.yaml'))))
+    output = str(tmpdir.join('output'))
+
+    execute.write_recipes(graph, str(recipes), output, clobber_sections_file=str(clobber),
+                          stage_mode=stage_mode)
+    for py in ('3.7', '3.8'):
+        out_folder = os.path.join(output, 'zlib-1.2-python_{}-on-linux'.format(py))
+        with open(os.path.join(out_folder, 'patches', 'fix.patch')) as f:
+            assert f.read() == 'patch'
+        if stage_mode == 'link':
+            assert os.path.samefile(os.path.join(out_folder, 'meta.yaml'),
+                                    str(recipe.join('meta.yaml')))
+        with open(os.path.join(out_folder, 'conda_build_config.yaml')) as f:
+            assert yaml.safe_load(f) == {'python': py}
+        with open(os.path.join(out_folder, 'recipe_clobber.yaml')) as f:
+            assert f.read() == 'extra: {}\n'
+    # the files of each node are not written through links into the recipe
+    assert recipe.join('conda_build_config.yaml').read() == 'zlib: 1.2\n'
+    with open(os.path.join(output, 'output_order_linux')) as f:
+        assert sorted(f.read().split()) == sorted(graph.nodes())
+
+
+def test_order_items_by_dependencies():
+    app, other, zlib = (execute.BatchItem(line) for line in ('app\n', 'other\n', 'zlib\n'))
+
+    def meta(folder):
+        return NodeRecord(folder, '1.0', meta_path=os.path.join('/recipes', folder, 'meta.yaml'))
+
+    graph = nx.DiGraph()
+    graph.add_node('app-1.0-on-linux', meta=meta('app'))
+    graph.add_node('app-1.0-on-win', meta=meta('app'))
+    graph.add_node('other-1.0-on-linux', meta=meta('other'))
+    graph.add_node('zlib-1.2-on-linux', meta=meta('zlib'))
+    graph.add_edge('app-1.0-on-linux', 'zlib-1.2-on-linux')
+
+    ordered, depends_on = execute._order_items_by_dependencies(
+        [app, other, zlib], graph, '/recipes')
+    # zlib heads the longest chain, and app has to wait for it
+    assert ordered == [zlib, app, other]
+    assert depends_on == {app: {zlib}, other: set(), zlib: set()}
+
+
+def test_add_pipeline_groups():
+    graph = nx.DiGraph()
+    for name, label in (('app', 'linux'), ('app', 'win'), ('lib', 'linux'), ('zlib', 'linux')):
+        graph.add_node('{}-1.0-on-{}'.format(name, label), worker={'label': label},
+                       meta=NodeRecord(name, '1.0',
+                                       meta_path=os.path.join('/recipes', name, 'meta.yaml')))
+    graph.add_node('test-zlib-1.0-on-win', worker={'label': 'win'}, test_only=True,
+                   meta=NodeRecord('zlib', '1.0',
+                                   meta_path=os.path.join('/recipes', 'zlib', 'meta.yaml')))
+    graph.add_edge('app-1.0-on-linux', 'lib-1.0-on-linux')
+    graph.add_edge('lib-1.0-on-linux', 'zlib-1.0-on-linux')
+    graph.add_edge('app-1.0-on-win', 'test-zlib-1.0-on-win')
+    plconfig = execute.PipelineConfig()
+    for node in graph.nodes():
+        plconfig.add_job(execute._job_name(graph, node))
+    plconfig.add_job('anaconda_upload')
+
+    execute.add_pipeline_groups(plconfig, graph, '/recipes')
+    assert plconfig.groups == [
+        {'name': 'linux-level-0', 'jobs': ['zlib-1.0-on-linux']},
+        {'name': 'linux-level-1', 'jobs': ['lib-1.0-on-linux']},
+        {'name': 'linux-level-2', 'jobs': ['app-1.0-on-linux']},
+        {'name': 'win-level-0', 'jobs': ['test-zlib-1.0-on-win']},
+        {'name': 'win-level-1', 'jobs': ['app-1.0-on-win']},
+        {'name': 'app', 'jobs': ['app-1.0-on-win', 'app-1.0-on-linux']},
+        {'name': 'lib', 'jobs': ['lib-1.0-on-linux']},
+        {'name': 'zlib', 'jobs': ['test-zlib-1.0-on-win', 'zlib-1.0-on-linux']},
+        {'name': 'other', 'jobs': ['anaconda_upload']},
+    ]
+
+
+def test_label_from_job_name():
+    assert execute._label_from_job_name('somepackage-1.0-on-centos5-64') == 'centos5-64'
+    assert execute._label_from_job_name('stage_for_upload') is None
 
 
 def test_bootstrap(mocker, testing_workdir):
@@ -147,6 +439,50 @@ def test_compute_builds(testing_workdir, mocker, monkeypatch):
     assert "HashableDict" not in cfg
 
 
+def test_compute_builds_sharded(testing_workdir, monkeypatch):
+    monkeypatch.chdir(test_data_dir)
+    output = os.path.join(testing_workdir, 'output')
+    execute.compute_builds('.', 'config-name',
+                           folders=['python_test', 'conda_forge_style_recipe'],
+                           matrix_base_dir=os.path.join(test_data_dir, 'linux-config-test'),
+                           output_dir=output, max_shard_jobs=1)
+    shards = execute._computed_shards(output)
+    assert len(shards) > 1
+    assert shards == sorted('test-{}-of-{}'.format(i, len(shards))
+                            for i in range(1, len(shards) + 1))
+    assert 'plan.yml' not in os.listdir(output)
+    jobs = set()
+    for shard in shards:
+        with open(os.path.join(output, shard, 'plan.yml')) as f:
+            plan = yaml.safe_load(f)
+        assert len(plan['jobs']) == 1
+        jobs.update(job['name'] for job in plan['jobs'])
+        assert os.path.isfile(os.path.join(output, shard, plan['jobs'][0]['name'], 'meta.yaml'))
+    assert 'dummy_conda_forge_test-1.0-on-centos5-64' in jobs
+    assert sum(execute._jobs_per_label(output).values()) == len(jobs)
+
+
+def test_compute_builds_reuses_output_dir(testing_workdir, monkeypatch):
+    monkeypatch.chdir(test_data_dir)
+    output = os.path.join(testing_workdir, 'output')
+
+    def compute(**kwargs):
+        execute.compute_builds('.', 'config-name',
+                               folders=['python_test', 'conda_forge_style_recipe'],
+                               matrix_base_dir=os.path.join(test_data_dir, 'linux-config-test'),
+                               output_dir=output, **kwargs)
+        return execute._computed_shards(output), execute._jobs_per_label(output)
+
+    shards, sharded_jobs = compute(max_shard_jobs=1)
+    assert len(shards) > 1
+    # the shards of the earlier run are not taken for part of the new plan
+    assert compute() == ([], sharded_jobs)
+    assert os.path.isfile(os.path.join(output, 'plan.yml'))
+    assert compute(max_shard_jobs=1) == (shards, sharded_jobs)
+    assert not os.path.exists(os.path.join(output, 'plan.yml'))
+    assert not glob.glob(os.path.join(output, 'output_order_*'))
+
+
 def test_compute_builds_intradependencies(testing_workdir, monkeypatch, mocker):
     """When we build stuff, and upstream dependencies are part of the batch, but they're
     also already installable, then we do extra work to make sure that we order our build
@@ -260,3 +596,21 @@ def test_collapse_noarch_python():
     assert ('pkg_b-1.0.0-python_2.7-on-win-32', a_build_node) in tasks.edges()
     assert ('pkg_b-1.0.0-python_3.6-on-centos5-64', a_build_node) in tasks.edges()
     assert ('pkg_b-1.0.0-python_2.7-on-centos5-64', a_build_node) in tasks.edges()
+
+
+def test_get_resolve_reuses_index_within_ttl(mocker):
+    mocker.patch.object(execute, 'get_build_index', return_value=({}, None))
+    mocker.patch.object(execute, 'Resolve', side_effect=lambda index: object())
+    mocker.patch.object(execute.compute_build_graph, 'forget_renders')
+    clock = mocker.patch.object(execute.time, 'time', return_value=1000)
+    mocker.patch.dict(execute._resolve_cache, clear=True)
+
+    # without a ttl the index is always fetched again
+    assert execute._get_resolve('linux-64', '/bld', ['c']) is not \
+        execute._get_resolve('linux-64', '/bld', ['c'])
+    first = execute._get_resolve('linux-64', '/bld', ['c'], ttl=300)
+    assert execute._get_resolve('linux-64', '/bld', ['c'], ttl=300) is first
+    assert execute._get_resolve('osx-64', '/bld', ['c'], ttl=300) is not first
+    clock.return_value = 1300
+    assert execute._get_resolve('linux-64', '/bld', ['c'], ttl=300) is not first
+    execute.compute_build_graph.forget_renders.assert_called_once_with()
@@ -0,0 +1,86 @@
+import time
+
+import pytest
+
+from conda_concourse_ci import pipelines
+
+from .utils import test_config_dir
+
+
+def test_rm_pipeline_logs_in_once(mocker):
+    con = mocker.Mock()
+    con.pipelines = ['one', 'two', 'other']
+    con.get_builds.side_effect = lambda p: [
+        {'status': 'started', 'job_name': 'job', 'name': '1'},
+        {'status': 'succeeded', 'job_name': 'job', 'name': '0'}]
+    login = mocker.patch.object(pipelines, '_ensure_login_and_sync', return_value=con)
+    pipelines.rm_pipeline(['one', 'two'], test_config_dir, do_it_dammit=True, parallel=4)
+    login.assert_called_once_with(test_config_dir)
+    con.abort_build.assert_has_calls([mocker.call('one', 'job', '1'),
+                                      mocker.call('two', 'job', '1')], any_order=True)
+    assert con.abort_build.call_count == 2
+    con.destroy_pipeline.assert_has_calls([mocker.call('one'), mocker.call('two')],
+                                          any_order=True)
+    assert con.destroy_pipeline.call_count == 2
+
+
+def test_trigger_pipeline_reports_failures(mocker):
+    con = mocker.Mock()
+    con.pipelines = ['one']
+    con.get_jobs.return_value = [
+        {'name': 'failed-job', 'next_build': None, 'finished_build': None},
+        {'name': 'running-job', 'next_build': {'id': 1}},
+        {'name': 'stage_for_upload', 'next_build': None, 'finished_build': None}]
+    con.trigger_job.side_effect = RuntimeError("boom")
+    mocker.patch.object(pipelines, '_ensure_login_and_sync', return_value=con)
+    with pytest.raises(RuntimeError):
+        pipelines.trigger_pipeline(['one'], test_config_dir)
+    con.trigger_job.assert_called_once_with('one', 'failed-job')
+
+
+def test_filter_pipelines_by_time(mocker, monkeypatch, tmpdir):
+    monkeypatch.setenv('C3I_CACHE_DIR', str(tmpdir))
+    now = time.time()
+    builds = {
+        'old': [{'end_time': now - 10 * 86400, 'status': 'succeeded'}],
+        'recent': [{'start_time': now - 3600, 'status': 'started'}],
+        'empty': [],
+        # the newest build was aborted before it started
+        'aborted': [{'status': 'aborted'}, {'end_time': now - 10 * 86400, 'status': 'failed'}],
+    }
+    con = mocker.Mock(concourse_url='http://concourse')
+    con.get_builds.side_effect = lambda pipeline, limit=None: builds[pipeline]
+    assert pipelines._filter_pipelines_by_time(con, ['old', 'recent', 'empty'], 7) == ['old']
+    con.get_builds.assert_has_calls([mocker.call('old', limit=10)])
+
+    # recent activity is cached and conclusive, everything else is still fresh in the cache
+    con.get_builds.reset_mock()
+    assert pipelines._filter_pipelines_by_time(con, ['old', 'recent', 'empty'], 7) == ['old']
+    con.get_builds.assert_not_called()
+
+    # once the ttl is up, only pipelines which may be removed are looked up again
+    assert pipelines._filter_pipelines_by_time(con, ['old', 'recent', 'empty'], 7,
+                                             cache_ttl=-1) == ['old']
+    assert sorted(c[0][0] for c in con.get_builds.call_args_list) == ['empty', 'old']
+
+    assert pipelines._filter_pipelines_by_time(con, ['aborted'], 7) == ['aborted']
+
+
+def test_last_activity_looks_past_builds_without_time(mocker):
+    builds = [{'status': 'aborted'}, {'status': 'aborted'}, {'end_time': 100, 'status': 'failed'}]
+    con = mocker.Mock()
+    con.get_builds.side_effect = lambda pipeline, limit=None: builds[:limit]
+    assert pipelines._last_activity(con, 'one', page_size=2) == 100
+    assert con.get_builds.call_args_list == [mocker.call('one', limit=2), mocker.call('one')]
+    builds.pop()
+    assert pipelines._last_activity(con, 'one', page_size=2) is None
+
+
+def test_ensure_login_and_sync_reuses_session(mocker):
+    mocker.patch.dict(pipelines._sessions, clear=True)
+    mocker.patch.object(pipelines, 'BACKENDS', {'fly': mocker.Mock()})
+    con = pipelines._ensure_login_and_sync(test_config_dir)
+    assert pipelines._ensure_login_and_sync(test_config_dir) is con
+    pipelines.BACKENDS['fly'].assert_called_once()
+    assert con.ensure_login.call_count == 2
+    assert con.sync_if_needed.call_count == 2
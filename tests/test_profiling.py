@@ -0,0 +1,73 @@
+import json
+import os
+import subprocess
+import sys
+
+from conda_concourse_ci import profiling
+
+
+def test_phase_does_nothing_when_disabled():
+    profiling.disable()
+    with profiling.phase('render'):
+        pass
+    assert profiling._profiler is None
+
+
+def test_phases_accumulate(tmpdir):
+    profiler = profiling.enable(cprofile_dir=str(tmpdir.join('prof')))
+    try:
+        for _ in range(2):
+            with profiling.phase('render'):
+                with profiling.phase('index fetch'):
+                    sum(range(1000))
+        with profiling.phase('yaml dump'):
+            pass
+    finally:
+        profiling.disable()
+    report_file = str(tmpdir.join('report.json'))
+    profiler.write(report_file)
+
+    with open(report_file) as f:
+        report = json.load(f)
+    assert list(report['phases']) == ['render', 'index fetch', 'yaml dump']
+    assert report['phases']['render']['calls'] == 2
+    assert report['phases']['index fetch']['calls'] == 2
+    assert report['phases']['render']['wall'] >= report['phases']['index fetch']['wall']
+    assert report['wall'] >= report['phases']['render']['wall']
+    # only the outermost phases are profiled
+    assert sorted(os.listdir(str(tmpdir.join('prof')))) == ['render.prof', 'yaml_dump.prof']
+
+
+def test_metrics_count_calls_and_time():
+    profiling.reset_metrics()
+
+    @profiling.counted('lookups')
+    def lookup(key):
+        return key
+
+    @profiling.timed('scans')
+    def scan():
+        profiling.count('hits', 2)
+
+    assert lookup('a') == 'a'
+    lookup('b')
+    scan()
+    with profiling.timer('scans'):
+        pass
+
+    metrics = profiling.metrics()
+    assert metrics['counters'] == {'hits': 2, 'lookups': 2}
+    assert metrics['timers']['scans']['calls'] == 2
+    assert metrics['timers']['scans']['seconds'] >= 0
+    profiling.reset_metrics()
+    assert profiling.metrics() == {'counters': {}, 'timers': {}}
+
+
+def test_metrics_written_at_exit(tmpdir):
+    metrics_file = str(tmpdir.join('metrics.json'))
+    code = ("from conda_concourse_ci import profiling; "
+            "[profiling.count('fly pipelines') for _ in range(3)]")
+    env = dict(os.environ, C3I_METRICS=metrics_file)
+    subprocess.check_call([sys.executable, '-c', code], env=env)
+    with open(metrics_file) as f:
+        assert json.load(f)['counters'] == {'fly pipelines': 3}
@@ -0,0 +1,86 @@
+import os
+import shutil
+import threading
+
+import pytest
+
+from conda_concourse_ci import compute_build_graph, execute, profiling, serve
+
+from .utils import graph_data_dir, test_config_dir
+
+
+@pytest.fixture
+def server(monkeypatch, tmpdir):
+    monkeypatch.setattr(compute_build_graph, 'track_recipe_changes', False)
+    socket_path = str(tmpdir.join('c3i.sock'))
+    server = serve.Server(socket_path, index_ttl=0)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    yield server
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+def test_forward_without_server(tmpdir):
+    assert not serve.forward('examine', {}, str(tmpdir.join('c3i.sock')))
+
+
+def test_forward_examine(mocker, capsys, tmpdir, server):
+    def compute_builds(folders, **kw):
+        print('examined', ' '.join(folders))
+    mocker.patch.object(execute, 'compute_builds', side_effect=compute_builds)
+    mocker.patch.object(compute_build_graph, 'forget_renders')
+    mocker.patch.object(compute_build_graph, 'forget_stale_renders', return_value=set())
+    kwargs = {'path': '.', 'base_name': 'frank', 'folders': ['bzip2'],
+              'matrix_base_dir': str(tmpdir)}
+
+    assert serve.forward('examine', kwargs, server.server_address)
+    assert capsys.readouterr().out == 'examined bzip2\n'
+    execute.compute_builds.assert_called_once_with(index_ttl=0, **kwargs)
+    assert compute_build_graph.forget_renders.call_count == 1
+
+    # only the recipes which changed on disk are rendered again for the same configuration
+    serve.forward('examine', dict(kwargs, folders=['pytest']), server.server_address)
+    assert capsys.readouterr().out == 'examined pytest\n'
+    assert compute_build_graph.forget_renders.call_count == 1
+    assert compute_build_graph.forget_stale_renders.call_count == 1
+
+    serve.forward('examine', dict(kwargs, channel=['conda-forge']), server.server_address)
+    assert compute_build_graph.forget_renders.call_count == 2
+
+
+def test_forward_examine_after_config_change(mocker, tmpdir, testing_conda_resolve, server):
+    mocker.patch.object(execute, 'Resolve', return_value=testing_conda_resolve)
+    mocker.patch.object(execute, 'get_build_index')
+    mocker.patch.object(compute_build_graph, '_installable', return_value=True)
+    mocker.patch.object(execute, 'compute_builds', side_effect=lambda **kw: execute.collect_tasks(
+        graph_data_dir, folders=kw['folders'], matrix_base_dir=kw['matrix_base_dir']))
+    matrix_base_dir = str(tmpdir.join('config'))
+    shutil.copytree(test_config_dir, matrix_base_dir)
+    kwargs = {'path': '.', 'folders': ['a'], 'matrix_base_dir': matrix_base_dir}
+
+    def render_misses():
+        profiling.reset_metrics()
+        serve.forward('examine', kwargs, server.server_address)
+        return profiling.metrics()['counters'].get('render cache misses', 0)
+
+    try:
+        assert render_misses() > 0
+        assert render_misses() == 0
+        # the arguments are the same, but the platform is not
+        with open(os.path.join(matrix_base_dir, 'build_platforms.d', 'centos5-64.yml'), 'a') as f:
+            f.write('variants:\n  c_compiler: gcc\n')
+        assert render_misses() > 0
+        assert render_misses() == 0
+    finally:
+        compute_build_graph.forget_renders()
+        profiling.reset_metrics()
+
+
+def test_forward_raises_errors(mocker, server):
+    mocker.patch.object(execute, 'compute_builds', side_effect=ValueError("bad recipe"))
+    with pytest.raises(serve.ServerError, match='bad recipe'):
+        serve.forward('examine', {'matrix_base_dir': '.'}, server.server_address)
+    with pytest.raises(serve.ServerError, match='cannot run'):
+        serve.forward('one-off', {}, server.server_address)
@@ -1,7 +1,8 @@
 import os
 
-from conda_concourse_ci import uploads
+from conda_concourse_ci import compute_build_graph, uploads
 
+import pytest
 import yaml
 from conda_build import conda_interface
 
@@ -91,7 +92,11 @@ def test_upload_command_list():
     assert tasks[1]['config']['run']['path'] == 'wee'
 
 
-def test_get_upload_tasks(mocker, testing_graph):
+@pytest.mark.parametrize('compact', [False, True])
+def test_get_upload_tasks(mocker, testing_graph, compact):
+    if compact:
+        # as collect_tasks leaves the graph for uploads
+        compute_build_graph.compact_graph(testing_graph, output_paths=True)
     with open(os.path.join(test_config_dir, 'config.yml')) as f:
         config_vars = yaml.safe_load(f)
     mocker.patch.object(uploads, 'load_yaml_config_dir')
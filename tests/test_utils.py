@@ -1,4 +1,7 @@
-from conda_concourse_ci.utils import ensure_list, HashableDict
+from conda_build.utils import HashableDict
+
+from conda_concourse_ci.utils import ensure_list
+
 
 def test_ensure_list():
     a = ensure_list('abc')